@@ -1,13 +1,27 @@
 import os
 import json
-from flask import Flask, request, render_template_string, session, Response, send_file, abort, url_for, send_from_directory, redirect, jsonify
+import re
+from flask import Flask, Request, request, render_template_string, session, Response, send_file, abort, url_for, send_from_directory, redirect, jsonify
 import google.generativeai as genai
 import pdfplumber
+from pdf_extraction import iter_page_texts, extract_tables
 import pandas as pd
 import io
 import grpc
 import time
+import hashlib
+import hmac
+import sqlite3
+import threading
+import uuid
+import shutil
+import tempfile
+from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
 from urllib.parse import quote
 
@@ -17,6 +31,16 @@ try:
 except ImportError:
     google_exceptions = None
 
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, each worker refreshes on its own
+    fcntl = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # the ingestion watcher polls instead
+    INotify = None
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
@@ -26,7 +50,29 @@ if api_key:
     genai.configure(api_key=api_key)
 
 FINANCE_UPLOAD_DIR = os.path.join('uploads', 'finance')
-os.makedirs(FINANCE_UPLOAD_DIR, exist_ok=True)
+# Form uploads get their own subfolder so the ingestion watcher (on FINANCE_UPLOAD_DIR) skips them
+FINANCE_FORM_UPLOAD_DIR = os.path.join(FINANCE_UPLOAD_DIR, 'web')
+os.makedirs(FINANCE_FORM_UPLOAD_DIR, exist_ok=True)
+
+# Local state shared by all gunicorn workers (SQLite files)
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+os.makedirs(DATA_DIR, exist_ok=True)
+
+
+def env_flag(name, default=False):
+    """Read a boolean feature flag from the environment ("1", "true", "yes", "on")."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def open_sqlite(path):
+    """Open a SQLite connection that can safely share a file with other workers."""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
 
 # --- DEPARTMENT CONFIG ---
 DEFAULT_DEPARTMENT = "finance"
@@ -121,8 +167,63 @@ ENGINEERING_PROMPT_LIMIT = 6000
 ENGINEERING_PROMPT_LIMIT_SHORT = 3200
 TRANSMITTAL_PROMPT_LIMIT = 3200
 
+# Long engineering schedules are split into prompt-sized chunks instead of being truncated
+ENGINEERING_CHUNKING = env_flag('ENGINEERING_CHUNKING', True)
+ENGINEERING_MAX_CHUNKS = int(os.environ.get('ENGINEERING_MAX_CHUNKS', 8))
+ENGINEERING_CHUNK_CONCURRENCY = int(os.environ.get('ENGINEERING_CHUNK_CONCURRENCY', 4))
+
+# Transmittals can instead be extracted with one smaller prompt per category group, run concurrently
+TRANSMITTAL_SPLIT_PROMPTS = env_flag('TRANSMITTAL_SPLIT_PROMPTS', False)
+TRANSMITTAL_CATEGORY_RETRIES = int(os.environ.get('TRANSMITTAL_CATEGORY_RETRIES', 1))
+TRANSMITTAL_CATEGORY_GROUPS = [
+    ["DrawingRegister"],
+    ["Standards", "Materials"],
+    ["Connections", "CrossReferences"],
+    ["Assumptions", "VOSFlags"],
+]
+
+def prompt_char_budget(doc_type):
+    """Characters of document text a doc_type's prompt can use (None = unlimited)."""
+    if doc_type == "engineering":
+        return ENGINEERING_PROMPT_LIMIT
+    if doc_type == "transmittal":
+        return TRANSMITTAL_PROMPT_LIMIT
+    return None
+
+def extraction_char_budget(doc_type):
+    """Characters worth extracting from a PDF: the largest prompt budget, or every chunk's worth when chunking."""
+    if doc_type == "engineering" and ENGINEERING_CHUNKING:
+        return ENGINEERING_PROMPT_LIMIT_SHORT * ENGINEERING_MAX_CHUNKS
+    budget = prompt_char_budget(doc_type)
+    if budget and ADAPTIVE_PROMPT_BUDGET:
+        return int(budget * PROMPT_BUDGET_MAX_GROWTH)
+    return budget
+
+# Shorter lines (marks, sizes, "Concrete Grade: 32 MPa") repeat legitimately and are never treated as boilerplate
+BOILERPLATE_MIN_LINE_CHARS = 30
+
+def compact_prompt_text(text, dedupe_lines=False):
+    """Collapse whitespace and, optionally, drop repeated lines (title blocks, legends, notes
+    repeated on every sheet) so a character budget holds more distinct content.
+
+    Lines are joined with single spaces, as the prompts have always received them.
+    """
+    seen = set()
+    lines = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line:
+            continue
+        if dedupe_lines and len(line) >= BOILERPLATE_MIN_LINE_CHARS:
+            if line in seen:
+                continue
+            seen.add(line)
+        lines.append(line)
+    return " ".join(lines)
+
 def prepare_prompt_text(text, doc_type, limit=None):
-    cleaned = text.replace("\n", " ").strip()
+    # Repeated lines are only dropped where a budget forces truncation; invoice line items may legitimately repeat
+    cleaned = compact_prompt_text(text, dedupe_lines=prompt_char_budget(doc_type) is not None)
     if doc_type == "engineering":
         limit = ENGINEERING_PROMPT_LIMIT_SHORT if limit is None else limit
         return cleaned[:limit]
@@ -137,8 +238,6 @@ ALLOWED_SAMPLE_PATHS = {
     for sample in group["samples"]
 }
 
-# Cache for available models
-_available_models = None
 FINANCE_FIELDS = ["Vendor", "Date", "InvoiceNum", "Cost", "GST", "FinalAmount", "Summary"]
 ENGINEERING_BEAM_FIELDS = ["Mark", "Size", "Qty", "Length", "Grade", "PaintSystem", "Comments"]
 ENGINEERING_COLUMN_FIELDS = ["Mark", "SectionType", "Size", "Length", "Grade", "BasePlate", "CapPlate", "Finish", "Comments"]
@@ -150,53 +249,748 @@ DOC_FIELDS = {
 }
 ERROR_FIELD = {"finance": "Summary", "engineering": "Comments", "transmittal": "Title"}
 
+# --- MODEL CATALOGUE ---
+# genai.list_models() is slow and every worker used to call it on cold start (and again on
+# every document after a failure). The result is kept in a JSON file shared by all workers,
+# refreshed in the background once it is older than the TTL; failed listings back off
+# exponentially instead of being retried per document.
+MODEL_CATALOGUE_PATH = os.environ.get('MODEL_CATALOGUE_PATH', os.path.join(DATA_DIR, 'model_catalogue.json'))
+MODEL_CATALOGUE_TTL_SECONDS = int(os.environ.get('MODEL_CATALOGUE_TTL_SECONDS', 6 * 60 * 60))
+MODEL_CATALOGUE_RETRY_SECONDS = int(os.environ.get('MODEL_CATALOGUE_RETRY_SECONDS', 30))
+MODEL_CATALOGUE_MAX_RETRY_SECONDS = 15 * 60
+
+STABLE_PREFERRED_MODELS = ['gemini-2.5-flash-lite', 'gemini-2.5-pro', 'gemini-2.5-flash', 'gemini-pro-latest']
+
+
+def _model_preferences(doc_type):
+    configured = os.environ.get(f'GEMINI_MODELS_{doc_type.upper()}')
+    if configured:
+        return [name.strip() for name in configured.split(',') if name.strip()]
+    return STABLE_PREFERRED_MODELS
+
+
+# Preferred model order per doc_type; GEMINI_MODELS_FINANCE etc. override the default order
+MODEL_PREFERENCES = {doc_type: _model_preferences(doc_type) for doc_type in ("finance", "engineering", "transmittal")}
+MODEL_PREFERENCES["finance_batch"] = MODEL_PREFERENCES["finance"]
+
+_catalogue = None
+_catalogue_mtime = None
+_catalogue_lock = threading.Lock()
+_catalogue_refreshing = False
+_candidate_lists = {}  # doc_type -> ranked list for _candidate_catalogue
+_candidate_catalogue = None
+
+
+def list_generation_models():
+    """Ask the API for models that support generateContent (names without the models/ prefix)."""
+    models_list = list(genai.list_models())
+    print(f"Found {len(models_list)} total models")
+    available = []
+    for m in models_list:
+        try:
+            model_name = m.name
+            if model_name.startswith('models/'):
+                model_name = model_name.replace('models/', '')
+
+            # Check if model supports generateContent
+            supported_methods = getattr(m, 'supported_generation_methods', [])
+            if hasattr(supported_methods, '__iter__'):
+                methods = list(supported_methods)
+            else:
+                methods = [str(supported_methods)] if supported_methods else []
+
+            if 'generateContent' in methods or len(methods) == 0:
+                available.append(model_name)
+        except Exception as e:
+            print(f"Error processing model {m}: {e}")
+            continue
+    print(f"Available models for generateContent: {available}")
+    return available
+
+
+def _read_catalogue():
+    """Return the catalogue dict, re-reading the shared file only when it has changed."""
+    global _catalogue, _catalogue_mtime
+    try:
+        mtime = os.path.getmtime(MODEL_CATALOGUE_PATH)
+    except OSError:
+        return _catalogue or {}
+    if mtime != _catalogue_mtime:
+        try:
+            with open(MODEL_CATALOGUE_PATH) as f:
+                _catalogue = json.load(f)
+            _catalogue_mtime = mtime
+        except (OSError, ValueError) as e:
+            print(f"Could not read model catalogue: {e}")
+    return _catalogue or {}
+
+
+def _write_catalogue(catalogue):
+    global _catalogue
+    _catalogue = catalogue
+    temp_path = f"{MODEL_CATALOGUE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(catalogue, f)
+        os.replace(temp_path, MODEL_CATALOGUE_PATH)
+    except OSError as e:
+        print(f"Could not write model catalogue: {e}")
+
+
+@contextmanager
+def _catalogue_file_lock(blocking):
+    """Cross-worker lock so only one process lists models at a time; yields whether it was acquired."""
+    if fcntl is None:
+        yield True
+        return
+    with open(f"{MODEL_CATALOGUE_PATH}.lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def refresh_model_catalogue(blocking=False):
+    """List models and record the result (or the failure and its backoff) in the catalogue.
+
+    If another worker is already refreshing, a non-blocking call returns the current catalogue
+    and a blocking call waits for that refresh instead of listing again.
+    """
+    global _catalogue_refreshing
+    try:
+        with _catalogue_file_lock(blocking) as acquired:
+            previous = _read_catalogue()
+            recently_fetched = time.time() - previous.get("fetched_at", 0) <= MODEL_CATALOGUE_TTL_SECONDS
+            if not acquired or recently_fetched:
+                return previous
+            catalogue = dict(previous)
+            try:
+                catalogue.update({
+                    "models": list_generation_models(),
+                    "fetched_at": time.time(),
+                    "failures": 0,
+                    "retry_after": 0,
+                    "last_error": None
+                })
+            except Exception as e:
+                failures = previous.get("failures", 0) + 1
+                delay = min(MODEL_CATALOGUE_MAX_RETRY_SECONDS, MODEL_CATALOGUE_RETRY_SECONDS * 2 ** (failures - 1))
+                print(f"Error listing models: {type(e).__name__}: {e} - next attempt in {delay}s")
+                catalogue.update({
+                    "failures": failures,
+                    "retry_after": time.time() + delay,
+                    "last_error": f"{type(e).__name__}: {e}"
+                })
+            _write_catalogue(catalogue)
+            return catalogue
+    finally:
+        with _catalogue_lock:
+            _catalogue_refreshing = False
+
+
 def get_available_models():
-    """Get list of available Gemini models"""
-    global _available_models
-    if _available_models is not None:
-        return _available_models
-    
+    """Get list of available Gemini models (None if they have never been listed successfully)"""
+    global _catalogue_refreshing
     if not api_key:
         return []
-    
-    _available_models = []
+
+    catalogue = _read_catalogue()
+    now = time.time()
+    is_stale = now - catalogue.get("fetched_at", 0) > MODEL_CATALOGUE_TTL_SECONDS
+    can_retry = now >= catalogue.get("retry_after", 0)
+    if is_stale and can_retry:
+        with _catalogue_lock:
+            start_refresh = not _catalogue_refreshing
+            _catalogue_refreshing = True
+        if start_refresh:
+            if catalogue.get("models"):
+                # Serve the stale list while a fresh one is fetched
+                threading.Thread(target=refresh_model_catalogue, name='model-catalogue', daemon=True).start()
+            else:
+                catalogue = refresh_model_catalogue(blocking=True)
+    return catalogue.get("models") or None
+
+
+def _rank_candidates(available_models, stable_preferred):
+    """Pick the models to try from the available list; returns (model_names, action_log)."""
+    model_names = []
+    action_log = []
+
+    action_log.append(f"Model selection: Checking {len(available_models) if available_models else 0} available models")
+    action_log.append(f"Preferred order: {', '.join(stable_preferred)}")
+
+    if available_models and len(available_models) > 0:
+        # Prefer stable GA models in defined order
+        model_names = [m for m in stable_preferred if m in available_models]
+        if model_names:
+            action_log.append(f"Found {len(model_names)} preferred model(s): {', '.join(model_names)}")
+        if not model_names:
+            # Expand to include any available model that contains the GA name
+            preview_candidates = []
+            for preferred in stable_preferred:
+                for m in available_models:
+                    if preferred in m and m not in preview_candidates:
+                        preview_candidates.append(m)
+            if preview_candidates:
+                model_names = preview_candidates
+                action_log.append(f"Using preview variants: {', '.join(model_names)}")
+        if not model_names:
+            legacy = [m for m in available_models if m.startswith("gemini-1.5")]
+            if legacy:
+                model_names = legacy[:2]
+                action_log.append(f"Falling back to legacy models: {', '.join(model_names)}")
+        if not model_names:
+            model_names = available_models[:2]
+            action_log.append(f"Using first available models: {', '.join(model_names)}")
+        print(f"Using available models from API: {model_names}")
+    else:
+        model_names = list(stable_preferred)
+        action_log.append(f"API listing failed, using fallback: {', '.join(model_names)}")
+        print(f"Using fallback models (API listing failed): {model_names}")
+
+    return model_names, action_log
+
+
+def select_model_candidates(doc_type=None):
+    """Return (model_names, action_log) listing the Gemini models to try, in order of preference.
+
+    Ranked lists are computed once per catalogue version and doc_type, so this is normally a
+    dictionary lookup.
+    """
+    global _candidate_catalogue
+    available_models = get_available_models()
+    preferred = MODEL_PREFERENCES.get(doc_type, STABLE_PREFERRED_MODELS)
+    catalogue = tuple(available_models or ())
+    with _catalogue_lock:
+        if catalogue != _candidate_catalogue:
+            # A new catalogue invalidates every doc_type's list; otherwise they are all kept
+            _candidate_lists.clear()
+            _candidate_catalogue = catalogue
+        ranked = _candidate_lists.get(doc_type)
+    if ranked is None:
+        ranked = _rank_candidates(available_models, preferred)
+        with _catalogue_lock:
+            if catalogue == _candidate_catalogue:
+                _candidate_lists[doc_type] = ranked
+    model_names, action_log = ranked
+    return list(model_names), list(action_log)
+
+# --- MODEL CLIENTS ---
+# GenerativeModel handles are created once per worker and shared by every request; the
+# google.generativeai client (and its gRPC channel) behind them is likewise shared. A
+# transport failure drops the handles and rebuilds the client so the next call reconnects.
+ASSISTANT_MODEL = 'gemini-2.0-flash-exp'  # Blog search, contact assistant and relevance checks
+GEMINI_CLIENT_WARMUP = env_flag('GEMINI_CLIENT_WARMUP', True)
+CLIENT_RECONNECT_MIN_INTERVAL_SECONDS = 10
+
+_model_clients = {}
+_model_clients_lock = threading.Lock()
+_last_client_reset = 0.0
+
+
+def get_model(model_name):
+    """Return the shared GenerativeModel handle for model_name, creating it on first use."""
+    with _model_clients_lock:
+        model = _model_clients.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            _model_clients[model_name] = model
+        return model
+
+
+def is_connection_error(error):
+    """True for transport-level failures where reconnecting may help (not quota/404/timeouts)."""
+    if isinstance(error, ConnectionError):
+        return True
+    if google_exceptions and isinstance(error, google_exceptions.ServiceUnavailable):
+        return True
+    if isinstance(error, grpc.RpcError) and hasattr(error, 'code'):
+        return error.code() == grpc.StatusCode.UNAVAILABLE
+    return False
+
+
+def reset_model_clients(reason):
+    """Drop cached handles and rebuild the Gemini client (at most once per interval)."""
+    global _last_client_reset
+    with _model_clients_lock:
+        if time.time() - _last_client_reset < CLIENT_RECONNECT_MIN_INTERVAL_SECONDS:
+            return False
+        _last_client_reset = time.time()
+        _model_clients.clear()
+        if api_key:
+            genai.configure(api_key=api_key)
+    print(f"Gemini clients reset: {reason}")
+    return True
+
+
+def report_model_error(error):
+    """Reset the shared clients if error looks like a broken connection."""
+    if is_connection_error(error):
+        reset_model_clients(f"{type(error).__name__}: {error}")
+
+
+def warm_model_clients():
+    """Create handles for the extraction candidates and the assistant model and send each a
+    count_tokens call (free, no generation), so the channel is open and TLS is done before the
+    first request."""
+    if not api_key:
+        return
+    started = time.time()
     try:
-        models = genai.list_models()
-        models_list = list(models)  # Convert to list once
-        print(f"Found {len(models_list)} total models")
-        
-        # Extract model names, removing 'models/' prefix
-        for m in models_list:
-            try:
-                model_name = m.name
-                if model_name.startswith('models/'):
-                    model_name = model_name.replace('models/', '')
-                
-                # Check if model supports generateContent
-                supported_methods = getattr(m, 'supported_generation_methods', [])
-                if hasattr(supported_methods, '__iter__'):
-                    methods = list(supported_methods)
-                else:
-                    methods = [str(supported_methods)] if supported_methods else []
-                
-                if 'generateContent' in methods or len(methods) == 0:
-                    _available_models.append(model_name)
-                    print(f"  - {model_name} (methods: {methods})")
-            except Exception as e:
-                print(f"Error processing model {m}: {e}")
-                continue
-        
-        print(f"Available models for generateContent: {_available_models}")
-        return _available_models if _available_models else None
+        model_names = [ASSISTANT_MODEL]
+        for doc_type in MODEL_PREFERENCES:
+            model_names += [m for m in select_model_candidates(doc_type)[0] if m not in model_names]
     except Exception as e:
-        print(f"Error listing models: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
-        # Return None to use fallback
+        print(f"Gemini client warm-up failed: {type(e).__name__}: {e}")
+        return
+    warmed = 0
+    for model_name in model_names:
+        try:
+            get_model(model_name).count_tokens("ping", request_options={"timeout": 10})
+            warmed += 1
+        except Exception as e:
+            print(f"Gemini client warm-up failed for {model_name}: {type(e).__name__}: {e}")
+    print(f"Gemini clients warmed in {time.time() - started:.1f}s ({warmed} of {len(model_names)} model(s) answered count_tokens)")
+
+
+# --- MODEL HEALTH ---
+# Process-wide view of how each Gemini model has been behaving: rolling latencies and
+# outcomes plus a circuit breaker. analyze_gemini asks rank_models() for the order to try
+# candidates, so models that keep timing out or 404ing are skipped instead of rediscovered
+# (with backoff sleeps) on every document.
+MODEL_HEALTH_WINDOW = int(os.environ.get('MODEL_HEALTH_WINDOW', 50))
+MODEL_BREAKER_FAILURES = int(os.environ.get('MODEL_BREAKER_FAILURES', 3))
+MODEL_BREAKER_COOLDOWN_SECONDS = int(os.environ.get('MODEL_BREAKER_COOLDOWN_SECONDS', 120))
+MODEL_HALF_OPEN_TRIAL_SECONDS = 90  # A half-open trial that never reports back is abandoned after this
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Hedged requests: if the model being tried has not answered within its recent latency
+# percentile, the same prompt also goes to the next candidate and the first valid answer wins.
+GEMINI_HEDGING = env_flag('GEMINI_HEDGING', False)
+HEDGE_LATENCY_PERCENTILE = float(os.environ.get('HEDGE_LATENCY_PERCENTILE', 90))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('HEDGE_DEFAULT_DELAY_SECONDS', 12))
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('HEDGE_MIN_DELAY_SECONDS', 3))
+HEDGE_MAX_IN_FLIGHT = int(os.environ.get('HEDGE_MAX_IN_FLIGHT', 2))
+
+# Stream engineering responses so completed rows can be shown while Gemini is still writing
+GEMINI_STREAMING = env_flag('GEMINI_STREAMING', True)
+
+_model_health = {}
+_model_health_lock = threading.Lock()
+
+
+def _health_record(model_name):
+    record = _model_health.get(model_name)
+    if record is None:
+        record = {
+            "latencies": deque(maxlen=MODEL_HEALTH_WINDOW),
+            "outcomes": deque(maxlen=MODEL_HEALTH_WINDOW),
+            "state": "closed",
+            "opened_at": None,
+            "trial_started": None,
+            "consecutive_failures": 0,
+            "last_error": None,
+            "payloads": deque(maxlen=MODEL_HEALTH_WINDOW)  # (prompt tokens, latency or None on timeout)
+        }
+        _model_health[model_name] = record
+    return record
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def record_model_result(model_name, outcome, latency=None, error=None, prompt_tokens=None):
+    """Record one call: outcome is "success", "timeout", "not_found" or "error"."""
+    with _model_health_lock:
+        record = _health_record(model_name)
+        record["outcomes"].append(outcome)
+        if latency is not None and outcome == "success":
+            record["latencies"].append(latency)
+        if prompt_tokens and outcome in ("success", "timeout"):
+            record["payloads"].append((prompt_tokens, latency if outcome == "success" else None))
+        if outcome == "success":
+            record["consecutive_failures"] = 0
+            record["state"] = "closed"
+            record["opened_at"] = None
+            record["trial_started"] = None
+            return
+        record["consecutive_failures"] += 1
+        record["last_error"] = error or outcome
+        should_open = (
+            record["state"] == "half_open"
+            or outcome == "not_found"
+            or record["consecutive_failures"] >= MODEL_BREAKER_FAILURES
+        )
+        if should_open:
+            if record["state"] != "open":
+                print(f"Circuit breaker opened for {model_name} after {outcome}")
+            record["state"] = "open"
+            record["opened_at"] = time.time()
+            record["trial_started"] = None
+
+
+def _model_stats(record):
+    outcomes = list(record["outcomes"])
+    total = len(outcomes)
+    latencies = list(record["latencies"])
+    return {
+        "samples": total,
+        "error_rate": round(sum(1 for o in outcomes if o != "success") / total, 3) if total else 0.0,
+        "timeout_rate": round(sum(1 for o in outcomes if o == "timeout") / total, 3) if total else 0.0,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p90": _percentile(latencies, 90),
+        "latency_p99": _percentile(latencies, 99)
+    }
+
+
+def model_latency_percentile(model_name, pct):
+    """Observed latency percentile for a model in seconds (None until it has succeeded)."""
+    with _model_health_lock:
+        record = _model_health.get(model_name)
+        return _percentile(list(record["latencies"]), pct) if record else None
+
+
+def largest_payload_within(model_name, target_seconds):
+    """Largest prompt (in tokens) this model is expected to answer within target_seconds.
+
+    Fits latency = overhead + tokens * per-token cost to the model's recent successful calls
+    and stays below any size that recently timed out. None until there are enough samples.
+    """
+    with _model_health_lock:
+        record = _model_health.get(model_name)
+        samples = list(record["payloads"]) if record else []
+    completed = [(tokens, latency) for tokens, latency in samples if latency is not None]
+    if len(completed) < PROMPT_BUDGET_MIN_SAMPLES:
         return None
+    mean_tokens = sum(t for t, _ in completed) / len(completed)
+    mean_latency = sum(l for _, l in completed) / len(completed)
+    spread = sum((t - mean_tokens) ** 2 for t, _ in completed)
+    slope = sum((t - mean_tokens) * (l - mean_latency) for t, l in completed) / spread if spread else 0
+    if slope > 0:
+        largest = mean_tokens + (target_seconds - mean_latency) / slope
+    else:
+        # No size/latency trend: trust the largest prompt that finished in time
+        in_time = [t for t, l in completed if l <= target_seconds]
+        largest = max(in_time) if in_time else min(t for t, _ in completed)
+    timed_out = [tokens for tokens, latency in samples if latency is None]
+    if timed_out:
+        largest = min(largest, 0.8 * min(timed_out))
+    return max(0, int(largest))
+
+
+def hedge_delay(model_name):
+    """Seconds to wait on a model before hedging to the next candidate."""
+    observed = model_latency_percentile(model_name, HEDGE_LATENCY_PERCENTILE)
+    delay = observed if observed is not None else HEDGE_DEFAULT_DELAY_SECONDS
+    return max(HEDGE_MIN_DELAY_SECONDS, delay)
+
+
+def rank_models(model_names):
+    """Order candidate models by health for one request.
+
+    Open breakers are skipped; after the cooldown a breaker goes half-open and the model is
+    offered as a trial (begin_model_call() claims the trial when the call is made). Healthy models are ordered by error rate, then median
+    latency, then the original preference. Returns (ordered_names, notes for the action log).
+    """
+    now = time.time()
+    notes = []
+    ranked = []
+    with _model_health_lock:
+        for preference, model_name in enumerate(model_names):
+            record = _health_record(model_name)
+            if record["state"] == "open":
+                if now - record["opened_at"] < MODEL_BREAKER_COOLDOWN_SECONDS:
+                    notes.append(f"Skipping {model_name}: circuit open ({record['last_error']})")
+                    continue
+                record["state"] = "half_open"
+                record["trial_started"] = None
+            if record["state"] == "half_open":
+                trial_started = record["trial_started"]
+                if trial_started and now - trial_started < MODEL_HALF_OPEN_TRIAL_SECONDS:
+                    notes.append(f"Skipping {model_name}: half-open trial already in progress")
+                    continue
+                notes.append(f"Offering {model_name} as a half-open trial")
+            stats = _model_stats(record)
+            p50 = stats["latency_p50"]
+            ranked.append(((round(stats["error_rate"], 1), round(p50 / 5) if p50 else 0, preference), model_name))
+
+    if not ranked:
+        notes.append("All candidate models have open circuits - trying them in preference order anyway")
+        return list(model_names), notes
+    ordered = [name for _, name in sorted(ranked)]
+    if ordered != [m for m in model_names if m in ordered]:
+        notes.append(f"Health-ranked order: {', '.join(ordered)}")
+    return ordered, notes
+
+
+def begin_model_call(model_name):
+    """Claim the half-open trial just before calling a model; False if another call holds it."""
+    now = time.time()
+    with _model_health_lock:
+        record = _health_record(model_name)
+        if record["state"] != "half_open":
+            return True
+        trial_started = record["trial_started"]
+        if trial_started and now - trial_started < MODEL_HALF_OPEN_TRIAL_SECONDS:
+            return False
+        record["trial_started"] = now
+        return True
+
+
+def model_health_snapshot():
+    with _model_health_lock:
+        return {
+            name: dict(
+                _model_stats(record),
+                state=record["state"],
+                consecutive_failures=record["consecutive_failures"],
+                opened_at=record["opened_at"],
+                last_error=record["last_error"]
+            )
+            for name, record in _model_health.items()
+        }
+
+
+# --- PROMPT BUDGET ---
+# Character limits per doc_type are the starting point; once a model has enough latency
+# history its text budget is re-derived from token estimates so prompts are as large as
+# that model reliably answers within the latency target (and smaller for slow models).
+PROMPT_CHARS_PER_TOKEN = float(os.environ.get('PROMPT_CHARS_PER_TOKEN', 4))
+ADAPTIVE_PROMPT_BUDGET = env_flag('ADAPTIVE_PROMPT_BUDGET', True)
+PROMPT_BUDGET_MAX_GROWTH = float(os.environ.get('PROMPT_BUDGET_MAX_GROWTH', 2))
+PROMPT_BUDGET_MIN_SAMPLES = 5
+# Half of each doc_type's request timeout, leaving room for the retry path
+PROMPT_LATENCY_TARGET_SECONDS = {"engineering": 30, "transmittal": 15}
+
+_template_tokens = {}
+
+
+def estimate_tokens(text):
+    """Rough token count for Gemini prompts (no API round trip)."""
+    return int(len(text) / PROMPT_CHARS_PER_TOKEN) + 1
+
+
+def template_tokens(doc_type):
+    """Tokens used by a doc_type's prompt template without any document text."""
+    if doc_type not in _template_tokens:
+        _template_tokens[doc_type] = estimate_tokens(build_prompt("", doc_type))
+    return _template_tokens[doc_type]
+
+
+def model_prompt_char_budget(model_name, doc_type):
+    """Characters of document text to send to model_name; returns (limit, note for the action log).
+
+    Falls back to prompt_char_budget() until the model has latency history, and never goes
+    below the short (timeout) limit or above PROMPT_BUDGET_MAX_GROWTH times the default.
+    """
+    default = prompt_char_budget(doc_type)
+    if not default or not ADAPTIVE_PROMPT_BUDGET:
+        return default, None
+    target = PROMPT_LATENCY_TARGET_SECONDS.get(doc_type, 30)
+    largest_tokens = largest_payload_within(model_name, target)
+    if largest_tokens is None:
+        return default, None
+    floor = min(default, ENGINEERING_PROMPT_LIMIT_SHORT)
+    ceiling = int(default * PROMPT_BUDGET_MAX_GROWTH)
+    chars = int((largest_tokens - template_tokens(doc_type)) * PROMPT_CHARS_PER_TOKEN)
+    chars = max(floor, min(ceiling, chars))
+    return chars, (
+        f"Prompt budget for {model_name}: ~{largest_tokens} tokens fit the {target}s latency target "
+        f"-> {chars} characters of text (default {default})"
+    )
 
-def build_prompt(text, doc_type):
-    """Build a prompt tailored to the selected department."""
+
+# --- RESPONSE PARSING ---
+# Gemini sometimes wraps its JSON in code fences or prose, or stops mid-array when it hits
+# the output limit. Salvaging what is there is far cheaper than another full model call.
+_json_decoder = json.JSONDecoder()
+
+
+def _scan_json(text, start):
+    """Walk text from the opening bracket at start, tracking strings and nesting.
+
+    Returns (end, cut_points): end is the index just past the matching close bracket (None if
+    the value is truncated), cut_points lists (index, open_brackets) after every close bracket.
+    """
+    stack = []
+    cut_points = []
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "[{":
+            stack.append(char)
+        elif char in "]}":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                return index + 1, cut_points
+            cut_points.append((index + 1, "".join(stack)))
+    return None, cut_points
+
+
+def parse_model_json(text):
+    """Parse the JSON value in a model response, tolerating fences, prose and truncation.
+
+    Returns (parsed, repair_note, partial); repair_note is None when the response was well-formed
+    JSON, and partial is True when a truncated response was cut back, so rows may be missing.
+    Raises json.JSONDecodeError when nothing usable can be recovered.
+    """
+    clean = text.replace("```json", "").replace("```", "").strip()
+    try:
+        return json.loads(clean), None, False
+    except json.JSONDecodeError as e:
+        first_error = e
+
+    starts = [i for i in (clean.find("["), clean.find("{")) if i >= 0]
+    if not starts:
+        raise first_error
+    start = min(starts)
+    end, cut_points = _scan_json(clean, start)
+    if end is not None:
+        # Complete value surrounded by prose
+        return json.loads(clean[start:end]), "Ignored text around the JSON response", False
+
+    # Truncated: close the brackets left open at the last point where a value completed
+    closers = {"[": "]", "{": "}"}
+    for cut, open_brackets in reversed(cut_points[-200:]):
+        candidate = clean[start:cut] + "".join(closers[b] for b in reversed(open_brackets))
+        try:
+            return json.loads(candidate), f"Response was truncated - kept the first {cut - start} of {len(clean) - start} characters", True
+        except json.JSONDecodeError:
+            continue
+    raise first_error
+
+
+def response_was_partial(attempt_log):
+    """True when any attempt in the log kept a truncated response (see parse_model_json)."""
+    return any(attempt.get("partial") for attempt in attempt_log or [])
+
+
+def iter_json_array_items(fragments):
+    """Yield each element of a top-level JSON array as soon as it is complete.
+
+    fragments is an iterable of text pieces (e.g. streamed response chunks). Elements must be
+    objects or arrays, which is what every extraction prompt asks for; anything before the
+    opening bracket (code fences, prose) is skipped. Stops at the closing bracket.
+    """
+    buffer = ""
+    position = 0
+    depth = 0
+    element_start = None
+    in_string = False
+    escaped = False
+    for fragment in fragments:
+        buffer += fragment
+        while position < len(buffer):
+            char = buffer[position]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif depth == 0:
+                if char == "{":
+                    return  # A single object, not an array of rows
+                if char == "[":
+                    depth = 1
+            elif char == '"':
+                in_string = True
+            elif char in "[{":
+                depth += 1
+                if depth == 2:
+                    element_start = position
+            elif char in "]}":
+                depth -= 1
+                if depth == 0:
+                    return
+                if depth == 1 and element_start is not None:
+                    yield json.loads(buffer[element_start:position + 1])
+                    # Drop consumed text so long streams stay cheap to scan
+                    buffer = buffer[position + 1:]
+                    position = -1
+                    element_start = None
+            position += 1
+
+
+# Transmittal categories in prompt order: the key's description, and its two extraction rules
+TRANSMITTAL_CATEGORIES = OrderedDict([
+    ("DrawingRegister", """"DrawingRegister" - Basic drawing metadata (always extract):
+           - "DwgNo": Drawing number (e.g., S-001, S-100, S-101)
+           - "Rev": Revision (e.g., A, 0, C)
+           - "Title": Drawing title (e.g., "GENERAL NOTES", "FOUNDATION PLAN")
+           - "Scale": Scale (e.g., "1:100", "N.T.S")"""),
+    ("Standards", """"Standards" - Array of standards referenced:
+           - "Standard": Standard name (e.g., "AS 4100", "AS 3600", "AS/NZS 1170.1")
+           - "Clause": Clause/section numbers (e.g., "Cl. 9.2, 13.4")
+           - "Applicability": What it applies to (e.g., "Structural Steel Design")"""),
+    ("Materials", """"Materials" - Array of material specifications:
+           - "MaterialType": Type (e.g., "Concrete", "Steel Grade", "Bolts", "Grout")
+           - "GradeSpec": Specification (e.g., "32 MPa", "300PLUS", "M24 Grade 8.8")
+           - "Applications": Where used (e.g., "Slabs Zones A1/A2", "Columns C1-C2")"""),
+    ("Connections", """"Connections" - Array of connection details:
+           - "DetailMark": Connection mark (e.g., "CBP-01", "BCC-2", "BR-3")
+           - "ConnectionType": Type description
+           - "BoltSpec": Bolt specifications
+           - "PlateSpec": Plate/member specifications
+           - "WeldTorque": Weld or torque requirements
+           - "DrawingRef": Reference to detail drawing"""),
+    ("Assumptions", """"Assumptions" - Array of design assumptions:
+           - "Assumption": What is assumed (e.g., "Foundation bearing capacity")
+           - "Value": The value (e.g., "250 kPa minimum")
+           - "Location": Where it applies (e.g., "All footings", "Zones B1/B2")
+           - "Critical": Criticality level (e.g., "CRITICAL", "HIGH")
+           - "VerificationMethod": How to verify"""),
+    ("VOSFlags", """"VOSFlags" - Array of "Verify on Site" items:
+           - "FlagID": Identifier (e.g., "V.O.S.-01")
+           - "Item": What needs verification
+           - "Issue": The issue or requirement
+           - "ActionRequired": What action is needed
+           - "ResponsibleParty": Who is responsible"""),
+    ("CrossReferences", """"CrossReferences" - Array of cross-references:
+           - "Reference": The reference text (e.g., "See Detail D1/S-500")
+           - "ReferencedIn": Which drawing contains the reference
+           - "RefersTo": What it refers to (e.g., "Detail D1 on S-500")"""),
+])
+TRANSMITTAL_CATEGORY_RULES = {
+    "Standards": ("Extract ALL standards mentioned (AS, AS/NZS, NCC codes)", "For standards: Look in notes, specifications, detail callouts"),
+    "Materials": ("Extract ALL material grades and specifications", "For materials: Extract from schedules, notes, detail specifications"),
+    "Connections": ("Extract ALL connection detail marks and their specs", "For connections: Extract from detail marks, connection tables, specifications"),
+    "Assumptions": ("Extract ALL design assumptions, bearing capacities, slab thicknesses, grid spacing, FRL requirements", "For assumptions: Extract from notes, plan annotations, general notes"),
+    "VOSFlags": ("Extract ALL \"V.O.S.\", \"Verify on Site\", \"Check\", or similar flags", "For VOS: Look for explicit \"V.O.S.\", \"Verify\", \"Check on site\" text"),
+    "CrossReferences": ("Extract ALL \"See Detail\", \"Ref:\", \"Refer to\" cross-references", "For cross-refs: Extract all \"See Detail X\", \"Ref: Detail Y\", \"Refer to Z\" mentions"),
+}
+
+
+def build_prompt(text, doc_type, include_register=True, categories=None):
+    """Build a prompt tailored to the selected department.
+
+    include_register=False leaves the DrawingRegister out of the transmittal prompt (it was
+    already read reliably from the title block); categories limits a transmittal prompt to
+    those keys.
+    """
     if doc_type == "engineering":
         return f"""
         You are a structural engineering assistant extracting data from a structural schedule PDF.
@@ -242,73 +1036,42 @@ def build_prompt(text, doc_type):
         TEXT: {text}
         """
     if doc_type == "transmittal":
+        categories = list(categories or TRANSMITTAL_CATEGORIES)
+        sections = []
+        for number, key in enumerate(categories, 1):
+            if key == "DrawingRegister" and not include_register:
+                sections.append(f'{number}. "DrawingRegister" - Already extracted from the title block. Do NOT return this key.')
+            else:
+                sections.append(f"{number}. {TRANSMITTAL_CATEGORIES[key]}")
+        key_count = len([key for key in categories if include_register or key != "DrawingRegister"])
+        rules = [TRANSMITTAL_CATEGORY_RULES[key][0] for key in categories if key in TRANSMITTAL_CATEGORY_RULES]
+        rules += [TRANSMITTAL_CATEGORY_RULES[key][1] for key in categories if key in TRANSMITTAL_CATEGORY_RULES]
+        rules_section = "EXTRACTION RULES:\n        " + "\n        ".join(f"- {rule}" for rule in rules) + "\n        \n        " if rules else ""
+        section_text = "\n        \n        ".join(sections)
         return f"""
         You are an advanced structural engineering document analyzer extracting comprehensive structured data from drawing PDFs.
         
         Extract data into these categories and return a JSON object with these keys:
         
-        1. "DrawingRegister" - Basic drawing metadata (always extract):
-           - "DwgNo": Drawing number (e.g., S-001, S-100, S-101)
-           - "Rev": Revision (e.g., A, 0, C)
-           - "Title": Drawing title (e.g., "GENERAL NOTES", "FOUNDATION PLAN")
-           - "Scale": Scale (e.g., "1:100", "N.T.S")
-        
-        2. "Standards" - Array of standards referenced:
-           - "Standard": Standard name (e.g., "AS 4100", "AS 3600", "AS/NZS 1170.1")
-           - "Clause": Clause/section numbers (e.g., "Cl. 9.2, 13.4")
-           - "Applicability": What it applies to (e.g., "Structural Steel Design")
-        
-        3. "Materials" - Array of material specifications:
-           - "MaterialType": Type (e.g., "Concrete", "Steel Grade", "Bolts", "Grout")
-           - "GradeSpec": Specification (e.g., "32 MPa", "300PLUS", "M24 Grade 8.8")
-           - "Applications": Where used (e.g., "Slabs Zones A1/A2", "Columns C1-C2")
-        
-        4. "Connections" - Array of connection details:
-           - "DetailMark": Connection mark (e.g., "CBP-01", "BCC-2", "BR-3")
-           - "ConnectionType": Type description
-           - "BoltSpec": Bolt specifications
-           - "PlateSpec": Plate/member specifications
-           - "WeldTorque": Weld or torque requirements
-           - "DrawingRef": Reference to detail drawing
-        
-        5. "Assumptions" - Array of design assumptions:
-           - "Assumption": What is assumed (e.g., "Foundation bearing capacity")
-           - "Value": The value (e.g., "250 kPa minimum")
-           - "Location": Where it applies (e.g., "All footings", "Zones B1/B2")
-           - "Critical": Criticality level (e.g., "CRITICAL", "HIGH")
-           - "VerificationMethod": How to verify
-        
-        6. "VOSFlags" - Array of "Verify on Site" items:
-           - "FlagID": Identifier (e.g., "V.O.S.-01")
-           - "Item": What needs verification
-           - "Issue": The issue or requirement
-           - "ActionRequired": What action is needed
-           - "ResponsibleParty": Who is responsible
+        {section_text}
         
-        7. "CrossReferences" - Array of cross-references:
-           - "Reference": The reference text (e.g., "See Detail D1/S-500")
-           - "ReferencedIn": Which drawing contains the reference
-           - "RefersTo": What it refers to (e.g., "Detail D1 on S-500")
-        
-        EXTRACTION RULES:
-        - Extract ALL standards mentioned (AS, AS/NZS, NCC codes)
-        - Extract ALL material grades and specifications
-        - Extract ALL connection detail marks and their specs
-        - Extract ALL design assumptions, bearing capacities, slab thicknesses, grid spacing, FRL requirements
-        - Extract ALL "V.O.S.", "Verify on Site", "Check", or similar flags
-        - Extract ALL "See Detail", "Ref:", "Refer to" cross-references
-        - For standards: Look in notes, specifications, detail callouts
-        - For materials: Extract from schedules, notes, detail specifications
-        - For connections: Extract from detail marks, connection tables, specifications
-        - For assumptions: Extract from notes, plan annotations, general notes
-        - For VOS: Look for explicit "V.O.S.", "Verify", "Check on site" text
-        - For cross-refs: Extract all "See Detail X", "Ref: Detail Y", "Refer to Z" mentions
-        
-        Return a JSON object with all 7 keys. Use empty arrays [] if a category has no data.
+        {rules_section}Return a JSON object with all {key_count} keys. Use empty arrays [] if a category has no data.
         Return ONLY valid JSON (no markdown, no explanation, no code blocks).
 
         TEXT: {text}
         """
+    if doc_type == "finance_batch":
+        return f"""
+    Extract specific fields from EACH invoice below. Every invoice starts with a line like
+    "=== DOCUMENT 3 ===" and ends with "=== END DOCUMENT 3 ===".
+    Fields: Vendor, Date (YYYY-MM-DD), InvoiceNum, Cost (pre-tax amount), GST (tax component, use "N/A" if not listed), FinalAmount (total payable), Summary (3-5 words).
+    Return ONLY a JSON array with exactly one object per document, in document order.
+    Keys: "DocumentId" (the number from the document's header, as a string), "Vendor", "Date", "InvoiceNum", "Cost", "GST", "FinalAmount", "Summary".
+    Never mix values between documents. Use "N/A" for missing fields.
+
+    DOCUMENTS:
+    {text}
+    """
     return f"""
     Extract specific fields from this invoice text as JSON.
     Fields: Vendor, Date (YYYY-MM-DD), InvoiceNum, Cost (pre-tax amount), GST (tax component, use "N/A" if not listed), FinalAmount (total payable), Summary (3-5 words).
@@ -319,6 +1082,747 @@ def build_prompt(text, doc_type):
     """
 
 
+# --- CONCURRENCY ---
+# Files in one request are extracted in parallel; the global cap bounds Gemini calls across
+# all concurrent requests handled by this worker process. The slot is taken around each model
+# call (not each file), so nested pools (chunks, hedge lanes, transmittal categories, finance
+# batches, re-asks) are all counted.
+EXTRACTION_MAX_WORKERS_PER_REQUEST = int(os.environ.get('EXTRACTION_MAX_WORKERS_PER_REQUEST', 4))
+EXTRACTION_GLOBAL_CONCURRENCY = int(os.environ.get('EXTRACTION_GLOBAL_CONCURRENCY', 8))
+_extraction_slots = threading.BoundedSemaphore(EXTRACTION_GLOBAL_CONCURRENCY)
+
+# --- EXTRACTION CACHE ---
+# Results are keyed on (SHA-256 of the PDF bytes, doc_type, prompt template version, model)
+# so the bundled samples never hit pdfplumber or Gemini twice. A small in-process LRU sits
+# in front of a size-bounded SQLite file shared by all workers.
+PROMPT_TEMPLATE_VERSION = "2"  # Bump when extraction behaviour changes without a prompt text change
+EXTRACTION_CACHE_ENABLED = env_flag('EXTRACTION_CACHE_ENABLED', True)
+EXTRACTION_CACHE_PATH = os.environ.get('EXTRACTION_CACHE_PATH', os.path.join(DATA_DIR, 'extraction_cache.sqlite3'))
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+EXTRACTION_CACHE_MEMORY_ITEMS = int(os.environ.get('EXTRACTION_CACHE_MEMORY_ITEMS', 64))
+
+_extraction_cache_memory = OrderedDict()
+_extraction_cache_lock = threading.Lock()
+_extraction_cache_ready = False
+
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prompt_template_version(doc_type):
+    """Version tag for a doc_type's prompt; changes automatically when the template text changes."""
+    template_hash = hashlib.sha256(build_prompt("", doc_type).encode('utf-8')).hexdigest()[:12]
+    return f"{PROMPT_TEMPLATE_VERSION}:{template_hash}"
+
+
+def extraction_cache_key(file_hash, doc_type, model_name):
+    raw = "|".join([file_hash, doc_type, prompt_template_version(doc_type), model_name])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _init_extraction_cache(conn):
+    global _extraction_cache_ready
+    if _extraction_cache_ready:
+        return
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS extraction_cache (
+            key TEXT PRIMARY KEY,
+            file_hash TEXT NOT NULL,
+            doc_type TEXT NOT NULL,
+            model TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_extraction_cache_access ON extraction_cache (last_access)")
+    conn.commit()
+    _extraction_cache_ready = True
+
+
+def _remember_in_memory(key, payload):
+    with _extraction_cache_lock:
+        _extraction_cache_memory[key] = payload
+        _extraction_cache_memory.move_to_end(key)
+        while len(_extraction_cache_memory) > EXTRACTION_CACHE_MEMORY_ITEMS:
+            _extraction_cache_memory.popitem(last=False)
+
+
+def get_cached_extraction(file_hash, doc_type, model_names):
+    """Look up a cached result for any candidate model (in preference order).
+
+    Returns a dict with entries, schedule_type, model, created_at and tier, or None on a miss.
+    """
+    if not EXTRACTION_CACHE_ENABLED:
+        return None
+    keys = [(extraction_cache_key(file_hash, doc_type, m), m) for m in model_names]
+
+    with _extraction_cache_lock:
+        for key, model_name in keys:
+            payload = _extraction_cache_memory.get(key)
+            if payload is not None:
+                _extraction_cache_memory.move_to_end(key)
+                record = json.loads(payload)
+                record["tier"] = "memory"
+                return record
+
+    try:
+        conn = open_sqlite(EXTRACTION_CACHE_PATH)
+        try:
+            _init_extraction_cache(conn)
+            for key, model_name in keys:
+                row = conn.execute("SELECT payload FROM extraction_cache WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                conn.execute("UPDATE extraction_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+                _remember_in_memory(key, row["payload"])
+                record = json.loads(row["payload"])
+                record["tier"] = "disk"
+                return record
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Extraction cache read error: {type(e).__name__}: {e}")
+    return None
+
+
+def store_cached_extraction(file_hash, doc_type, model_name, entries, schedule_type):
+    """Persist a successful extraction and evict least-recently-used rows beyond the size limit."""
+    if not EXTRACTION_CACHE_ENABLED or not model_name:
+        return
+    key = extraction_cache_key(file_hash, doc_type, model_name)
+    now = time.time()
+    payload = json.dumps({
+        "entries": entries,
+        "schedule_type": schedule_type,
+        "model": model_name,
+        "created_at": now
+    })
+    _remember_in_memory(key, payload)
+
+    try:
+        conn = open_sqlite(EXTRACTION_CACHE_PATH)
+        try:
+            _init_extraction_cache(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache "
+                "(key, file_hash, doc_type, model, payload, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, file_hash, doc_type, model_name, payload, len(payload), now, now)
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM extraction_cache").fetchone()[0]
+            if total > EXTRACTION_CACHE_MAX_BYTES:
+                evicted = 0
+                for row in conn.execute("SELECT key, size FROM extraction_cache ORDER BY last_access ASC").fetchall():
+                    if total <= EXTRACTION_CACHE_MAX_BYTES:
+                        break
+                    conn.execute("DELETE FROM extraction_cache WHERE key = ?", (row["key"],))
+                    total -= row["size"]
+                    evicted += 1
+                print(f"Extraction cache: evicted {evicted} entr{'y' if evicted == 1 else 'ies'} (size limit {EXTRACTION_CACHE_MAX_BYTES} bytes)")
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Extraction cache write error: {type(e).__name__}: {e}")
+
+
+# --- SCHEDULE TABLES ---
+# Beam/column schedules are real tables in the CAD/Revit PDFs. When pdfplumber's table finder
+# returns a header matching ENGINEERING_BEAM_FIELDS or ENGINEERING_COLUMN_FIELDS the rows are
+# built locally with no LLM call; otherwise the tables are sent to Gemini as compact JSON rows
+# ahead of the flattened text, so most rows fit inside the prompt budget.
+ENGINEERING_TABLE_EXTRACTION = env_flag('ENGINEERING_TABLE_EXTRACTION', True)
+LOCAL_TABLE_PARSER = "local-table-parser"
+SCHEDULE_HEADER_ALIASES = {
+    "MARK": "Mark",
+    "MEMBER SIZE": "Size",
+    "SIZE": "Size",
+    "SECTION SIZE": "Size",
+    "QTY": "Qty",
+    "QUANTITY": "Qty",
+    "LENGTH": "Length",
+    "LENGTHS": "Length",
+    "GRADE": "Grade",
+    "PAINT SYSTEM": "PaintSystem",
+    "PAINT": "PaintSystem",
+    "SECTION TYPE": "SectionType",
+    "TYPE": "SectionType",
+    "BASE PLATE": "BasePlate",
+    "CAP PLATE": "CapPlate",
+    "FINISH": "Finish",
+    "COMMENTS": "Comments",
+    "REMARKS": "Comments",
+    "NOTES": "Comments"
+}
+
+
+def map_schedule_header(row):
+    """Map a table row to schedule field names.
+
+    Returns (fields, units): fields has one entry per column (None for unknown columns) and
+    units maps a field to the unit given in its header, e.g. "LENGTH (mm)" -> {"Length": "mm"}.
+    """
+    fields = []
+    units = {}
+    for cell in row:
+        header = (cell or "").upper()
+        unit_match = re.search(r"\(([A-Z]+)\)", header)
+        name = re.sub(r"\([^)]*\)", "", header).strip()
+        field = SCHEDULE_HEADER_ALIASES.get(name)
+        fields.append(field)
+        if field and unit_match:
+            units[field] = unit_match.group(1).lower()
+    return fields, units
+
+
+def _schedule_value(value, field, units):
+    if not value:
+        return "N/A"
+    unit = units.get(field)
+    # "8500" under "LENGTH (mm)" -> "8500 mm", matching the units the prompt asks for
+    if field == "Length" and unit and value[-1].isdigit():
+        return f"{value} {unit}"
+    return value
+
+
+def parse_schedule_tables(tables):
+    """Build schedule rows from tables whose headers cover a full beam or column field set.
+
+    Returns (entries, schedule_type), or (None, None) when the tables are not well-formed
+    enough to skip the LLM.
+    """
+    entries = {}
+    schedule_types = set()
+    for table in tables:
+        if len(table) < 2:
+            continue
+        fields, units = map_schedule_header(table[0])
+        mapped = {f for f in fields if f}
+        if "Mark" not in mapped:
+            continue
+        if mapped >= set(ENGINEERING_COLUMN_FIELDS):
+            schedule_type, expected = "column", ENGINEERING_COLUMN_FIELDS
+        elif mapped >= set(ENGINEERING_BEAM_FIELDS):
+            schedule_type, expected = "beam", ENGINEERING_BEAM_FIELDS
+        else:
+            return None, None
+        schedule_types.add(schedule_type)
+        for row in table[1:]:
+            values = {}
+            for field, cell in zip(fields, row):
+                if field and field not in values:
+                    values[field] = _schedule_value(cell, field, units)
+            mark = values.get("Mark")
+            if not mark or mark == "N/A":
+                continue
+            entry = {field: values.get(field, "N/A") for field in expected}
+            existing = entries.get(mark)
+            if existing is None:
+                entries[mark] = entry
+            elif entry["Length"] not in existing["Length"].split(", "):
+                # One object per unique mark; combine differing lengths
+                existing["Length"] = f"{existing['Length']}, {entry['Length']}"
+
+    if not entries or len(schedule_types) != 1:
+        return None, None
+    return list(entries.values()), schedule_types.pop()
+
+
+def format_tables_for_prompt(tables):
+    """Compact JSON rendering of schedule-like tables (header row first) for the prompt."""
+    lines = []
+    for table in tables:
+        if len(table) < 2:
+            continue
+        fields, _ = map_schedule_header(table[0])
+        if "Mark" not in fields or sum(1 for f in fields if f) < 3:
+            continue
+        # One row per line so long schedules can be chunked on row boundaries
+        lines.extend(json.dumps(row, ensure_ascii=False, separators=(",", ":")) for row in table if any(row))
+    if not lines:
+        return ""
+    return "SCHEDULE TABLES (JSON rows, first row of each table is the header):\n" + "\n".join(lines) + "\n"
+
+
+# --- DRAWING REGISTER RULES ---
+# Title blocks put DwgNo, Rev, Title and Scale in predictable places, so the register is read
+# locally with a few patterns. When all four are found and pass register_is_reliable(), the
+# transmittal prompt leaves the register out and Gemini only extracts the narrative
+# categories; otherwise Gemini is asked for it and the local values only fill its blanks.
+DRAWING_REGISTER_RULES = env_flag('DRAWING_REGISTER_RULES', True)
+DRAWING_NUMBER_PATTERN = r"[A-Z]{1,3}-\d{3}[A-Z]?"
+REGISTER_FIELDS = ["DwgNo", "Rev", "Title", "Scale"]
+
+
+def extract_drawing_register(text):
+    """Read DwgNo, Rev, Title and Scale from a drawing's title block text.
+
+    Returns a dict with the fields that were found (missing ones are left out).
+    """
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    register = {}
+
+    # Drawing number: a line holding only the number (CAD title blocks), else the file name
+    for line in lines:
+        if re.fullmatch(DRAWING_NUMBER_PATTERN, line):
+            register["DwgNo"] = line
+    if "DwgNo" not in register:
+        match = re.search(rf"DRAWING\s+No\.?\s*:?\s*({DRAWING_NUMBER_PATTERN})\b", text, re.IGNORECASE)
+        match = match or re.search(rf"[\\/]({DRAWING_NUMBER_PATTERN})[_ .-]", text)
+        if match:
+            register["DwgNo"] = match.group(1)
+
+    # Revision: the single letter/number under "DRAWING No.", else the last revision history entry
+    for index, line in enumerate(lines[:-1]):
+        if line.upper().endswith("DRAWING NO.") and re.fullmatch(r"[A-Z0-9]{1,2}", lines[index + 1]):
+            register["Rev"] = lines[index + 1]
+    if "Rev" not in register:
+        match = re.search(r"\bREV(?:ISION)?\.?\s*:\s*([A-Z0-9]{1,2})\b", text)
+        if match:
+            register["Rev"] = match.group(1)
+    if "Rev" not in register:
+        history = next((i for i, line in enumerate(lines) if line.upper().startswith("REV DESCRIPTION")), None)
+        if history is not None:
+            entries = [m.group(1) for line in lines[history + 1:] for m in [re.match(r"([A-Z0-9]{1,2}) \S", line)] if m]
+            if entries:
+                register["Rev"] = entries[-1]
+
+    match = re.search(r"DRAWING TITLE\s+(.+)", text)
+    if match:
+        register["Title"] = match.group(1).strip()
+    else:
+        # Split label: "DRAWING" / "PROJECT <PROJECT NAME> <Drawing Title>" / "TITLE"
+        for index, line in enumerate(lines[:-2]):
+            if line == "DRAWING" and lines[index + 2] == "TITLE":
+                match = re.match(r"PROJECT\s+(?:[A-Z0-9&'/-]+\s+)+?([A-Z0-9][^A-Z\s].*)", lines[index + 1])
+                if match:
+                    register["Title"] = match.group(1).strip()
+
+    match = re.search(r"\bSCALE\s*:?\s*(1\s*:\s*\d+(?:\s*\((?:varies|VARIES)\))?|N\.?\s*T\.?\s*S\.?|AS SHOWN)", text, re.IGNORECASE)
+    if match:
+        register["Scale"] = re.sub(r"\s*:\s*", ":", match.group(1).strip())
+    return register
+
+
+# --- INVOICE PRE-PARSER ---
+# Most supplier invoices label their totals ("Subtotal", "GST", "TOTAL") and print an ABN, a
+# date and an invoice number in the header, so they are read locally with anchored patterns.
+# Each field gets a confidence; Gemini is only called when a required field is missing, the
+# amounts do not add up, the weakest field is below INVOICE_PREPARSE_MIN_CONFIDENCE, or
+# nothing corroborates the reading (neither an ABN nor a printed subtotal and GST that sum
+# to the total).
+INVOICE_PREPARSE = env_flag('INVOICE_PREPARSE', True)
+INVOICE_PREPARSE_MIN_CONFIDENCE = float(os.environ.get('INVOICE_PREPARSE_MIN_CONFIDENCE', 0.8))
+LOCAL_INVOICE_PARSER = "local-invoice-parser"
+INVOICE_REQUIRED_FIELDS = ["Vendor", "Date", "FinalAmount"]
+ABN_PATTERN = r"\bABN\s*:?\s*\d{2}\s?\d{3}\s?\d{3}\s?\d{3}\b"
+AMOUNT_PATTERN = r"\$?\s*(\d{1,3}(?:,\d{3})+\.\d{2}|\d+\.\d{2})"
+INVOICE_DOCUMENT_WORDS = r"\s+(?:TAX\s+INVOICE|INVOICE|RECEIPT|STATEMENT)\s*$"
+VENDOR_SUFFIX_PATTERN = r"\b(?:PTY\.?\s+LTD\.?|LTD\.?|LIMITED|INC\.?|LLC|CORP\.?|GROUP)$|\.(?:io|com|com\.au|net|co)$"
+# Total lines, most specific first. "Total ex GST" is the subtotal and "Total GST" the tax, so
+# neither is ever read as the amount payable
+INVOICE_TOTAL_LABELS = [
+    r"(?:TOTAL\s+(?:INC\.?|INCL\.?|INCLUDING)\s*GST|(?:TOTAL\s+)?AMOUNT\s+(?:DUE|PAID|PAYABLE)|TOTAL\s+(?:DUE|PAYABLE)|BALANCE\s+DUE)",
+    r"TOTAL(?!\s*(?:EX|EXCL|EXCLUDING)\b)(?!\s+(?:GST|TAX)\b)",
+]
+INVOICE_SUBTOTAL_LABEL = r"(?:SUB\s*-?\s*TOTAL|TOTAL\s+(?:EX|EXCL|EXCLUDING)\b\.?\s*GST)"
+INVOICE_GST_LABEL = r"(?:TOTAL\s+)?(?:GST|TAX)"
+TOTAL_LINE_PATTERN = r"^\s*(?:SUB\s*-?\s*TOTAL|TOTAL|GST|TAX|AMOUNT|BALANCE|EFTPOS|CASH|CHANGE|PAID)\b"
+MONTH_NUMBERS = {
+    name: number
+    for number, names in enumerate([
+        ("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"),
+        ("may",), ("jun", "june"), ("jul", "july"), ("aug", "august"),
+        ("sep", "sept", "september"), ("oct", "october"), ("nov", "november"), ("dec", "december")
+    ], start=1)
+    for name in names
+}
+
+
+def _invoice_amount(value):
+    """'$2,277.00' -> '2277.00' (the plain number format_currency expects)."""
+    return f"{float(value.replace(',', '')):.2f}"
+
+
+def _iso_date(year, month, day):
+    """YYYY-MM-DD for a valid calendar date, else None."""
+    try:
+        return datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+def _invoice_date(text):
+    """Return (YYYY-MM-DD, confidence) for the invoice date, or (None, 0)."""
+    labelled = r"(?:INVOICE\s+DATE|DATE(?:\s+ISSUED)?|ISSUED)\s*:?\s*"
+    patterns = [
+        (labelled + r"(\d{1,2})\s+([A-Za-z]{3,9})\.?,?\s+(\d{4})", "dmy", 0.95),
+        (labelled + r"(\d{1,2})/(\d{1,2})/(\d{4})", "dmy", 0.95),
+        (labelled + r"(\d{4})-(\d{2})-(\d{2})", "ymd", 0.95),
+        (r"\b(\d{1,2})\s+([A-Za-z]{3,9})\.?,?\s+(\d{4})\b", "dmy", 0.85),
+        (r"\b([A-Za-z]{3,9})\.?\s+(\d{1,2}),?\s+(\d{4})\b", "mdy", 0.85),
+        (r"\b(\d{4})-(\d{2})-(\d{2})\b", "ymd", 0.85),
+        (r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b", "dmy", 0.85),  # Australian day/month order
+    ]
+    for pattern, order, confidence in patterns:
+        for match in re.finditer(pattern, text, re.IGNORECASE):
+            parts = dict(zip(order, match.groups()))
+            month = parts["m"]
+            if not month.isdigit():
+                month = MONTH_NUMBERS.get(month.lower())
+            date = _iso_date(parts["y"], month, parts["d"])
+            if date:
+                return date, confidence
+    return None, 0
+
+
+def _labelled_amount(text, label):
+    """Amount on the line starting with label (or on the next line); returns (value, confidence)."""
+    match = re.search(rf"^\s*{label}\b[^\n\d$]*(?:\(\d+(?:\.\d+)?%\)[^\n\d$]*)?{AMOUNT_PATTERN}", text, re.IGNORECASE | re.MULTILINE)
+    if match:
+        return _invoice_amount(match.group(1)), 0.95
+    match = re.search(rf"^\s*{label}\s*:?\s*\n{AMOUNT_PATTERN}", text, re.IGNORECASE | re.MULTILINE)
+    if match:
+        return _invoice_amount(match.group(1)), 0.85
+    return None, 0
+
+
+def parse_invoice_locally(text):
+    """Read an invoice's fields from its text without an LLM call.
+
+    Returns (entry, confidences, score): entry uses the FINANCE_FIELDS keys with "N/A" for
+    fields that were not found, confidences maps each found field to 0-1, and score is the
+    confidence of the weakest required field. The score is 0 if a required field is missing,
+    the amounts are inconsistent (a printed subtotal + GST != total, or Cost/GST above the
+    total), the entry fails finance validation, or nothing corroborates the reading: neither
+    an ABN nor a printed subtotal and GST that add up to the total. A Cost derived as total
+    less GST never counts as corroboration.
+    """
+    lines = [" ".join(line.split()) for line in text.splitlines() if line.strip()]
+    entry = {field: "N/A" for field in FINANCE_FIELDS}
+    confidences = {}
+    if not lines:
+        return entry, confidences, 0
+    has_abn = bool(re.search(ABN_PATTERN, text, re.IGNORECASE))
+
+    # Vendor: the letterhead, i.e. the first line, without a trailing "TAX INVOICE"/"RECEIPT"
+    vendor = re.sub(INVOICE_DOCUMENT_WORDS, "", lines[0], flags=re.IGNORECASE).strip()
+    if vendor and not re.search(r"\d", vendor):
+        entry["Vendor"] = vendor
+        if re.search(VENDOR_SUFFIX_PATTERN, vendor, re.IGNORECASE):
+            confidences["Vendor"] = 0.95
+        else:
+            # A bare heading is only trusted as the trader's name when an ABN is printed too
+            confidences["Vendor"] = 0.85 if has_abn and vendor.isupper() else 0.6
+
+    date, confidence = _invoice_date(text)
+    if date:
+        entry["Date"], confidences["Date"] = date, confidence
+
+    match = re.search(r"\b(?:INVOICE|INV|RECEIPT|BILL)\s*(?:#|NO\.?|NUMBER)\s*:?\s*([A-Z0-9][A-Z0-9/-]*\d[A-Z0-9/-]*)", text, re.IGNORECASE)
+    if match:
+        entry["InvoiceNum"], confidences["InvoiceNum"] = match.group(1), 0.95
+    else:
+        match = re.search(r"^#\s*([A-Z0-9][A-Z0-9-]*\d[A-Z0-9-]*)$", text, re.IGNORECASE | re.MULTILINE)
+        if match:
+            entry["InvoiceNum"], confidences["InvoiceNum"] = match.group(1), 0.85
+
+    final = None
+    for label in INVOICE_TOTAL_LABELS:
+        final, confidence = _labelled_amount(text, label)
+        if final:
+            entry["FinalAmount"], confidences["FinalAmount"] = final, confidence
+            break
+    gst, confidence = _labelled_amount(text, INVOICE_GST_LABEL)
+    if gst:
+        entry["GST"], confidences["GST"] = gst, confidence
+    subtotal, confidence = _labelled_amount(text, INVOICE_SUBTOTAL_LABEL)
+    if subtotal:
+        entry["Cost"], confidences["Cost"] = subtotal, confidence
+    elif final:
+        # No subtotal printed: the pre-tax amount is the total less any GST
+        entry["Cost"] = f"{float(final) - float(gst or 0):.2f}"
+        confidences["Cost"] = 0.85
+
+    # Summary: the first line item's description, without its quantity and prices
+    for line in lines[1:]:
+        if re.search(rf"{AMOUNT_PATTERN}$", line) and not re.match(TOTAL_LINE_PATTERN, line, re.IGNORECASE):
+            description = re.sub(rf"(?:\s+(?:\d+|{AMOUNT_PATTERN}))+$", "", line)
+            description = re.sub(r"\s*\(.*?\)", "", description).strip(" -")
+            if description:
+                entry["Summary"] = " ".join(description.split()[:5])
+                break
+
+    if any(field not in confidences for field in INVOICE_REQUIRED_FIELDS):
+        return entry, confidences, 0
+    total = float(final)
+    inconsistent = (
+        not 0 <= float(entry["Cost"]) <= total
+        or (gst and float(gst) >= total)
+        or (subtotal and abs(float(subtotal) + float(gst or 0) - total) > 0.05)
+    )
+    if inconsistent:
+        confidences["FinalAmount"] = 0  # e.g. Subtotal + GST != total: let Gemini read it
+        return entry, confidences, 0
+    if not (has_abn or (subtotal and gst)):
+        return entry, confidences, 0  # Nothing on the invoice confirms the reading
+    issues = validate_entries([entry], "finance")
+    if issues:
+        for issue in issues:
+            confidences[issue["field"]] = 0
+        return entry, confidences, 0
+    return entry, confidences, min(confidences[field] for field in INVOICE_REQUIRED_FIELDS)
+
+
+def preparse_invoice(text, actions):
+    """Run the local invoice parser; returns the entry when it is confident enough, else None."""
+    if not INVOICE_PREPARSE or not text:
+        return None
+    started = time.perf_counter()
+    entry, confidences, score = parse_invoice_locally(text)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if score >= INVOICE_PREPARSE_MIN_CONFIDENCE:
+        actions.append(
+            f"✓ Invoice read by the local parser in {elapsed_ms:.1f} ms "
+            f"(confidence {score:.2f}: {entry['Vendor']}, {entry['Date']}, total {entry['FinalAmount']}) - no AI call needed"
+        )
+        return entry
+    missing = [
+        field for field in FINANCE_FIELDS
+        if (field in INVOICE_REQUIRED_FIELDS and not confidences.get(field)) or confidences.get(field) == 0
+    ]
+    if missing:
+        reason = f"missing or inconsistent {', '.join(missing)}"
+    elif not score:
+        reason = "no ABN or printed subtotal and GST to confirm it"
+    else:
+        reason = f"confidence {score:.2f}"
+    actions.append(f"Local invoice parser not confident ({reason}) - sending the invoice to the AI")
+    return None
+
+
+# --- ENTRY VALIDATION ---
+# Model output is checked field by field (invoice arithmetic, date and unit formats, mark and
+# drawing number patterns). Only the failing fields are sent back to the model that produced
+# them, in a short prompt with the relevant lines of the document, instead of re-running the
+# whole extraction.
+VALIDATION_REASK = env_flag('VALIDATION_REASK', True)
+VALIDATION_MAX_REASK_FIELDS = int(os.environ.get('VALIDATION_MAX_REASK_FIELDS', 20))
+REASK_CONTEXT_CHARS = int(os.environ.get('REASK_CONTEXT_CHARS', 4000))
+LENGTH_PATTERN = r"\d+(?:\.\d+)?\s*(?:mm|m)"
+MARK_PATTERN = r"[A-Z]{1,4}-?\d{1,4}[A-Z]?"
+REGISTER_DWG_PATTERN = r"[A-Z0-9]{1,4}[-.]?\d{2,4}[A-Z]?"
+SCALE_PATTERN = r"1:\d+(?:\s*\(varies\))?|N\.?T\.?S\.?|AS SHOWN"
+FIELD_FORMAT_HINTS = {
+    "finance": 'Date as YYYY-MM-DD; Cost, GST and FinalAmount as plain numbers, with Cost + GST = FinalAmount ("N/A" for GST if none is listed).',
+    "engineering": 'Mark is the short identifier from the MARK column (e.g. "B-101", "C1"), never a detail reference like "D1/S-500"; Length includes units (e.g. "8500 mm"); Qty is a whole number.',
+    "transmittal": 'DwgNo like "S-101"; Rev is the current revision letter or number; Scale like "1:100", "N.T.S." or "AS SHOWN".',
+}
+
+
+def _money(value):
+    """Parse '$1,234.50', '1234.5' or 1234.5 to a float; None if not an amount."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    cleaned = re.sub(r"[$,\s]|AUD|USD|NZD", "", str(value or ""), flags=re.IGNORECASE)
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def _missing(value):
+    return str(value if value is not None else "").strip() in ("", "N/A")
+
+
+def validation_target(entry, doc_type):
+    """The dict whose fields are validated: the DrawingRegister for transmittals, else the row."""
+    if doc_type == "transmittal":
+        register = entry.get("DrawingRegister")
+        return register if isinstance(register, dict) else None
+    return entry
+
+
+def validate_entry(entry, doc_type):
+    """Return [(field, problem)] for the fields of one entry that fail validation."""
+    target = validation_target(entry, doc_type) if isinstance(entry, dict) else None
+    if target is None:
+        return []
+    problems = []
+    if doc_type == "finance":
+        if _missing(target.get("Date")) or not re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(target.get("Date")).strip()):
+            problems.append(("Date", "not a YYYY-MM-DD date"))
+        cost, gst, final = (_money(target.get(field)) for field in ("Cost", "GST", "FinalAmount"))
+        if final is None:
+            problems.append(("FinalAmount", "missing or not a number"))
+        elif cost is not None and gst is not None and abs(cost + gst - final) > 0.05:
+            for field in ("Cost", "GST", "FinalAmount"):
+                problems.append((field, f"Cost + GST ({cost + gst:.2f}) does not equal FinalAmount ({final:.2f})"))
+    elif doc_type == "engineering":
+        mark = str(target.get("Mark", "")).strip()
+        if not re.fullmatch(MARK_PATTERN, mark, re.IGNORECASE):
+            problems.append(("Mark", "looks like a detail reference or note, not a short mark"))
+        length = str(target.get("Length", "")).strip()
+        if not _missing(length) and not all(re.fullmatch(LENGTH_PATTERN, part.strip()) for part in length.split(",")):
+            problems.append(("Length", "length without units (expected e.g. \"8500 mm\")"))
+        qty = str(target.get("Qty", "N/A")).strip()
+        if not _missing(qty) and not qty.isdigit():
+            problems.append(("Qty", "not a whole number"))
+    elif doc_type == "transmittal":
+        checks = [("DwgNo", REGISTER_DWG_PATTERN), ("Rev", r"[A-Z0-9]{1,3}"), ("Scale", SCALE_PATTERN)]
+        for field, pattern in checks:
+            value = str(target.get(field, "")).strip()
+            if not _missing(value) and not re.fullmatch(pattern, value, re.IGNORECASE):
+                problems.append((field, f"unexpected {field} format"))
+    return problems
+
+
+def validate_entries(entries, doc_type):
+    """Return validation issues as [{"row", "field", "value", "problem"}] (row is 0-based)."""
+    issues = []
+    for row, entry in enumerate(entries):
+        target = validation_target(entry, doc_type) if isinstance(entry, dict) else None
+        for field, problem in validate_entry(entry, doc_type):
+            issues.append({"row": row, "field": field, "value": target.get(field), "problem": problem})
+    return issues
+
+
+def absent_from_document(text, doc_type, issue):
+    """True when a flagged field is missing because the document has no such value, so a
+    re-ask cannot fix it (e.g. an invoice with no date anywhere)."""
+    if not _missing(issue["value"]):
+        return False
+    if doc_type == "finance" and issue["field"] == "Date":
+        return _invoice_date(text)[0] is None
+    return False
+
+
+def open_issues(text, doc_type, entries):
+    """validate_entries without the issues absent_from_document() explains."""
+    return [issue for issue in validate_entries(entries, doc_type) if not absent_from_document(text, doc_type, issue)]
+
+
+def reask_context(text, entries, issues, doc_type):
+    """Document text around the failing rows (found by their other values), within REASK_CONTEXT_CHARS."""
+    if doc_type == "finance" or len(text) <= REASK_CONTEXT_CHARS:
+        return text[:REASK_CONTEXT_CHARS]
+    spans = []
+    for row in sorted({issue["row"] for issue in issues}):
+        target = validation_target(entries[row], doc_type) or {}
+        for value in target.values():
+            if isinstance(value, (str, int, float)) and len(str(value)) >= 3 and not _missing(value):
+                position = text.find(str(value))
+                if position >= 0:
+                    spans.append((max(0, position - 300), position + 300))
+    if not spans:
+        return text[:REASK_CONTEXT_CHARS]
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return "\n...\n".join(text[start:end] for start, end in merged)[:REASK_CONTEXT_CHARS]
+
+
+def build_reask_prompt(text, entries, issues, doc_type):
+    """Short follow-up prompt asking only for the failing fields."""
+    rows = sorted({issue["row"] for issue in issues})
+    row_lines = "\n    ".join(
+        f"row {row + 1}: {json.dumps(validation_target(entries[row], doc_type), ensure_ascii=False, default=str)}"
+        for row in rows
+    )
+    issue_lines = "\n    ".join(
+        f'- row {issue["row"] + 1}, {issue["field"]} = {json.dumps(issue["value"], default=str)}: {issue["problem"]}'
+        for issue in issues
+    )
+    return f"""
+    You extracted the rows below from a document, but some fields failed validation.
+    Re-read the document text and return ONLY a JSON array of corrections, one per failing field:
+    [{{"row": <row number>, "field": "<field name>", "value": "<corrected value>"}}]
+    Formats: {FIELD_FORMAT_HINTS.get(doc_type, "")}
+    If the document really shows the value as extracted, return it unchanged. Do not return other fields.
+
+    EXTRACTED ROWS:
+    {row_lines}
+
+    FAILING FIELDS:
+    {issue_lines}
+
+    DOCUMENT TEXT:
+    {reask_context(text, entries, issues, doc_type)}
+    """
+
+
+def reask_failed_fields(text, doc_type, entries, model_name, action_log, attempt_log):
+    """Validate entries and send one targeted follow-up prompt for the failing fields.
+
+    Corrections are applied in place, only to fields that failed. Fields the document does
+    not contain at all are not re-asked. Returns the issues still open afterwards (logged,
+    but the entries are kept either way).
+    """
+    if doc_type not in FIELD_FORMAT_HINTS or not entries:
+        return []
+    issues = open_issues(text, doc_type, entries)
+    if not issues:
+        return []
+    summary = ", ".join(f"row {issue['row'] + 1} {issue['field']}" for issue in issues[:5])
+    if len(issues) > 5:
+        summary += f" and {len(issues) - 5} more"
+    action_log.append(f"Validation flagged {len(issues)} field(s): {summary}")
+    if not VALIDATION_REASK or not model_name:
+        return issues
+    if len(issues) > VALIDATION_MAX_REASK_FIELDS:
+        action_log.append(f"Too many failing fields to re-ask (limit {VALIDATION_MAX_REASK_FIELDS}) - keeping the extracted values")
+        return issues
+
+    prompt = build_reask_prompt(text, entries, issues, doc_type)
+    attempt_detail = {"model": model_name, "attempt": 1, "reask": True, "status": "pending", "message": ""}
+    try:
+        with _extraction_slots:
+            started = time.time()
+            response = get_model(model_name).generate_content(prompt, request_options={"timeout": 30})
+        record_model_result(model_name, "success", time.time() - started, prompt_tokens=estimate_tokens(prompt))
+        fixes, _, _ = parse_model_json(response.text if response and hasattr(response, 'text') else "")
+    except Exception as e:
+        record_model_result(model_name, "error", error=f"{type(e).__name__}: {e}")
+        report_model_error(e)
+        attempt_detail.update(status="error", message=f"{type(e).__name__}: {e}")
+        attempt_log.append(attempt_detail)
+        action_log.append(f"Re-ask for {len(issues)} field(s) failed ({type(e).__name__}) - keeping the extracted values")
+        return issues
+
+    failing = {(issue["row"], issue["field"]) for issue in issues}
+    for fix in fixes if isinstance(fixes, list) else []:
+        if not isinstance(fix, dict):
+            continue
+        try:
+            row = int(fix.get("row")) - 1
+        except (TypeError, ValueError):
+            continue
+        field = fix.get("field")
+        if (row, field) in failing and "value" in fix:
+            validation_target(entries[row], doc_type)[field] = fix["value"]
+    remaining = open_issues(text, doc_type, entries)
+    fixed = len(issues) - len(remaining)
+    attempt_detail.update(status="success", message=f"Re-asked {len(issues)} field(s), {fixed} fixed")
+    attempt_log.append(attempt_detail)
+    action_log.append(
+        f"✓ Targeted re-ask to {model_name} ({len(prompt)} chars) fixed {fixed} of {len(issues)} field(s)"
+        + (f"; {len(remaining)} still flagged" if remaining else "")
+    )
+    return remaining
+
+
 # --- HTML TEMPLATE ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -701,6 +2205,18 @@ HTML_TEMPLATE = """
             <div id="processing-spinner"><span class="spinner-icon"></span>Processing files…</div>
         </form>
 
+        <!-- Engineering rows streamed from the background job while Gemini is still responding -->
+        <div id="live-results" style="display: none; margin-top: 30px;">
+            <div style="display: flex; justify-content: space-between; align-items: baseline;">
+                <h3 style="margin: 0;">Extracting…</h3>
+                <span class="info" id="live-results-status"></span>
+            </div>
+            <table>
+                <thead><tr id="live-results-head"></tr></thead>
+                <tbody id="live-results-body"></tbody>
+            </table>
+        </div>
+
         {% if results %}
         <div id="results-section">
             <div style="display: flex; justify-content: space-between; align-items: baseline; margin-top: 30px;">
@@ -1229,9 +2745,88 @@ HTML_TEMPLATE = """
         document.addEventListener('DOMContentLoaded', function() {
             const spinner = document.getElementById('processing-spinner');
             const mainForm = document.querySelector('form');
+            const liveResults = document.getElementById('live-results');
+            const liveStatus = document.getElementById('live-results-status');
+            const liveHead = document.getElementById('live-results-head');
+            const liveBody = document.getElementById('live-results-body');
+
+            function renderLiveRows(files) {
+                const rows = files.flatMap(file => file.rows || []);
+                const columns = rows.length ? Object.keys(rows[0]) : [];
+                liveHead.innerHTML = '';
+                columns.forEach(column => {
+                    const th = document.createElement('th');
+                    th.textContent = column;
+                    liveHead.appendChild(th);
+                });
+                liveBody.innerHTML = '';
+                rows.forEach(row => {
+                    const tr = document.createElement('tr');
+                    columns.forEach(column => {
+                        const td = document.createElement('td');
+                        td.textContent = row[column] ?? '';
+                        tr.appendChild(td);
+                    });
+                    liveBody.appendChild(tr);
+                });
+                liveStatus.textContent = `${rows.length} row(s) so far`;
+            }
+
+            // Engineering runs as a background job so rows can be shown while they stream in;
+            // any failure to start the job falls back to the normal form post.
+            function streamEngineeringJob() {
+                const files = {};
+                const maxReconnects = 5;
+                let reconnects = 0;
+                const stopStreaming = (source, message) => {
+                    source.close();
+                    spinner?.classList?.remove('visible');
+                    liveStatus.textContent = message;
+                };
+                fetch('{{ url_for("create_extraction_job") }}', { method: 'POST', body: new FormData(mainForm) })
+                    .then(response => response.ok ? response.json() : Promise.reject(response.status))
+                    .then(job => {
+                        liveResults.style.display = 'block';
+                        document.getElementById('results-section')?.remove();
+                        const source = new EventSource(job.stream_url);
+                        source.addEventListener('job', () => { reconnects = 0; });
+                        source.addEventListener('file', event => {
+                            reconnects = 0;
+                            const file = JSON.parse(event.data);
+                            const earlier = (files[file.position]?.rows || []).slice(0, file.rows_offset || 0);
+                            file.rows = earlier.concat(file.rows || []);
+                            files[file.position] = file;
+                            renderLiveRows(Object.keys(files).sort((a, b) => a - b).map(key => files[key]));
+                        });
+                        source.addEventListener('error', event => {
+                            // Named "error" events come from the server; plain ones are dropped connections
+                            if (event.data) {
+                                stopStreaming(source, JSON.parse(event.data).error || 'Job failed');
+                            } else if (++reconnects > maxReconnects) {
+                                stopStreaming(source, `Lost connection to the job; check ${job.status_url}`);
+                            }
+                        });
+                        source.addEventListener('done', event => {
+                            source.close();
+                            const finished = JSON.parse(event.data);
+                            if (finished.results_url) {
+                                window.location = finished.results_url;
+                            } else {
+                                stopStreaming(source, finished.error || 'No rows extracted');
+                            }
+                        });
+                    })
+                    .catch(() => HTMLFormElement.prototype.submit.call(mainForm));
+            }
+
             if (mainForm) {
-                mainForm.addEventListener('submit', () => {
+                mainForm.addEventListener('submit', (event) => {
                     spinner?.classList?.add('visible');
+                    const department = mainForm.querySelector('input[name="department"]:checked');
+                    if (department && department.value === 'engineering' && window.EventSource && window.fetch) {
+                        event.preventDefault();
+                        streamEngineeringJob();
+                    }
                 });
             }
 
@@ -1262,94 +2857,120 @@ def format_currency(value):
         # If conversion fails, return as is
         return str(value) if value else ""
 
-def extract_text(file_obj):
-    text = ""
+def extract_text(file_obj, max_chars=None, stats=None):
+    """Extract text from a PDF; pages are parsed in parallel and stop once max_chars is reached.
+
+    Pass a dict as stats to receive pages_total and pages_parsed.
+    """
     try:
-        with pdfplumber.open(file_obj) as pdf:
-            for page in pdf.pages:
-                extracted = page.extract_text()
-                if extracted:
-                    text += extracted + "\n"
+        pages = [page_text + "\n" for page_text in iter_page_texts(file_obj, max_chars, stats) if page_text]
+        text = "".join(pages)
         if not text.strip():
             return f"Error: No text extracted from PDF"
     except Exception as e:
         print(f"PDF Extraction Error: {type(e).__name__}: {str(e)}")
         return f"Error: {e}"
     return text
-
-def analyze_gemini(text, doc_type):
-    """Call Gemini with a doc-type-specific prompt and return entries, error, model used, attempt log, action log, and schedule_type."""
-    # For engineering, we'll detect schedule type from returned data
-    if doc_type == "engineering":
-        fields = ENGINEERING_BEAM_FIELDS  # Default, will detect if column schedule
-    else:
-        fields = DOC_FIELDS.get(doc_type, FINANCE_FIELDS)
-    error_field = ERROR_FIELD.get(doc_type, fields[-1])
-
-    def error_entry(message):
-        return {
-            field: (message if field == error_field else "AI Error")
-            for field in fields
-        }
-
-    if not api_key:
-        return [error_entry("MISSING API KEY")], "MISSING API KEY", None, [], [], None
-
-    if not text or text.startswith("Error:"):
-        return [error_entry(f"Text extraction failed: {text}")], f"Text extraction failed: {text}", None, [], [], None
-
-    available_models = get_available_models()
-    stable_preferred = ['gemini-2.5-flash-lite', 'gemini-2.5-pro', 'gemini-2.5-flash', 'gemini-pro-latest']
-    model_names = []
-    action_log = []
-    
-    action_log.append(f"Model selection: Checking {len(available_models) if available_models else 0} available models")
-    action_log.append(f"Preferred order: {', '.join(stable_preferred)}")
-    
-    if available_models and len(available_models) > 0:
-        # Prefer stable GA models in defined order
-        model_names = [m for m in stable_preferred if m in available_models]
-        if model_names:
-            action_log.append(f"Found {len(model_names)} preferred model(s): {', '.join(model_names)}")
-        if not model_names:
-            # Expand to include any available model that contains the GA name
-            preview_candidates = []
-            for preferred in stable_preferred:
-                for m in available_models:
-                    if preferred in m and m not in preview_candidates:
-                        preview_candidates.append(m)
-            if preview_candidates:
-                model_names = preview_candidates
-                action_log.append(f"Using preview variants: {', '.join(model_names)}")
-        if not model_names:
-            legacy = [m for m in available_models if m.startswith("gemini-1.5")]
-            if legacy:
-                model_names = legacy[:2]
-                action_log.append(f"Falling back to legacy models: {', '.join(model_names)}")
-        if not model_names:
-            model_names = available_models[:2]
-            action_log.append(f"Using first available models: {', '.join(model_names)}")
-        print(f"Using available models from API: {model_names}")
+
+def stream_model_text(model, prompt, timeout_seconds, on_rows):
+    """Generate with stream=True and return the full response text.
+
+    Each array row is parsed as soon as it is complete and on_rows(rows_so_far) is called, so
+    callers can show rows before the response finishes. The returned text is still parsed
+    (and repaired) as a whole by the caller. The global extraction slot is held until the
+    stream is fully read.
+    """
+    parts = []
+    with _extraction_slots:
+        stream = model.generate_content(prompt, stream=True, request_options={"timeout": timeout_seconds})
+
+        def fragments():
+            for chunk in stream:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue  # Chunk without text parts (e.g. the final finish-reason chunk)
+                if text:
+                    parts.append(text)
+                    yield text
+
+        feed = fragments()
+        rows = []
+        try:
+            for row in iter_json_array_items(feed):
+                rows.append(row)
+                on_rows(list(rows))
+        except json.JSONDecodeError:
+            pass  # Leave it to parse_model_json once the whole response is in
+        for _ in feed:
+            pass
+    return "".join(parts)
+
+
+def analyze_gemini(text, doc_type, allow_chunking=True, candidates=None, cancel_event=None, on_rows=None, local_register=None, categories=None, register_trusted=False):
+    """Call Gemini with a doc-type-specific prompt and return entries, error, model used, attempt log, action log, and schedule_type.
+
+    candidates pins the models to try (skipping selection and health ranking); cancel_event
+    stops further attempts once it is set, e.g. when a hedged request has already won.
+    on_rows(rows_so_far) receives engineering rows while the response is streaming; each new
+    attempt starts again from an empty list. local_register (transmittal) holds DrawingRegister
+    fields read from the title block; they fill fields the model left blank or N/A. With
+    register_trusted the prompt omits the register and the local values are used as-is.
+    categories limits a transmittal prompt to those keys (see analyze_transmittal_split).
+    """
+    # For engineering, we'll detect schedule type from returned data
+    if doc_type == "engineering":
+        fields = ENGINEERING_BEAM_FIELDS  # Default, will detect if column schedule
     else:
-        model_names = stable_preferred
-        action_log.append(f"API listing failed, using fallback: {', '.join(model_names)}")
-        print(f"Using fallback models (API listing failed): {model_names}")
+        fields = DOC_FIELDS.get(doc_type, FINANCE_FIELDS)
+    error_field = ERROR_FIELD.get(doc_type, fields[-1])
+
+    def error_entry(message):
+        return {
+            field: (message if field == error_field else "AI Error")
+            for field in fields
+        }
+
+    if not api_key:
+        return [error_entry("MISSING API KEY")], "MISSING API KEY", None, [], [], None
+
+    if not text or text.startswith("Error:"):
+        return [error_entry(f"Text extraction failed: {text}")], f"Text extraction failed: {text}", None, [], [], None
+
+    if allow_chunking and doc_type == "engineering" and ENGINEERING_CHUNKING:
+        if len(compact_prompt_text(text, dedupe_lines=True)) > ENGINEERING_PROMPT_LIMIT:
+            return analyze_gemini_chunked(text, doc_type, on_rows)
+    if doc_type == "transmittal" and TRANSMITTAL_SPLIT_PROMPTS and categories is None:
+        return analyze_transmittal_split(text, local_register, register_trusted)
+
+    if candidates:
+        model_names, action_log = list(candidates), []
+    else:
+        model_names, action_log = select_model_candidates(doc_type)
+        model_names, health_notes = rank_models(model_names)
+        action_log.extend(health_notes)
+        if GEMINI_HEDGING and len(model_names) > 1:
+            return analyze_gemini_hedged(text, doc_type, model_names, action_log, local_register, categories, register_trusted, on_rows)
 
-    prompt_limit = (
-        ENGINEERING_PROMPT_LIMIT if doc_type == "engineering"
-        else TRANSMITTAL_PROMPT_LIMIT if doc_type == "transmittal"
-        else None
-    )
-    prompt_text = prepare_prompt_text(text, doc_type, prompt_limit)
-    prompt = build_prompt(prompt_text, doc_type)
-    if prompt_limit:
-        action_log.append(f"Prompt truncated to {prompt_limit} characters for {doc_type} document")
     last_error = None
-    response = None
+    response_text = None
     resolved_model = None
     attempt_log = []
+    compacted_length = len(compact_prompt_text(text, dedupe_lines=prompt_char_budget(doc_type) is not None))
+    if prompt_char_budget(doc_type) and compacted_length < len(text):
+        action_log.append(f"Compacted document text from {len(text)} to {compacted_length} characters (whitespace and repeated lines)")
 
     for model_name in model_names:
+        if not begin_model_call(model_name):
+            action_log.append(f"Skipping {model_name}: half-open trial already in progress")
+            continue
+        prompt_limit, budget_note = model_prompt_char_budget(model_name, doc_type)
+        if budget_note:
+            action_log.append(budget_note)
+        prompt_text = prepare_prompt_text(text, doc_type, prompt_limit)
+        prompt = build_prompt(prompt_text, doc_type, include_register=not register_trusted, categories=categories)
+        if prompt_limit and compacted_length > prompt_limit:
+            action_log.append(f"Prompt truncated to {prompt_limit} characters for {doc_type} document")
         for attempt in range(3):
             attempt_detail = {
                 "model": model_name,
@@ -1357,17 +2978,30 @@ def analyze_gemini(text, doc_type):
                 "status": "pending",
                 "message": ""
             }
+            if cancel_event is not None and cancel_event.is_set():
+                action_log.append(f"Stopped before {model_name} (Attempt {attempt + 1}): another model already answered")
+                return [error_entry("Cancelled")], "Cancelled", None, attempt_log, action_log, None
             action_log.append(f"Trying {model_name} (Attempt {attempt + 1})")
+            call_recorded = False
             try:
                 print(f"Trying model: {model_name}")
-                model = genai.GenerativeModel(model_name)
+                model = get_model(model_name)
                 # Use longer timeout for engineering (large PDFs), shorter for others
                 timeout_seconds = 60 if doc_type == "engineering" else 30
-                response = model.generate_content(prompt, request_options={"timeout": timeout_seconds})
+                if on_rows is not None and doc_type == "engineering" and GEMINI_STREAMING:
+                    call_started = time.time()
+                    response_text = stream_model_text(model, prompt, timeout_seconds, on_rows)
+                else:
+                    with _extraction_slots:
+                        call_started = time.time()
+                        response = model.generate_content(prompt, request_options={"timeout": timeout_seconds})
+                        response_text = response.text if response and hasattr(response, 'text') else None
+                record_model_result(model_name, "success", time.time() - call_started, prompt_tokens=estimate_tokens(prompt))
+                call_recorded = True
                 resolved_model = model_name
                 action_log.append(f"✓ API call succeeded with {model_name}")
 
-                if not response or not hasattr(response, 'text') or not response.text:
+                if not response_text:
                     print(f"Error: Empty response from Gemini API with model {model_name}")
                     attempt_detail["status"] = "no_response"
                     attempt_detail["message"] = "Empty response"
@@ -1375,8 +3009,12 @@ def analyze_gemini(text, doc_type):
                     action_log.append(f"Empty response from {model_name}")
                     continue
 
-                clean_json = response.text.replace("```json", "").replace("```", "").strip()
-                parsed = json.loads(clean_json)
+                parsed, repair_note, partial = parse_model_json(response_text)
+                if repair_note:
+                    attempt_detail["repaired"] = repair_note
+                    action_log.append(f"Salvaged response from {model_name}: {repair_note}")
+                if partial:
+                    attempt_detail["partial"] = True
                 
                 # Handle different return structures
                 if doc_type == "transmittal":
@@ -1411,6 +3049,10 @@ def analyze_gemini(text, doc_type):
                             for key in ['DrawingRegister', 'Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
                                 if key not in entry:
                                     entry[key] = [] if key != 'DrawingRegister' else {}
+                            if local_register and register_trusted:
+                                entry['DrawingRegister'] = dict(local_register)
+                            elif local_register and isinstance(entry['DrawingRegister'], dict):
+                                fill_register_blanks(entry['DrawingRegister'], local_register, action_log)
 
                 if entries:
                     attempt_detail["status"] = "success"
@@ -1418,6 +3060,10 @@ def analyze_gemini(text, doc_type):
                     attempt_log.append(attempt_detail)
                     print(f"Successfully extracted {len(entries)} rows with {model_name} for {doc_type}")
                     action_log.append(f"Success with {model_name}: extracted {len(entries)} row(s)")
+                    if cancel_event is not None and cancel_event.is_set():
+                        action_log.append(f"Skipped re-asking {model_name}: another model already answered")
+                    else:
+                        reask_failed_fields(prompt_text, doc_type, entries, model_name, action_log, attempt_log)
                     return entries, None, resolved_model, attempt_log, action_log, schedule_type
 
                 attempt_detail["status"] = "no_data"
@@ -1429,8 +3075,7 @@ def analyze_gemini(text, doc_type):
 
             except json.JSONDecodeError as e:
                 print(f"JSON Parse Error with {model_name}: {e}")
-                response_text = response.text if response and hasattr(response, 'text') else 'No response'
-                print(f"Response text: {response_text}")
+                print(f"Response text: {response_text or 'No response'}")
                 last_error = f"JSON parse error: {str(e)}"
                 attempt_detail["status"] = "json_error"
                 attempt_detail["message"] = str(e)
@@ -1445,12 +3090,18 @@ def analyze_gemini(text, doc_type):
                 
                 # For timeouts, try shortening prompt once, then move to next model
                 is_timeout = "DeadlineExceeded" in error_msg or "504" in error_msg or "timeout" in error_msg.lower() or isinstance(e, TimeoutError)
+                if not call_recorded:
+                    record_model_result(
+                        model_name, "timeout" if is_timeout else "error",
+                        error=f"{error_type}: {error_msg}", prompt_tokens=estimate_tokens(prompt)
+                    )
+                report_model_error(e)
                 
-                if is_timeout and doc_type == "engineering" and prompt_limit == ENGINEERING_PROMPT_LIMIT and attempt == 0:
+                if is_timeout and prompt_limit and prompt_limit > ENGINEERING_PROMPT_LIMIT_SHORT and attempt == 0:
                     # First attempt timeout - shorten prompt and retry once
                     prompt_limit = ENGINEERING_PROMPT_LIMIT_SHORT
                     prompt_text = prepare_prompt_text(text, doc_type, prompt_limit)
-                    prompt = build_prompt(prompt_text, doc_type)
+                    prompt = build_prompt(prompt_text, doc_type, include_register=not register_trusted, categories=categories)
                     action_log.append(f"Timeout detected - shortening prompt to {prompt_limit} chars and retrying {model_name}")
                     time.sleep(2)  # Brief delay before retry
                     continue
@@ -1486,25 +3137,1945 @@ def analyze_gemini(text, doc_type):
                     'not found' in error_msg.lower() or
                     (google_exceptions and isinstance(e, google_exceptions.NotFound))
                 )
+                if not call_recorded:
+                    record_model_result(model_name, "not_found" if is_not_found else "error", error=f"{error_type}: {error_msg}")
+                report_model_error(e)
                 attempt_detail["status"] = "error"
                 attempt_detail["message"] = f"{error_type}: {error_msg}"
                 attempt_log.append(attempt_detail)
                 action_log.append(f"{model_name} (Attempt {attempt + 1}) error: {error_type}: {error_msg}")
-                if is_not_found and attempt < 2:
-                    backoff_delay = 2 ** attempt
-                    action_log.append(f"Model not found, waiting {backoff_delay} second(s) before retry")
-                    time.sleep(backoff_delay)
-                    continue
                 last_error = f"API error: {error_type} - {error_msg}"
-                action_log.append(f"All retries exhausted for {model_name}, trying next model")
+                if is_not_found:
+                    # The breaker is now open for this model, so later requests skip it too
+                    action_log.append(f"{model_name} not available - trying next model")
+                else:
+                    action_log.append(f"All retries exhausted for {model_name}, trying next model")
                 break
-        else:
-            continue
-        break
 
     action_log.append(f"✗ All models failed for this document: {last_error or 'Unknown error'}")
     return [error_entry(last_error or "All models failed")], last_error or "All models failed", resolved_model, attempt_log, action_log, None
 
+
+def analyze_gemini_hedged(text, doc_type, model_names, action_log, local_register=None, categories=None, register_trusted=False, on_rows=None):
+    """Race candidate models to cut tail latency.
+
+    The first model gets the prompt alone; if it has not answered within hedge_delay() the
+    next candidate is sent the same prompt (up to HEDGE_MAX_IN_FLIGHT at once), and a model
+    that fails outright is replaced by the next one immediately. The first valid result
+    wins and the other lanes are told to stop. Attempts carry a "hedge" lane number.
+    Streamed rows reach on_rows from one lane only: the first to produce rows, until it fails.
+    """
+    attempt_log = []
+    remaining = list(model_names)
+    pending = {}
+    lanes = {}
+    cancel = threading.Event()
+    hedges = 0
+    last_result = None
+    stream_lane = []
+    stream_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_IN_FLIGHT, thread_name_prefix='hedge')
+
+    def lane_on_rows(lane):
+        def forward(rows):
+            with stream_lock:
+                if cancel.is_set() or stream_lane[:1] not in ([], [lane]):
+                    return
+                stream_lane[:] = [lane]
+            on_rows(rows)
+        return forward
+
+    def launch():
+        model_name = remaining.pop(0)
+        lane = len(lanes)
+        future = executor.submit(
+            analyze_gemini, text, doc_type, False, [model_name], cancel,
+            lane_on_rows(lane) if on_rows else None, local_register, categories, register_trusted
+        )
+        lanes[future] = lane
+        pending[future] = (model_name, time.time())
+        return model_name
+
+    try:
+        action_log.append(f"Hedging enabled: sending prompt to {launch()}")
+        while pending:
+            newest_model, newest_started = max(pending.values(), key=lambda p: p[1])
+            timeout = None
+            if remaining and len(pending) < HEDGE_MAX_IN_FLIGHT:
+                delay = hedge_delay(newest_model)
+                timeout = max(0, newest_started + delay - time.time())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                action_log.append(f"Hedge {hedges}: {newest_model} has not answered within {delay:.1f}s - also sending to {launch()}")
+                continue
+            for future in done:
+                model_name, _ = pending.pop(future)
+                lane = lanes[future]
+                entries, api_error, resolved_model, lane_attempts, lane_actions, schedule_type = future.result()
+                action_log.extend(f"[{model_name}] {action}" for action in lane_actions)
+                attempt_log.extend(dict(attempt, hedge=lane) for attempt in lane_attempts)
+                if not api_error:
+                    cancel.set()
+                    losers = ", ".join(name for name, _ in pending.values())
+                    action_log.append(f"✓ {model_name} answered first after {hedges} hedge(s)" + (f" - ignoring {losers}" if losers else ""))
+                    return entries, None, resolved_model, attempt_log, action_log, schedule_type
+                last_result = (entries, api_error, resolved_model)
+                with stream_lock:
+                    if stream_lane == [lane]:
+                        stream_lane.clear()  # Let a surviving lane stream its rows instead
+                if remaining and len(pending) < HEDGE_MAX_IN_FLIGHT:
+                    action_log.append(f"{model_name} failed - falling back to {launch()}")
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False)
+
+    entries, api_error, resolved_model = last_result
+    action_log.append(f"✗ All models failed for this document after {hedges} hedge(s): {api_error}")
+    return entries, api_error, resolved_model, attempt_log, action_log, None
+
+
+def analyze_transmittal_split(text, local_register=None, register_trusted=False):
+    """Extract a transmittal with one smaller prompt per TRANSMITTAL_CATEGORY_GROUPS entry.
+
+    Groups run concurrently on the same text and each is re-run up to
+    TRANSMITTAL_CATEGORY_RETRIES times if it fails, so a JSON error only costs that group.
+    The groups' keys are merged into the usual single transmittal entry. local_register (title
+    block values) fills any DrawingRegister fields the model left blank; with register_trusted
+    the DrawingRegister group is skipped and the local values are used as-is.
+    """
+    groups = [group for group in TRANSMITTAL_CATEGORY_GROUPS if not (register_trusted and group == ["DrawingRegister"])]
+    action_log = [f"Splitting transmittal prompt into {len(groups)} concurrent category group(s): {'; '.join(', '.join(group) for group in groups)}"]
+    started = time.time()
+
+    def run(group):
+        for retry in range(TRANSMITTAL_CATEGORY_RETRIES + 1):
+            result = analyze_gemini(text, "transmittal", allow_chunking=False, categories=group)
+            if not result[1]:
+                break
+        return result, retry
+
+    with ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix='category') as executor:
+        group_results = list(executor.map(run, groups))
+
+    merged = {key: {} if key == "DrawingRegister" else [] for key in TRANSMITTAL_CATEGORIES}
+    if local_register and register_trusted:
+        merged["DrawingRegister"] = dict(local_register)
+    attempt_log = []
+    errors = []
+    resolved_model = None
+    for group, ((entries, api_error, model_used, group_attempts, group_actions, _), retries) in zip(groups, group_results):
+        label = f"[{'+'.join(group)}]"
+        action_log.extend(f"{label} {action}" for action in group_actions)
+        attempt_log.extend(dict(attempt, categories=group) for attempt in group_attempts)
+        if retries:
+            action_log.append(f"{label} re-ran {retries} time(s)" + (" and still failed" if api_error else ""))
+        if api_error:
+            errors.append(f"{', '.join(group)}: {api_error}")
+            continue
+        resolved_model = resolved_model or model_used
+        entry = entries[0] if entries and isinstance(entries[0], dict) else {}
+        for key in group:
+            merged[key] = entry.get(key, merged[key])
+
+    if len(errors) == len(groups):
+        first = group_results[0][0]
+        action_log.append("✗ All category groups failed")
+        return first[0], first[1], first[2], attempt_log, action_log, None
+
+    action_log.append(f"Merged {len(groups) - len(errors)} of {len(groups)} category group(s) in {time.time() - started:.1f}s")
+    if local_register and not register_trusted and isinstance(merged["DrawingRegister"], dict):
+        fill_register_blanks(merged["DrawingRegister"], local_register, action_log)
+    api_error = None
+    if errors:
+        api_error = f"{len(errors)} of {len(groups)} category groups failed ({'; '.join(errors)}) - results may be incomplete"
+        action_log.append(f"⚠ {api_error}")
+    return [merged], api_error, resolved_model, attempt_log, action_log, None
+
+
+def split_schedule_text(text, chunk_chars):
+    """Split schedule text on line (row) boundaries into chunks of at most chunk_chars.
+
+    The most recent header line (one containing MARK) is repeated at the top of each chunk
+    so the model can still map columns.
+    """
+    chunks = []
+    current = []
+    size = 0
+    header = ""
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        is_header = bool(re.search(r"\bMARK\b", line.upper()))
+        if is_header:
+            header = line
+        # Rows in a new chunk are preceded by the header (unless it would leave no room)
+        prefix = [header] if header and not is_header and len(header) <= chunk_chars // 2 else []
+        prefix_size = sum(len(l) + 1 for l in prefix)
+        room = max(1, chunk_chars - prefix_size)
+        # A single over-long line is hard split so nothing is truncated away
+        pieces = [line[start:start + room] for start in range(0, len(line), room)] if len(line) > room else [line]
+        for piece in pieces:
+            if current and size + len(piece) > chunk_chars:
+                chunks.append("\n".join(current))
+                current, size = list(prefix), prefix_size
+            current.append(piece)
+            size += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def merge_schedule_entries(entry_lists):
+    """Merge rows from several chunks: one object per unique Mark, combining differing lengths."""
+    merged = {}
+    unmarked = []
+    for entries in entry_lists:
+        for entry in entries:
+            mark = str(entry.get("Mark", "")).strip()
+            if not mark or mark == "N/A":
+                unmarked.append(entry)
+                continue
+            existing = merged.get(mark)
+            if existing is None:
+                merged[mark] = dict(entry)
+                continue
+            for field, value in entry.items():
+                if field == "Length":
+                    lengths = [l for l in str(existing.get("Length", "")).split(", ") if l and l != "N/A"]
+                    if value and value != "N/A" and value not in lengths:
+                        existing["Length"] = ", ".join(lengths + [value])
+                elif existing.get(field) in (None, "", "N/A") and value not in (None, ""):
+                    existing[field] = value
+    return list(merged.values()) + unmarked
+
+
+def analyze_gemini_chunked(text, doc_type, on_rows=None):
+    """Map-reduce extraction for schedules longer than the prompt limit.
+
+    Chunks are sized to ENGINEERING_PROMPT_LIMIT_SHORT so even the timeout retry path never
+    truncates them, are analyzed concurrently, and merged by Mark. At most ENGINEERING_MAX_CHUNKS
+    chunks are sent; any beyond that are dropped and logged. Streamed rows from all chunks are
+    passed to on_rows in chunk order.
+    """
+    chunks = split_schedule_text(text, ENGINEERING_PROMPT_LIMIT_SHORT)
+    action_log = [f"Schedule text ({len(text)} chars) exceeds {ENGINEERING_PROMPT_LIMIT} chars - splitting into {len(chunks)} chunk(s) on row boundaries"]
+    if len(chunks) > ENGINEERING_MAX_CHUNKS:
+        dropped = chunks[ENGINEERING_MAX_CHUNKS:]
+        chunks = chunks[:ENGINEERING_MAX_CHUNKS]
+        action_log.append(
+            f"Only the first {ENGINEERING_MAX_CHUNKS} chunk(s) are analyzed (ENGINEERING_MAX_CHUNKS) - "
+            f"skipped {len(dropped)} chunk(s), {sum(len(chunk) for chunk in dropped)} chars at the end of the schedule"
+        )
+    streamed = {}
+    streamed_lock = threading.Lock()
+
+    def run(indexed_chunk):
+        index, chunk = indexed_chunk
+        chunk_on_rows = None
+        if on_rows is not None:
+            def chunk_on_rows(rows):
+                with streamed_lock:
+                    streamed[index] = rows
+                    on_rows([row for i in sorted(streamed) for row in streamed[i]])
+        return analyze_gemini(chunk, doc_type, allow_chunking=False, on_rows=chunk_on_rows)
+
+    with ThreadPoolExecutor(max_workers=min(len(chunks), ENGINEERING_CHUNK_CONCURRENCY), thread_name_prefix='chunk') as executor:
+        chunk_results = list(executor.map(run, enumerate(chunks)))
+
+    attempt_log = []
+    successful = []
+    errors = []
+    type_votes = {}
+    resolved_model = None
+    for index, (entries, api_error, model_used, chunk_attempts, chunk_actions, schedule_type) in enumerate(chunk_results, 1):
+        label = f"[chunk {index}/{len(chunks)}]"
+        action_log.extend(f"{label} {action}" for action in chunk_actions)
+        for attempt in chunk_attempts:
+            attempt_log.append(dict(attempt, chunk=index))
+        if api_error:
+            errors.append(f"chunk {index}: {api_error}")
+            continue
+        successful.append(entries)
+        resolved_model = resolved_model or model_used
+        if schedule_type:
+            type_votes[schedule_type] = type_votes.get(schedule_type, 0) + len(entries)
+
+    if not successful:
+        first = chunk_results[0]
+        action_log.append("✗ All chunks failed")
+        return first[0], first[1], first[2], attempt_log, action_log, None
+
+    schedule_type = max(type_votes, key=type_votes.get) if type_votes else "beam"
+    fields = ENGINEERING_COLUMN_FIELDS if schedule_type == "column" else ENGINEERING_BEAM_FIELDS
+    entries = merge_schedule_entries(successful)
+    for entry in entries:
+        for field in fields:
+            entry.setdefault(field, "N/A")
+    raw_count = sum(len(e) for e in successful)
+    action_log.append(f"Merged {raw_count} row(s) from {len(successful)} chunk(s) into {len(entries)} unique mark(s) ({schedule_type.upper()} schedule)")
+
+    api_error = None
+    if errors:
+        api_error = f"{len(errors)} of {len(chunks)} chunks failed ({'; '.join(errors)}) - results may be incomplete"
+        action_log.append(f"⚠ {api_error}")
+    return entries, api_error, resolved_model, attempt_log, action_log, schedule_type
+
+def register_is_reliable(register, text):
+    """True when all four title block fields were found, are well-formed, and the drawing
+    number is printed in the title block itself rather than only in a file path."""
+    if not register or any(register.get(field) in (None, "", "N/A") for field in REGISTER_FIELDS):
+        return False
+    if validate_entry({"DrawingRegister": register}, "transmittal"):
+        return False
+    title = register["Title"]
+    if not 3 <= len(title) <= 120 or re.search(r"\b(?:SCALE|REV|DRAWING\s+No)\b", title, re.IGNORECASE):
+        return False
+    dwg_no = re.escape(register["DwgNo"])
+    return bool(re.search(rf"^\s*{dwg_no}\s*$|DRAWING\s+No\.?\s*:?\s*{dwg_no}\b", text, re.IGNORECASE | re.MULTILINE))
+
+
+def read_register_for_prompt(text, doc_type, actions):
+    """Run the title block rules for a transmittal.
+
+    Returns (register, trusted): the fields found (None if none were), and whether they pass
+    register_is_reliable() so the prompt can leave the register out.
+    """
+    if doc_type != "transmittal" or not DRAWING_REGISTER_RULES or not text:
+        return None, False
+    started = time.perf_counter()
+    register = extract_drawing_register(text)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not register:
+        actions.append("Title block rules found no drawing register fields")
+        return None, False
+    found = ", ".join(f"{field} {register[field]}" for field in REGISTER_FIELDS if field in register)
+    if register_is_reliable(register, text):
+        actions.append(f"✓ Drawing register read from the title block in {elapsed_ms:.1f} ms ({found}) - omitted from the AI prompt")
+        return register, True
+    actions.append(f"✓ Title block rules read {found} in {elapsed_ms:.1f} ms - used where the AI leaves a field blank")
+    return register, False
+
+
+def fill_register_blanks(register, local_register, action_log):
+    """Copy title block values into DrawingRegister fields the model left blank or N/A."""
+    filled = [field for field, value in local_register.items() if _missing(register.get(field))]
+    for field in filled:
+        register[field] = local_register[field]
+    if filled:
+        action_log.append(f"Filled {', '.join(filled)} in the drawing register from the title block")
+
+
+def extract_and_analyze(file_path, doc_type, actions, on_rows=None, prepared=None):
+    """Extract a file's text and run it through analyze_gemini.
+
+    Engineering schedules whose tables match a known layout, and invoices the local parser
+    reads confidently, are handled without an LLM call. prepared ({"text", "raw_text", "note"}) supplies text already extracted for a batch.
+    Returns analyze_gemini's result tuple, or None if no text could be extracted.
+    """
+    if prepared:
+        actions.append(prepared["note"])
+        local_register, trusted = read_register_for_prompt(prepared["raw_text"], doc_type, actions)
+        actions.append(f"Analyzing {os.path.basename(file_path)} with AI models")
+        return analyze_gemini(prepared["text"], doc_type, on_rows=on_rows, local_register=local_register, register_trusted=trusted)
+
+    filename = os.path.basename(file_path)
+    char_budget = extraction_char_budget(doc_type)
+    table_text = ""
+    if doc_type == "engineering" and ENGINEERING_TABLE_EXTRACTION:
+        actions.append(f"Looking for schedule tables in {filename}")
+        try:
+            tables = extract_tables(file_path)
+        except Exception as e:
+            print(f"Table extraction error for {filename}: {type(e).__name__}: {e}")
+            tables = []
+        entries, schedule_type = parse_schedule_tables(tables)
+        if entries:
+            action_log = [f"✓ Parsed {len(entries)} {schedule_type.upper()} schedule row(s) directly from the PDF tables"]
+            attempt_log = []
+            # Same post-validation as model output; only failing cells are re-asked, with the tables as context
+            if validate_entries(entries, doc_type):
+                model_names = rank_models(select_model_candidates(doc_type)[0])[0] if api_key else []
+                reask_failed_fields(
+                    format_tables_for_prompt(tables), doc_type, entries,
+                    model_names[0] if model_names else None, action_log, attempt_log
+                )
+            if not attempt_log:
+                action_log[0] += " - no AI call needed"
+            return entries, None, LOCAL_TABLE_PARSER, attempt_log, action_log, schedule_type
+        table_text = format_tables_for_prompt(tables)
+        if table_text:
+            actions.append(f"Schedule tables found but headers did not fully match; sending {len(table_text)} characters of table rows ahead of the page text")
+
+    actions.append(f"Extracting text from {filename}")
+    text_budget = max(char_budget - len(table_text), 1) if char_budget else None
+    page_stats = {}
+    text = extract_text(file_path, max_chars=text_budget, stats=page_stats)
+    if text.startswith("Error:"):
+        actions.append(f"✗ Text extraction failed for {filename}: {text}")
+        if not table_text:
+            return None
+        text = ""
+    else:
+        actions.append(f"✓ Text extracted successfully ({len(text)} characters)")
+    pages_total = page_stats.get("pages_total", 0)
+    pages_parsed = page_stats.get("pages_parsed", 0)
+    if pages_total:
+        page_note = f"Parsed {pages_parsed} of {pages_total} page(s)"
+        if pages_parsed < pages_total:
+            page_note += f", skipped {pages_total - pages_parsed} once the {char_budget}-character prompt budget was filled"
+        actions.append(page_note)
+
+    if doc_type == "finance":
+        entry = preparse_invoice(text, actions)
+        if entry:
+            return [entry], None, LOCAL_INVOICE_PARSER, [], [], None
+
+    local_register, trusted = read_register_for_prompt(text, doc_type, actions)
+    actions.append(f"Analyzing {filename} with AI models")
+    return analyze_gemini(table_text + text, doc_type, on_rows=on_rows, local_register=local_register, register_trusted=trusted)
+
+
+def new_outcome(file_path):
+    """Empty per-file result as returned by process_document."""
+    return {
+        "path": file_path,
+        "filename": os.path.basename(file_path),
+        "analyzed": False,
+        "entries": [],
+        "error": None,
+        "model": None,
+        "attempt_log": [],
+        "actions": [],
+        "schedule_type": None
+    }
+
+
+def cached_model_names(doc_type):
+    """Model tags a cached result for doc_type may be stored under, in lookup order."""
+    model_names = select_model_candidates(doc_type)[0]
+    if doc_type == "engineering":
+        model_names.append(LOCAL_TABLE_PARSER)  # table-parsed schedules that needed a re-ask
+    return model_names
+
+
+def process_document(file_path, doc_type, on_rows=None, prepared=None):
+    """Run the cache -> pdfplumber -> Gemini pipeline for a single file.
+
+    Touches no request or session state, so it is safe to run on a worker thread. The action
+    and attempt logs are collected per file and merged by the caller in the original order.
+    on_rows is passed to analyze_gemini for incremental (streamed) rows; prepared is passed
+    to extract_and_analyze. Results from deduplicated text depend on the rest of the batch, so
+    they are neither cached nor registered under the file hash.
+    """
+    filename = os.path.basename(file_path)
+    outcome = new_outcome(file_path)
+    actions = outcome["actions"]
+
+    if not os.path.exists(file_path):
+        outcome["error"] = f"File not found: {file_path}"
+        actions.append(f"✗ {outcome['error']}")
+        return outcome
+
+    actions.append(f"Processing file: {filename} (path: {file_path})")
+    try:
+        file_hash = hash_file(file_path)
+    except OSError as e:
+        outcome["error"] = f"Could not read {filename}: {e}"
+        actions.append(f"✗ {outcome['error']}")
+        return outcome
+
+    registered = None
+    partial = False
+    if doc_type == "transmittal" and DRAWING_REGISTER_STORE:
+        registered = get_registered_drawing(file_hash)
+    cached = None if registered else get_cached_extraction(file_hash, doc_type, cached_model_names(doc_type))
+    if registered:
+        entries = registered["entries"]
+        api_error = None
+        model_used = registered["model"]
+        attempt_log = []
+        file_action_log = [
+            f"✓ {filename} unchanged since {registered['dwg_no']} Rev {registered['rev']} was registered "
+            f"- reused the drawing register entry"
+        ]
+        schedule_type = None
+    elif cached:
+        entries = cached["entries"]
+        api_error = None
+        model_used = cached["model"]
+        attempt_log = []
+        file_action_log = [
+            f"✓ Cache hit ({cached['tier']}) for {filename} with {model_used} "
+            f"(cached {int(time.time() - cached['created_at'])}s ago) - skipped text extraction and AI analysis"
+        ]
+        schedule_type = cached.get("schedule_type")
+    else:
+        extracted = extract_and_analyze(file_path, doc_type, actions, on_rows, prepared)
+        if extracted is None:
+            outcome["error"] = f"Text extraction failed for {filename}"
+            return outcome
+        entries, api_error, model_used, attempt_log, file_action_log, schedule_type = extracted
+        partial = response_was_partial(attempt_log)
+        if partial:
+            file_action_log.append("Response was cut short - rows may be missing, so it was not cached or registered")
+        elif prepared and prepared.get("deduplicated"):
+            partial = True
+            file_action_log.append("Extracted from batch-deduplicated text - not cached or registered, as the result depends on the other drawings")
+        # Local parser results are cheaper to recompute than to cache, unless a re-ask was paid for
+        local = model_used in (LOCAL_TABLE_PARSER, LOCAL_INVOICE_PARSER)
+        if entries and not api_error and not partial and (not local or attempt_log):
+            store_cached_extraction(file_hash, doc_type, model_used, entries, schedule_type)
+    if doc_type == "transmittal" and DRAWING_REGISTER_STORE and not registered and entries and not api_error and not partial:
+        note = register_drawing(file_hash, filename, entries[0], model_used)
+        if note:
+            file_action_log.append(note)
+
+    if file_action_log:
+        actions.extend(file_action_log)
+    if model_used:
+        actions.append(f"✓ Successfully processed {filename} with {model_used}")
+    if api_error:
+        actions.append(f"✗ Failed to process {filename}: {api_error}")
+
+    outcome.update({
+        "analyzed": True,
+        "entries": entries,
+        "error": api_error,
+        "model": model_used,
+        "attempt_log": attempt_log or [],
+        "schedule_type": schedule_type
+    })
+    return outcome
+
+
+def extraction_worker_count(file_count, requested=None):
+    """Threads to use for one request: the smaller of the request's ask, the configured cap and the file count."""
+    cap = EXTRACTION_MAX_WORKERS_PER_REQUEST
+    if requested:
+        cap = min(cap, requested)
+    return max(1, min(cap, file_count))
+
+
+def process_documents(file_paths, doc_type, requested_workers=None, on_start=None, on_complete=None, on_rows=None):
+    """Process files concurrently and return their outcomes in the original file order.
+
+    Concurrency is bounded per request (EXTRACTION_MAX_WORKERS_PER_REQUEST) and across all
+    requests in this worker process (EXTRACTION_GLOBAL_CONCURRENCY). The optional
+    on_start(index, path), on_rows(index, rows_so_far) and on_complete(index, outcome) hooks
+    run on the worker thread.
+    """
+    if doc_type == "finance" and FINANCE_BATCHING and len(file_paths) > 1:
+        return process_finance_batched(file_paths, requested_workers, on_start, on_complete)
+    prepared = {}
+    if doc_type == "transmittal" and TRANSMITTAL_DEDUP and len(file_paths) > 1:
+        prepared = prepare_deduplicated_texts(file_paths, doc_type, requested_workers)
+
+    def run(indexed_path):
+        index, path = indexed_path
+        file_on_rows = (lambda rows: on_rows(index, rows)) if on_rows else None
+        if on_start:
+            on_start(index, path)
+        outcome = process_document(path, doc_type, file_on_rows, prepared.get(index))
+        if on_complete:
+            on_complete(index, outcome)
+        return outcome
+
+    indexed_paths = list(enumerate(file_paths))
+    workers = extraction_worker_count(len(file_paths), requested_workers)
+    if workers == 1:
+        return [run(item) for item in indexed_paths]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract') as executor:
+        return list(executor.map(run, indexed_paths))
+
+
+# --- FINANCE BATCHING ---
+# Invoice prompts are tiny, so a batch of invoices goes to Gemini as one prompt with numbered
+# document delimiters. Results come back keyed by DocumentId; only documents whose slot is
+# missing or empty are re-run through the normal one-call-per-file path.
+FINANCE_BATCHING = env_flag('FINANCE_BATCHING', True)
+FINANCE_BATCH_MAX_CHARS = int(os.environ.get('FINANCE_BATCH_MAX_CHARS', 24000))
+FINANCE_BATCH_MAX_DOCS = int(os.environ.get('FINANCE_BATCH_MAX_DOCS', 20))
+
+
+def pack_finance_batches(documents):
+    """Group (index, text) pairs into batches within FINANCE_BATCH_MAX_CHARS / _MAX_DOCS."""
+    batches = []
+    current = []
+    size = 0
+    for index, text in documents:
+        if current and (size + len(text) > FINANCE_BATCH_MAX_CHARS or len(current) >= FINANCE_BATCH_MAX_DOCS):
+            batches.append(current)
+            current, size = [], 0
+        current.append((index, text))
+        size += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def valid_invoice_slot(entry):
+    """A batch slot is usable if it has a vendor, an invoice number and a numeric total."""
+    if not isinstance(entry, dict):
+        return False
+    return (
+        not _missing(entry.get("Vendor"))
+        and not _missing(entry.get("InvoiceNum"))
+        and _money(entry.get("FinalAmount")) is not None
+    )
+
+
+def analyze_finance_batch(batch):
+    """Send one batch of (index, text) invoices in a single prompt.
+
+    Returns ({index: entry}, model_used, attempt_log, action_log); indexes whose slot is
+    missing or invalid are absent from the dict.
+    """
+    batch_text = "\n".join(
+        f"=== DOCUMENT {index + 1} ===\n{text}\n=== END DOCUMENT {index + 1} ==="
+        for index, text in batch
+    )
+    entries, api_error, model_used, attempt_log, action_log, _ = analyze_gemini(batch_text, "finance_batch")
+    if api_error:
+        return {}, model_used, attempt_log, action_log
+    expected = {str(index + 1): index for index, _ in batch}
+    slots = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index = expected.get(str(entry.pop("DocumentId", "")).strip())
+        if index is not None and index not in slots and valid_invoice_slot(entry):
+            slots[index] = entry
+    return slots, model_used, attempt_log, action_log
+
+
+def process_finance_batched(file_paths, requested_workers=None, on_start=None, on_complete=None):
+    """process_documents for invoices: cached files are served from the cache, invoices the
+    local parser reads confidently skip Gemini, the rest are sent to Gemini in batches, and
+    failed slots fall back to process_document."""
+    outcomes = [None] * len(file_paths)
+    hashes = {}
+    preparse_notes = {}
+    local = {}
+    model_names = select_model_candidates("finance")[0]
+
+    def prepare(index):
+        """Text for a document that needs batching, or None if it was read locally or is left
+        to process_document."""
+        try:
+            hashes[index] = hash_file(file_paths[index])
+        except OSError:
+            return None  # process_document reports the missing/unreadable file
+        if get_cached_extraction(hashes[index], "finance", model_names):
+            return None  # process_document serves it from the cache
+        text = extract_text(file_paths[index])
+        if not text or text.startswith("Error:"):
+            return None
+        preparse_notes[index] = []
+        entry = preparse_invoice(text, preparse_notes[index])
+        if entry:
+            local[index] = entry
+            return None
+        return text
+
+    prepare_workers = extraction_worker_count(len(file_paths), requested_workers)
+    with ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix='extract') as executor:
+        texts = list(executor.map(prepare, range(len(file_paths))))
+    pending = [(index, text) for index, text in enumerate(texts) if text]
+
+    def finish(index, outcome):
+        outcomes[index] = outcome
+        if on_complete:
+            on_complete(index, outcome)
+
+    def run_local(index):
+        if on_start:
+            on_start(index, file_paths[index])
+        outcome = new_outcome(file_paths[index])
+        outcome["actions"].append(f"Processing file: {outcome['filename']} (path: {file_paths[index]})")
+        outcome["actions"].extend(preparse_notes[index])
+        outcome["actions"].append(f"✓ Successfully processed {outcome['filename']} with {LOCAL_INVOICE_PARSER}")
+        outcome.update({"analyzed": True, "entries": [local[index]], "model": LOCAL_INVOICE_PARSER})
+        finish(index, outcome)
+
+    def run_single(index):
+        if on_start:
+            on_start(index, file_paths[index])
+        outcome = process_document(file_paths[index], "finance")
+        finish(index, outcome)
+
+    def run_batch(batch):
+        for index, _ in batch:
+            if on_start:
+                on_start(index, file_paths[index])
+        slots, model_used, attempt_log, action_log = analyze_finance_batch(batch)
+        summary = f"Batched {len(batch)} invoice(s) into one request: {len(slots)} extracted"
+        for position, (index, text) in enumerate(batch):
+            entry = slots.get(index)
+            if entry is None:
+                continue
+            outcome = new_outcome(file_paths[index])
+            outcome["actions"].append(f"Processing file: {outcome['filename']} (path: {file_paths[index]})")
+            outcome["actions"].extend(preparse_notes.get(index, []))
+            if position == 0:
+                # The shared batch log is reported once, with the first document
+                outcome["actions"].extend(action_log)
+                outcome["attempt_log"] = list(attempt_log)
+            outcome["actions"].append(summary)
+            # Same post-validation as a single finance extraction, against this document's text
+            reask_failed_fields(text, "finance", [entry], model_used, outcome["actions"], outcome["attempt_log"])
+            outcome["actions"].append(f"✓ Successfully processed {outcome['filename']} with {model_used} (batched)")
+            outcome.update({"analyzed": True, "entries": [entry], "model": model_used})
+            if not response_was_partial(attempt_log):
+                store_cached_extraction(hashes[index], "finance", model_used, [dict(entry)], None)
+            finish(index, outcome)
+        failed = [index for index, _ in batch if index not in slots]
+        for index in failed:
+            run_single(index)
+        return len(failed)
+
+    batched = {index for index, _ in pending}
+    for index in local:
+        run_local(index)
+    singles = [index for index in range(len(file_paths)) if index not in batched and index not in local]
+    batches = pack_finance_batches(pending) if len(pending) > 1 else []
+    singles.extend(index for index, _ in pending if len(pending) <= 1)
+    tasks = [(run_batch, batch) for batch in batches] + [(run_single, index) for index in singles]
+
+    workers = extraction_worker_count(len(tasks), requested_workers) if tasks else 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract') as executor:
+        fallbacks = sum(f.result() or 0 for f in [executor.submit(task, arg) for task, arg in tasks])
+    if local:
+        print(f"Invoice pre-parser: {len(local)} of {len(file_paths)} invoice(s) read locally without an AI call")
+    if batches:
+        print(f"Finance batching: {len(pending)} invoice(s) in {len(batches)} request(s), {fallbacks} per-document fallback(s)")
+    return outcomes
+
+
+# --- BATCH TEXT DEDUPLICATION ---
+# Drawing sets repeat the same company footer, standard notes and legend on every sheet.
+# For a batch, each line is kept only where it first appears (page order, then file order),
+# so the per-document prompt limit is spent on content unique to that drawing.
+TRANSMITTAL_DEDUP = env_flag('TRANSMITTAL_DEDUP', True)
+
+
+def dedupe_batch_texts(texts):
+    """Drop lines already seen on an earlier page or earlier document of the batch.
+
+    texts is a list of strings (None for documents to skip). Returns (new_texts, bytes_saved)
+    with one entry per document. Short lines are always kept.
+    """
+    seen = set()
+    new_texts = []
+    bytes_saved = []
+    for text in texts:
+        if text is None:
+            new_texts.append(None)
+            bytes_saved.append(0)
+            continue
+        kept = []
+        removed = 0
+        for line in text.splitlines():
+            key = " ".join(line.split())
+            if len(key) >= BOILERPLATE_MIN_LINE_CHARS:
+                if key in seen:
+                    removed += len(line.encode()) + 1
+                    continue
+                seen.add(key)
+            kept.append(line)
+        new_texts.append("\n".join(kept))
+        bytes_saved.append(removed)
+    return new_texts, bytes_saved
+
+
+def prepare_deduplicated_texts(file_paths, doc_type, requested_workers=None):
+    """Extract every uncached document of a batch and remove repeated boilerplate.
+
+    Returns {index: {"text", "raw_text", "note", "deduplicated"}} for process_document; deduplicated
+    is True when lines were removed, so the result depends on the batch. Documents that are cached,
+    already in the drawing register, or whose text cannot be extracted are left to the normal
+    path. Twice the usual extraction budget is read so that, once boilerplate is gone, the
+    prompt can still be filled.
+    """
+    model_names = select_model_candidates(doc_type)[0]
+    budget = extraction_char_budget(doc_type)
+    raw_budget = budget * 2 if budget else None
+
+    def extract(path):
+        try:
+            file_hash = hash_file(path)
+            if doc_type == "transmittal" and DRAWING_REGISTER_STORE and get_registered_drawing(file_hash):
+                return None
+            if get_cached_extraction(file_hash, doc_type, model_names):
+                return None
+        except OSError:
+            return None
+        text = extract_text(path, max_chars=raw_budget)
+        return None if text.startswith("Error:") else text
+
+    workers = extraction_worker_count(len(file_paths), requested_workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract') as executor:
+        texts = list(executor.map(extract, file_paths))
+    new_texts, bytes_saved = dedupe_batch_texts(texts)
+
+    prepared = {}
+    for index, (text, new_text, saved) in enumerate(zip(texts, new_texts, bytes_saved)):
+        if new_text is None:
+            continue
+        prepared[index] = {
+            "text": new_text,
+            "raw_text": text,
+            "note": f"✓ Text extracted ({len(text)} characters); removed {saved} bytes repeated on earlier pages or drawings in this batch",
+            "deduplicated": saved > 0
+        }
+    total_before = sum(len(t.encode()) for t in texts if t)
+    if total_before:
+        print(f"Batch deduplication: {sum(bytes_saved)} of {total_before} bytes removed across {len(prepared)} document(s)")
+    return prepared
+
+
+def collect_samples(department, form, files, model_actions):
+    """Resolve the files to process from a submitted form (samples, defaults and finance uploads).
+
+    Returns (selected_samples, samples, error_message); progress is appended to model_actions.
+    """
+    error_message = None
+    finance_defaults = []
+    finance_uploaded_paths = []
+    transmittal_defaults = []
+
+    # For engineering (radio buttons), get single value; for others handle custom logic
+    if department == 'engineering':
+        sample_value = form.get('samples')
+        selected_samples = [sample_value] if sample_value else []
+        model_actions.append(f"Engineering mode: sample_value from form = '{sample_value}'")
+    elif department == 'finance':
+        finance_defaults = form.getlist('finance_defaults')
+        selected_samples = finance_defaults.copy()
+        model_actions.append(f"Finance mode: auto-selecting {len(finance_defaults)} sample invoice(s)")
+    elif department == 'transmittal':
+        transmittal_defaults = form.getlist('transmittal_defaults')
+        selected_samples = transmittal_defaults.copy()
+        model_actions.append(f"Transmittal mode: auto-selecting {len(transmittal_defaults)} sample drawing(s)")
+    else:
+        selected_samples = form.getlist('samples')
+        model_actions.append(f"Non-engineering mode: selected_samples from form = {selected_samples}")
+    allowed_folder = DEPARTMENT_SAMPLES.get(department, {}).get("folder", "")
+
+    # Handle finance uploads
+    if department == 'finance':
+        uploaded_files = files.getlist('finance_uploads')
+        if uploaded_files:
+            model_actions.append(f"Finance mode: {len(uploaded_files)} uploaded file(s) received")
+        for file_storage in uploaded_files:
+            if not file_storage or not file_storage.filename:
+                continue
+            filename = secure_filename(file_storage.filename)
+            if not filename.lower().endswith('.pdf'):
+                error_message = "Only PDF files can be uploaded for Finance."
+                model_actions.append(f"✗ ERROR: {filename} rejected (not a PDF)")
+                break
+            file_path, duplicate = store_upload(file_storage, filename)
+            if file_path is None:
+                error_message = "Only PDF files can be uploaded for Finance."
+                model_actions.append(f"✗ ERROR: {filename} rejected (not a PDF document)")
+                break
+            finance_uploaded_paths.append(file_path)
+            if duplicate:
+                model_actions.append(f"✓ {filename} was uploaded before - reusing the stored copy: {file_path}")
+            else:
+                model_actions.append(f"✓ Uploaded invoice saved: {file_path}")
+        selected_samples.extend(finance_uploaded_paths)
+        if finance_uploaded_paths:
+            maybe_gc_uploads()
+
+    # Filter samples to only those matching the current department (skip for auto-select departments)
+    if department in ('finance', 'transmittal'):
+        samples = [sample for sample in selected_samples if sample]
+    else:
+        samples = [
+            sample for sample in selected_samples
+            if sample and SAMPLE_TO_DEPT.get(sample) == department
+        ]
+    # Log what was selected for debugging
+    if selected_samples:
+        model_actions.append(f"Selected samples: {selected_samples}")
+        for sample in selected_samples:
+            if sample:
+                dept_match = SAMPLE_TO_DEPT.get(sample, "NOT FOUND")
+                model_actions.append(f"  - {sample}: mapped to department '{dept_match}'")
+        model_actions.append(f"Filtered to department '{department}': {samples}")
+    else:
+        model_actions.append("No samples selected in form")
+
+    # Check if there's anything to process
+    if not samples:
+        if selected_samples:
+            error_message = f"No samples matched department '{department}'. Selected: {selected_samples}"
+            model_actions.append(f"✗ ERROR: {error_message}")
+        else:
+            error_message = "Please select at least one sample file."
+            model_actions.append(f"✗ ERROR: {error_message}")
+
+    return selected_samples, samples, error_message
+
+
+def shape_result_rows(entries, filename, department, model_actions):
+    """Turn one file's extracted entries into display/export rows tagged with the filename."""
+    results = []
+    if entries:
+        if department == "transmittal":
+            # Transmittal returns a single object with multiple arrays
+            if isinstance(entries, list) and len(entries) > 0 and isinstance(entries[0], dict):
+                transmittal_data = entries[0]
+                # Add filename to DrawingRegister (handle both dict and list)
+                if 'DrawingRegister' in transmittal_data:
+                    dr = transmittal_data['DrawingRegister']
+                    if isinstance(dr, dict):
+                        dr['Filename'] = filename
+                    elif isinstance(dr, list) and len(dr) > 0:
+                        for item in dr:
+                            if isinstance(item, dict):
+                                item['Filename'] = filename
+                # Add SourceDocument to all sub-arrays
+                for key in ['Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
+                    if key in transmittal_data and isinstance(transmittal_data[key], list):
+                        for item in transmittal_data[key]:
+                            if isinstance(item, dict):
+                                item['SourceDocument'] = filename
+                results.append(transmittal_data)
+                model_actions.append(f"✓ Extracted structured data from {filename}")
+            else:
+                # Fallback to old format
+                for entry in entries if isinstance(entries, list) else [entries]:
+                    entry['Filename'] = filename
+                    results.append(entry)
+                model_actions.append(f"✓ Extracted {len(entries)} row(s) from {filename}")
+        else:
+            model_actions.append(f"✓ Extracted {len(entries)} row(s) from {filename}")
+            for entry in entries:
+                entry['Filename'] = filename
+                if department == "finance":
+                    cost_value = entry.get('Cost')
+                    gst_value = entry.get('GST')
+                    final_value = entry.get('FinalAmount') or entry.get('Total')
+                    if final_value and not entry.get('FinalAmount'):
+                        entry['FinalAmount'] = final_value
+                    entry['CostFormatted'] = format_currency(cost_value) if cost_value not in ("", None, "N/A") else (cost_value or "N/A")
+                    entry['GST'] = gst_value if gst_value not in ("", None) else "N/A"
+                    entry['GSTFormatted'] = format_currency(gst_value) if gst_value not in ("", None, "N/A") else "N/A"
+                    entry['FinalAmountFormatted'] = format_currency(final_value) if final_value not in ("", None, "N/A") else (final_value or "N/A")
+                else:
+                    entry['TotalFormatted'] = format_currency(entry.get('Total', ''))
+                results.append(entry)
+    else:
+        model_actions.append(f"⚠ No data extracted from {filename}")
+    return results
+
+
+def aggregate_transmittal(results):
+    """Merge per-drawing transmittal objects into one dict of category lists and resolve cross-references."""
+    transmittal_aggregated = {
+        "DrawingRegister": [],
+        "Standards": [],
+        "Materials": [],
+        "Connections": [],
+        "Assumptions": [],
+        "VOSFlags": [],
+        "CrossReferences": []
+    }
+    for result in drop_superseded_sheets(results):
+        if isinstance(result, dict):
+            # Extract drawing register - handle both dict and list
+            if 'DrawingRegister' in result:
+                dr = result['DrawingRegister']
+                if isinstance(dr, dict):
+                    transmittal_aggregated["DrawingRegister"].append(dr)
+                elif isinstance(dr, list):
+                    transmittal_aggregated["DrawingRegister"].extend(dr)
+            # Aggregate arrays
+            for key in ['Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
+                if key in result and isinstance(result[key], list):
+                    transmittal_aggregated[key].extend(result[key])
+    resolve_cross_references(transmittal_aggregated)
+    return transmittal_aggregated
+
+
+# --- CROSS-REFERENCE RESOLVER ---
+# "See Detail D1/S-500" is resolved against the drawings in the same batch: one pass builds an
+# index of drawing numbers and their detail marks, a second looks every reference up in it.
+XREF_DRAWING_PATTERN = rf"\b{DRAWING_NUMBER_PATTERN}\b"
+XREF_DETAIL_PATTERN = r"\b(?:DETAIL|DET\.?|SECTION|SECT\.?)\s+([A-Z]{0,3}\d{1,3}[A-Z]?)\b|\b([A-Z]{1,3}\d{1,3}[A-Z]?)\s*/\s*" + XREF_DRAWING_PATTERN
+# Candidate detail marks, including hyphenated ones such as CBP-01, looked up in the detail index
+XREF_MARK_TOKEN_PATTERN = r"[A-Z0-9]+(?:-[A-Z0-9]+)*"
+
+
+def build_drawing_index(transmittal_aggregated):
+    """Return ({DwgNo: filename}, {filename: DwgNo}, {DwgNo: set of detail marks}) for a batch."""
+    drawings = {}
+    by_file = {}
+    for register in transmittal_aggregated.get("DrawingRegister", []):
+        if isinstance(register, dict) and register.get("DwgNo"):
+            number = str(register["DwgNo"]).strip().upper()
+            drawings[number] = register.get("Filename")
+            if register.get("Filename"):
+                by_file[register["Filename"]] = number
+    details = {number: set() for number in drawings}
+    for connection in transmittal_aggregated.get("Connections", []):
+        if not isinstance(connection, dict) or not connection.get("DetailMark"):
+            continue
+        # A connection detail lives on the sheet it references, else on the sheet it was read from
+        match = re.search(XREF_DRAWING_PATTERN, str(connection.get("DrawingRef") or "").upper())
+        number = match.group(0) if match else by_file.get(connection.get("SourceDocument"))
+        if number:
+            details.setdefault(number, set()).add(str(connection["DetailMark"]).strip().upper())
+    return drawings, by_file, details
+
+
+def resolve_cross_references(transmittal_aggregated):
+    """Fill TargetDrawing, TargetDetail, Found and Status on each CrossReferences row in place."""
+    references = transmittal_aggregated.get("CrossReferences") or []
+    if not references:
+        return
+    drawings, by_file, details = build_drawing_index(transmittal_aggregated)
+    mark_sheets = {}
+    for number, marks in details.items():
+        for mark in marks:
+            mark_sheets.setdefault(mark, set()).add(number)
+    for xref in references:
+        if not isinstance(xref, dict):
+            continue
+        source = by_file.get(xref.get("SourceDocument")) or str(xref.get("ReferencedIn") or "").strip().upper()
+        texts = [str(xref.get("RefersTo") or ""), str(xref.get("Reference") or "")]
+        targets = [number for text in texts for number in re.findall(XREF_DRAWING_PATTERN, text.upper())]
+        target = next((number for number in targets if number != source), targets[0] if targets else None)
+        detail = None
+        for text in texts:
+            match = re.search(XREF_DETAIL_PATTERN, text.upper())
+            if match:
+                detail = match.group(1) or match.group(2)
+                break
+        if detail is None:
+            # "Refer to CBP-01": a bare mark that a connection in the batch is listed under
+            tokens = [token for text in texts for token in re.findall(XREF_MARK_TOKEN_PATTERN, text.upper())]
+            detail = next((token for token in tokens if token in mark_sheets and token not in drawings), None)
+        if target is None and detail:
+            sheets = mark_sheets.get(detail, set())
+            if source in sheets or (source and not sheets):
+                target = source  # "See Detail D3" without a sheet refers to the same drawing
+            elif len(sheets) == 1:
+                target = next(iter(sheets))
+            elif sheets:
+                xref["TargetDrawing"] = "N/A"
+                xref["TargetDetail"] = detail
+                xref["Found"] = "N/A"
+                xref["Status"] = f"Ambiguous - detail {detail} is on {', '.join(sorted(sheets))}"
+                continue
+
+        xref["TargetDrawing"] = target or "N/A"
+        xref["TargetDetail"] = detail or "N/A"
+        if target is None:
+            xref["Found"] = "N/A"
+            xref["Status"] = "No drawing number in reference"
+        elif target not in drawings:
+            xref["Found"] = "No"
+            xref["Status"] = f"Dangling - {target} is not in this drawing set"
+        elif detail and detail in details.get(target, ()):
+            xref["Found"] = "Yes"
+            xref["Status"] = f"Resolved - detail {detail} on {target} ({drawings[target]})"
+        elif detail:
+            xref["Found"] = "Yes"
+            xref["Status"] = f"{target} is in the set ({drawings[target]}); detail {detail} not listed in its extracted connections"
+        else:
+            xref["Found"] = "Yes"
+            xref["Status"] = f"Resolved - {target} ({drawings[target]})"
+
+
+# --- DRAWING REGISTER STORE ---
+# Transmittal results are kept per drawing number with the hash of the file they came from.
+# A re-issued set only re-extracts the sheets whose bytes changed; a changed sheet replaces
+# the stored entry for its DwgNo and the old revision is recorded as superseded.
+DRAWING_REGISTER_STORE = env_flag('DRAWING_REGISTER_STORE', True)
+DRAWING_REGISTER_DB_PATH = os.environ.get('DRAWING_REGISTER_DB_PATH', os.path.join(DATA_DIR, 'drawing_register.sqlite3'))
+
+_drawing_register_ready = False
+
+
+def _open_drawing_register():
+    global _drawing_register_ready
+    conn = open_sqlite(DRAWING_REGISTER_DB_PATH)
+    if not _drawing_register_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS drawings (
+                dwg_no TEXT PRIMARY KEY,
+                rev TEXT,
+                title TEXT,
+                file_hash TEXT NOT NULL,
+                filename TEXT,
+                prompt_version TEXT NOT NULL,
+                model TEXT,
+                entry TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_drawings_hash ON drawings (file_hash)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS superseded (
+                dwg_no TEXT NOT NULL,
+                rev TEXT,
+                file_hash TEXT NOT NULL,
+                filename TEXT,
+                superseded_by_rev TEXT,
+                superseded_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+        _drawing_register_ready = True
+    return conn
+
+
+def revision_key(rev):
+    """Sort key for revisions: lettered (preliminary) revisions come before numbered ones."""
+    rev = str(rev or "").strip().upper()
+    if rev.isdigit():
+        return (1, int(rev), "")
+    return (0, len(rev), rev)
+
+
+def get_registered_drawing(file_hash):
+    """Stored transmittal entry for a file's exact bytes, or None.
+
+    Entries extracted with an older transmittal prompt are ignored, as in the extraction cache.
+    """
+    conn = _open_drawing_register()
+    try:
+        row = conn.execute(
+            "SELECT dwg_no, rev, model, entry FROM drawings WHERE file_hash = ? AND prompt_version = ?",
+            (file_hash, prompt_template_version("transmittal"))
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Drawing register read error: {e}")
+        return None
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {"dwg_no": row["dwg_no"], "rev": row["rev"], "model": row["model"], "entries": [json.loads(row["entry"])]}
+
+
+def register_drawing(file_hash, filename, entry, model_name):
+    """Store a transmittal entry under its DwgNo; returns an action note when it supersedes another revision.
+
+    An entry whose revision is older than the registered one leaves the register unchanged.
+    The read and the write run in one BEGIN IMMEDIATE transaction, so two workers registering
+    the same drawing cannot both supersede the old row.
+    """
+    register = entry.get("DrawingRegister") if isinstance(entry, dict) else None
+    dwg_no = str(register.get("DwgNo") or "").strip().upper() if isinstance(register, dict) else ""
+    if not dwg_no or dwg_no == "N/A":
+        return None
+    rev = str(register.get("Rev") or "").strip()
+    now = time.time()
+    note = None
+    conn = _open_drawing_register()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        previous = conn.execute("SELECT rev, file_hash, filename FROM drawings WHERE dwg_no = ?", (dwg_no,)).fetchone()
+        if previous and previous["file_hash"] != file_hash and revision_key(rev) < revision_key(previous["rev"]):
+            conn.rollback()
+            return f"{dwg_no} Rev {rev or '?'} is older than registered Rev {previous['rev'] or '?'} ({previous['filename']}) - register unchanged"
+        if previous and previous["file_hash"] != file_hash:
+            conn.execute(
+                "INSERT INTO superseded (dwg_no, rev, file_hash, filename, superseded_by_rev, superseded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (dwg_no, previous["rev"], previous["file_hash"], previous["filename"], rev, now)
+            )
+            note = f"✓ {dwg_no} re-issued: Rev {previous['rev'] or '?'} ({previous['filename']}) superseded by Rev {rev or '?'} in the drawing register"
+        conn.execute(
+            "INSERT OR REPLACE INTO drawings (dwg_no, rev, title, file_hash, filename, prompt_version, model, entry, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (dwg_no, rev, register.get("Title"), file_hash, filename, prompt_template_version("transmittal"),
+             model_name, json.dumps(entry), now)
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Drawing register write error for {dwg_no}: {e}")
+    finally:
+        conn.close()
+    return note
+
+
+def drop_superseded_sheets(results):
+    """Keep one per-drawing result per DwgNo (the highest revision, later files winning ties)."""
+    latest = {}
+    for position, result in enumerate(results):
+        register = result.get("DrawingRegister") if isinstance(result, dict) else None
+        dwg_no = str(register.get("DwgNo") or "").strip().upper() if isinstance(register, dict) else ""
+        if not dwg_no or dwg_no == "N/A":
+            continue
+        current = latest.get(dwg_no)
+        if current is None or revision_key(register.get("Rev")) >= revision_key(results[current]["DrawingRegister"].get("Rev")):
+            latest[dwg_no] = position
+    keep = set(latest.values())
+    kept = [
+        result for position, result in enumerate(results)
+        if position in keep or not isinstance(result, dict) or not isinstance(result.get("DrawingRegister"), dict)
+        or str(result["DrawingRegister"].get("DwgNo") or "").strip().upper() in ("", "N/A")
+    ]
+    if len(kept) < len(results):
+        print(f"Drawing register: dropped {len(results) - len(kept)} superseded sheet(s) from the transmittal")
+    return kept
+
+
+# --- RESULT STORE ---
+# Extraction results live server-side; the session cookie only carries an opaque result id,
+# so large engineering/transmittal result sets no longer blow past the ~4 KB cookie limit.
+RESULTS_DB_PATH = os.environ.get('RESULTS_DB_PATH', os.path.join(DATA_DIR, 'results.sqlite3'))
+RESULT_TTL_SECONDS = int(os.environ.get('RESULT_TTL_SECONDS', 24 * 3600))
+
+_result_store_ready = False
+
+
+def _open_result_store():
+    global _result_store_ready
+    conn = open_sqlite(RESULTS_DB_PATH)
+    if not _result_store_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_expiry ON results (expires_at)")
+        conn.commit()
+        _result_store_ready = True
+    return conn
+
+
+def save_results(data):
+    """Store a result set ({"department", "rows", ...}) and return its id."""
+    result_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _open_result_store()
+    try:
+        conn.execute("DELETE FROM results WHERE expires_at < ?", (now,))
+        conn.execute(
+            "INSERT INTO results (id, data, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (result_id, json.dumps(data), now, now + RESULT_TTL_SECONDS)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return result_id
+
+
+def load_results(result_id):
+    """Return a stored result set, or None if it is unknown or expired."""
+    if not result_id:
+        return None
+    conn = _open_result_store()
+    try:
+        row = conn.execute(
+            "SELECT data FROM results WHERE id = ? AND expires_at >= ?", (result_id, time.time())
+        ).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row["data"]) if row else None
+
+
+def load_session_results():
+    """Result set referenced by the current session (None if missing or expired)."""
+    # Drop results stored in the cookie by older versions
+    session.pop('last_results', None)
+    return load_results(session.get('last_results_id'))
+
+
+# --- EXTRACTION JOBS ---
+# POST /api/jobs returns immediately and the per-file pipeline runs on a background thread
+# pool. Progress lives in SQLite so any gunicorn worker can answer polling and SSE requests,
+# not just the one running the job.
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 24 * 3600))
+JOB_STREAM_POLL_SECONDS = 0.5
+JOB_STREAM_MAX_SECONDS = 100  # Stay under gunicorn's -t 120; EventSource reconnects automatically
+JOB_PARTIAL_WRITE_SECONDS = 1.0  # Partial streamed rows are saved at most this often per file
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+_job_store_ready = False
+
+
+def _open_job_store():
+    global _job_store_ready
+    conn = open_sqlite(JOBS_DB_PATH)
+    if not _job_store_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                department TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                schedule_type TEXT,
+                transmittal_data TEXT,
+                result_id TEXT,
+                worker_pid INTEGER,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                status TEXT NOT NULL,
+                model TEXT,
+                error TEXT,
+                rows TEXT NOT NULL DEFAULT '[]',
+                actions TEXT NOT NULL DEFAULT '[]',
+                attempts TEXT NOT NULL DEFAULT '[]',
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, position)
+            )
+        """)
+        # Job stores created before results were linked to jobs (or to workers) lack these columns
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("result_id", "TEXT"), ("worker_pid", "INTEGER")):
+            if column in columns:
+                continue
+            try:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            except sqlite3.OperationalError as e:
+                # Another worker may have added it first
+                if "duplicate column" not in str(e).lower():
+                    raise
+        conn.commit()
+        fail_interrupted_jobs(conn)
+        _job_store_ready = True
+    return conn
+
+
+def worker_is_alive(pid):
+    """True if a process with this pid is running on this host."""
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, but owned by another user
+    return True
+
+
+def fail_interrupted_jobs(conn):
+    """Mark queued/running jobs whose worker process is gone as failed.
+
+    Jobs run in a thread pool inside the worker that accepted them, so a restarted or killed
+    worker leaves its jobs behind. Runs once per process, when the job store is first opened.
+    """
+    rows = conn.execute("SELECT id, worker_pid FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+    interrupted = [row["id"] for row in rows if not worker_is_alive(row["worker_pid"])]
+    if not interrupted:
+        return
+    now = time.time()
+    error = "Interrupted: the worker running this job stopped before it finished - please resubmit"
+    for job_id in interrupted:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+            (error, now, job_id)
+        )
+        conn.execute(
+            "UPDATE job_files SET status = 'failed', error = ?, updated_at = ? WHERE job_id = ? AND status IN ('queued', 'running')",
+            ("Interrupted", now, job_id)
+        )
+    conn.commit()
+    print(f"Marked {len(interrupted)} interrupted job(s) as failed")
+
+
+def _get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+        return _job_executor
+
+
+def purge_expired_jobs():
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    conn = _open_job_store()
+    try:
+        conn.execute("DELETE FROM job_files WHERE job_id IN (SELECT id FROM jobs WHERE updated_at < ?)", (cutoff,))
+        conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def update_job(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    conn = _open_job_store()
+    try:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def update_job_file(job_id, position, **fields):
+    for name in ("rows", "actions", "attempts"):
+        if name in fields:
+            fields[name] = json.dumps(fields[name])
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    conn = _open_job_store()
+    try:
+        conn.execute(
+            f"UPDATE job_files SET {assignments} WHERE job_id = ? AND position = ?",
+            (*fields.values(), job_id, position)
+        )
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (fields["updated_at"], job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_job(job_id):
+    """Return a job with its per-file status, rows and action log, or None if unknown."""
+    conn = _open_job_store()
+    try:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        file_rows = conn.execute(
+            "SELECT * FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    files = []
+    rows = []
+    actions = []
+    for f in file_rows:
+        file_data = {
+            "position": f["position"],
+            "filename": f["filename"],
+            "status": f["status"],
+            "model": f["model"],
+            "error": f["error"],
+            "rows": json.loads(f["rows"]),
+            "actions": json.loads(f["actions"]),
+            "attempts": json.loads(f["attempts"]),
+            "updated_at": f["updated_at"]
+        }
+        files.append(file_data)
+        rows.extend(file_data["rows"])
+        actions.extend(file_data["actions"])
+
+    return {
+        "job_id": job["id"],
+        "department": job["department"],
+        "status": job["status"],
+        "error": job["error"],
+        "schedule_type": job["schedule_type"],
+        "transmittal_data": json.loads(job["transmittal_data"]) if job["transmittal_data"] else None,
+        "result_id": job["result_id"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "progress": {
+            "total": len(files),
+            "finished": sum(1 for f in files if f["status"] in ("done", "failed"))
+        },
+        "files": files,
+        "rows": rows,
+        "actions": actions
+    }
+
+
+def run_job(job_id, department, samples, concurrency=None):
+    """Background entry point: process every file and record progress as each one finishes."""
+    update_job(job_id, status="running")
+
+    def on_start(index, path):
+        update_job_file(job_id, index, status="running")
+
+    last_partial_write = {}
+
+    def on_rows(index, entries):
+        # Partial rows while Gemini is still streaming; replaced when the file completes
+        now = time.monotonic()
+        if now - last_partial_write.get(index, 0) < JOB_PARTIAL_WRITE_SECONDS:
+            return
+        last_partial_write[index] = now
+        rows = shape_result_rows([dict(e) for e in entries], os.path.basename(samples[index]), department, [])
+        update_job_file(job_id, index, rows=rows)
+
+    def on_complete(index, outcome):
+        file_actions = list(outcome["actions"])
+        rows = []
+        if outcome["analyzed"]:
+            rows = shape_result_rows(outcome["entries"], outcome["filename"], department, file_actions)
+        update_job_file(
+            job_id, index,
+            status="failed" if outcome["error"] else "done",
+            model=outcome["model"],
+            error=outcome["error"],
+            rows=rows,
+            actions=file_actions,
+            attempts=outcome["attempt_log"]
+        )
+
+    try:
+        outcomes = process_documents(samples, department, concurrency, on_start=on_start, on_complete=on_complete, on_rows=on_rows)
+        job = get_job(job_id)
+        schedule_type = next(
+            (o["schedule_type"] for o in outcomes if o["analyzed"] and o["entries"] and o["schedule_type"]), None
+        ) if department == "engineering" else None
+        transmittal_data = aggregate_transmittal(job["rows"]) if department == "transmittal" and job["rows"] else None
+        first_error = next((o["error"] for o in outcomes if o["error"]), None)
+        result_id = None
+        if job["rows"]:
+            result_data = {"department": department, "rows": job["rows"]}
+            if schedule_type:
+                result_data["schedule_type"] = schedule_type
+            if transmittal_data:
+                result_data["transmittal_aggregated"] = transmittal_data
+            result_id = save_results(result_data)
+        update_job(
+            job_id,
+            status="completed" if job["rows"] else "failed",
+            error=first_error,
+            schedule_type=schedule_type,
+            transmittal_data=json.dumps(transmittal_data) if transmittal_data else None,
+            result_id=result_id
+        )
+    except Exception as e:
+        print(f"Job {job_id} crashed: {type(e).__name__}: {e}")
+        import traceback
+        traceback.print_exc()
+        update_job(job_id, status="failed", error=f"{type(e).__name__}: {e}")
+
+
+def submit_job(department, samples, concurrency=None):
+    """Create a job for the given files, queue it on the background pool and return its id."""
+    purge_expired_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _open_job_store()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, department, status, worker_pid, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (job_id, department, os.getpid(), now, now)
+        )
+        conn.executemany(
+            "INSERT INTO job_files (job_id, position, path, filename, status, updated_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+            [(job_id, i, path, os.path.basename(path), now) for i, path in enumerate(samples)]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _get_job_executor().submit(run_job, job_id, department, samples, concurrency)
+    return job_id
+
+
+# --- INVOICE INGESTION ---
+# A mailbox rule (or anything else) can drop invoices into INGEST_WATCH_DIR. One process per
+# host holds the watcher lock and waits for each new PDF to stop changing, skips content it
+# has already seen, and runs it through process_document on a small pool. Results go to a
+# SQLite store served by /api/ingest/invoices. Form uploads are saved in a subfolder, which
+# the (non-recursive) watcher ignores.
+INGEST_WATCH = env_flag('INGEST_WATCH', False)
+INGEST_WATCH_DIR = os.environ.get('INGEST_WATCH_DIR', FINANCE_UPLOAD_DIR)
+INGEST_DB_PATH = os.environ.get('INGEST_DB_PATH', os.path.join(DATA_DIR, 'ingest.sqlite3'))
+INGEST_POLL_SECONDS = float(os.environ.get('INGEST_POLL_SECONDS', 5))
+INGEST_DEBOUNCE_SECONDS = float(os.environ.get('INGEST_DEBOUNCE_SECONDS', 5))
+INGEST_MAX_WORKERS = int(os.environ.get('INGEST_MAX_WORKERS', 2))
+
+_ingest_store_ready = False
+_ingest_lock_file = None
+
+
+def _open_ingest_store():
+    global _ingest_store_ready
+    conn = open_sqlite(INGEST_DB_PATH)
+    if not _ingest_store_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS invoices (
+                file_hash TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                model TEXT,
+                error TEXT,
+                rows TEXT NOT NULL DEFAULT '[]',
+                actions TEXT NOT NULL DEFAULT '[]',
+                duplicates INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_created ON invoices (created_at)")
+        conn.commit()
+        _ingest_store_ready = True
+    return conn
+
+
+def update_ingested(file_hash, **fields):
+    """Update an ingested invoice's row (rows/actions are JSON-encoded)."""
+    for key in ("rows", "actions"):
+        if key in fields:
+            fields[key] = json.dumps(fields[key])
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{key} = ?" for key in fields)
+    conn = _open_ingest_store()
+    try:
+        conn.execute(f"UPDATE invoices SET {assignments} WHERE file_hash = ?", (*fields.values(), file_hash))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def claim_ingested(file_hash, path):
+    """Record a new invoice as queued.
+
+    Returns "queued", "known" (this file was ingested before, e.g. seen again after a restart)
+    or "duplicate" (same content under another name; counted on the original's row).
+    """
+    now = time.time()
+    conn = _open_ingest_store()
+    try:
+        existing = conn.execute("SELECT path FROM invoices WHERE file_hash = ?", (file_hash,)).fetchone()
+        if existing is None:
+            conn.execute(
+                "INSERT INTO invoices (file_hash, filename, path, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (file_hash, os.path.basename(path), path, now, now)
+            )
+            result = "queued"
+        elif existing["path"] == path:
+            result = "known"
+        else:
+            conn.execute("UPDATE invoices SET duplicates = duplicates + 1 WHERE file_hash = ?", (file_hash,))
+            result = "duplicate"
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+
+def list_ingested(status=None, limit=100):
+    """Most recent ingested invoices, newest first."""
+    query = "SELECT * FROM invoices"
+    params = []
+    if status:
+        query += " WHERE status = ?"
+        params.append(status)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(limit)
+    conn = _open_ingest_store()
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    return [
+        dict(row, rows=json.loads(row["rows"]), actions=json.loads(row["actions"]))
+        for row in rows
+    ]
+
+
+def ingest_invoice(path, file_hash):
+    """Run one queued invoice through the normal finance pipeline and store the outcome."""
+    update_ingested(file_hash, status="processing")
+    try:
+        outcome = process_document(path, "finance")
+    except Exception as e:
+        print(f"Ingestion error for {path}: {type(e).__name__}: {e}")
+        update_ingested(file_hash, status="error", error=f"{type(e).__name__}: {e}")
+        return
+    rows = [dict(entry, Filename=outcome["filename"]) for entry in outcome["entries"] if isinstance(entry, dict)]
+    update_ingested(
+        file_hash,
+        status="error" if outcome["error"] else "done",
+        model=outcome["model"],
+        error=outcome["error"],
+        rows=rows,
+        actions=outcome["actions"]
+    )
+    print(f"Ingested {outcome['filename']}: {'error - ' + outcome['error'] if outcome['error'] else outcome['model']}")
+
+
+def _acquire_ingest_lock():
+    """Hold the watcher lock for the life of this process; returns whether this process is the watcher."""
+    global _ingest_lock_file
+    if fcntl is None:
+        return False
+    lock_file = open(f"{INGEST_DB_PATH}.lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    _ingest_lock_file = lock_file
+    return True
+
+
+def _watch_events(inotify, timeout_seconds):
+    """Names reported by inotify within the timeout (empty when polling)."""
+    if inotify is None:
+        time.sleep(timeout_seconds)
+        return set()
+    return {event.name for event in inotify.read(timeout=int(timeout_seconds * 1000)) if event.name}
+
+
+def run_ingest_watcher():
+    """Watch INGEST_WATCH_DIR and ingest new PDFs (runs forever on a daemon thread)."""
+    if fcntl is None:
+        # Without file locks every worker would watch and ingest the same files
+        print("Ingestion watcher not started: file locking (fcntl) is unavailable on this platform")
+        return
+    while not _acquire_ingest_lock():
+        time.sleep(INGEST_POLL_SECONDS * 12)  # another worker is watching; take over if it exits
+    os.makedirs(INGEST_WATCH_DIR, exist_ok=True)
+    inotify = None
+    if INotify is not None:
+        try:
+            inotify = INotify()
+            inotify.add_watch(INGEST_WATCH_DIR, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE)
+        except OSError as e:
+            print(f"inotify unavailable ({e}) - polling {INGEST_WATCH_DIR} instead")
+            inotify = None
+    print(f"Ingestion watcher started on {INGEST_WATCH_DIR} ({'inotify' if inotify else 'polling'}, pid {os.getpid()})")
+
+    executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix='ingest')
+    # Invoices left queued or half-processed by a previous watcher are picked up again
+    for row in list_ingested(status="queued", limit=10000) + list_ingested(status="processing", limit=10000):
+        if os.path.exists(row["path"]):
+            executor.submit(ingest_invoice, row["path"], row["file_hash"])
+
+    pending = {}  # path -> (size, mtime, stable since)
+    handled = {}  # path -> (size, mtime) already hashed
+    names = set(os.listdir(INGEST_WATCH_DIR))
+    last_scan = time.time()
+    while True:
+        try:
+            for name in names:
+                path = os.path.join(INGEST_WATCH_DIR, name)
+                if name.lower().endswith(".pdf") and os.path.isfile(path) and path not in pending:
+                    pending[path] = (None, None, None)
+            now = time.time()
+            for path, (size, mtime, since) in list(pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    pending.pop(path)
+                    continue
+                signature = (stat.st_size, stat.st_mtime)
+                if handled.get(path) == signature:
+                    pending.pop(path)
+                elif signature != (size, mtime):
+                    pending[path] = (*signature, now)  # still being written: restart the debounce
+                elif stat.st_size and now - since >= INGEST_DEBOUNCE_SECONDS:
+                    pending.pop(path)
+                    handled[path] = signature
+                    file_hash = hash_file(path)
+                    claim = claim_ingested(file_hash, path)
+                    if claim == "queued":
+                        executor.submit(ingest_invoice, path, file_hash)
+                    elif claim == "duplicate":
+                        print(f"Ingestion: {os.path.basename(path)} has the same content as an invoice already ingested - skipped")
+            wait_seconds = min(INGEST_POLL_SECONDS, INGEST_DEBOUNCE_SECONDS) if pending else INGEST_POLL_SECONDS
+            names = _watch_events(inotify, wait_seconds)
+            if inotify is None or time.time() - last_scan >= INGEST_POLL_SECONDS * 12:
+                # Polling mode, plus a periodic rescan in case an inotify event was missed
+                names |= set(os.listdir(INGEST_WATCH_DIR))
+                handled = {path: signature for path, signature in handled.items() if os.path.exists(path)}
+                last_scan = time.time()
+        except Exception as e:
+            print(f"Ingestion watcher error: {type(e).__name__}: {e}")
+            time.sleep(INGEST_POLL_SECONDS)
+            names = set()
+
+
+# --- UPLOAD STORAGE ---
+# Multipart file parts are streamed straight to a spool file on disk while being hashed, with
+# a per-file limit checked as the bytes arrive (Flask's MAX_CONTENT_LENGTH covers the whole
+# request). Uploads are then stored content-addressed as <sha256>/<filename>, so the same
+# invoice uploaded twice is kept once, and old uploads are removed by age and a size quota.
+UPLOAD_STORE_DIR = FINANCE_FORM_UPLOAD_DIR
+UPLOAD_SPOOL_DIR = os.path.join(UPLOAD_STORE_DIR, '.spool')
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get('UPLOAD_MAX_FILE_BYTES', 20 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get('UPLOAD_MAX_REQUEST_BYTES', 100 * 1024 * 1024))
+UPLOAD_RETENTION_SECONDS = int(os.environ.get('UPLOAD_RETENTION_SECONDS', 7 * 24 * 3600))
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', 500 * 1024 * 1024))
+UPLOAD_GC_INTERVAL_SECONDS = 600
+UPLOAD_GC_MIN_AGE_SECONDS = 3600  # the quota never evicts uploads a queued job may still need
+
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_REQUEST_BYTES
+
+_upload_gc_lock = threading.Lock()
+_last_upload_gc = 0.0
+
+
+def upload_limit_message():
+    return (f"Upload too large: each file may be up to {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} MB "
+            f"and each request up to {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} MB.")
+
+
+class HashingSpool:
+    """Writable upload stream backed by a file in UPLOAD_SPOOL_DIR that hashes what is written."""
+
+    def __init__(self):
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, prefix='upload-', delete=False)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            self.close()
+            raise RequestEntityTooLarge(upload_limit_message())
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def close(self):
+        """Close and delete the spool file (a no-op once store_upload has moved it)."""
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class HashingRequest(Request):
+    """Request that spools every uploaded file to disk through a HashingSpool."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpool()
+
+
+app.request_class = HashingRequest
+
+
+def store_upload(file_storage, filename):
+    """Move an uploaded PDF into content-addressed storage.
+
+    Returns (path, duplicate); duplicate is True when the same bytes were already stored, in
+    which case the new copy is discarded. The path always ends in the submitted filename: a
+    repeat upload under another name is hard-linked to the stored copy. Returns (None, False)
+    if the upload is not a PDF.
+    """
+    spool = file_storage.stream
+    if not isinstance(spool, HashingSpool):
+        # Parts small enough to stay in memory (or streams from other callers)
+        spool = HashingSpool()
+        for chunk in iter(lambda: file_storage.stream.read(64 * 1024), b""):
+            spool.write(chunk)
+    spool.seek(0)
+    if spool.read(5) != b"%PDF-":
+        spool.close()
+        return None, False
+    spool.flush()
+    folder = os.path.join(UPLOAD_STORE_DIR, spool.sha256.hexdigest())
+    path = os.path.join(folder, filename)
+    try:
+        existing = sorted(os.listdir(folder))
+    except OSError:
+        existing = []
+    if existing:
+        try:
+            os.utime(folder)  # a fresh upload keeps the stored copy from ageing out
+            if filename not in existing:
+                _link_upload(os.path.join(folder, existing[0]), path)
+        except OSError:
+            pass
+        # gc_uploads in another worker may have removed the folder meanwhile; if so, store this copy
+        if os.path.exists(path):
+            spool.close()
+            return path, True
+    os.makedirs(folder, exist_ok=True)
+    spool.file.close()
+    os.replace(spool.file.name, path)
+    return path, False
+
+
+def _link_upload(source, target):
+    """Give a stored upload a second name without copying it, where the filesystem allows."""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _upload_entry_size(path):
+    if os.path.isdir(path):
+        # Names hard-linked by store_upload share one inode and are counted once
+        stats = {(st.st_dev, st.st_ino): st.st_size for st in (os.stat(os.path.join(path, name)) for name in os.listdir(path))}
+        return sum(stats.values())
+    return os.path.getsize(path)
+
+
+def gc_uploads():
+    """Delete uploads older than UPLOAD_RETENTION_SECONDS, then the oldest ones over UPLOAD_QUOTA_BYTES."""
+    now = time.time()
+    removed = 0
+    entries = []
+    for name in os.listdir(UPLOAD_STORE_DIR):
+        path = os.path.join(UPLOAD_STORE_DIR, name)
+        try:
+            if name == '.spool':
+                # Spool files left behind by interrupted requests
+                for spool_name in os.listdir(path):
+                    spool_path = os.path.join(path, spool_name)
+                    if now - os.path.getmtime(spool_path) > 24 * 3600:
+                        os.remove(spool_path)
+                continue
+            mtime = os.path.getmtime(path)
+            if now - mtime > UPLOAD_RETENTION_SECONDS:
+                shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+                removed += 1
+            else:
+                entries.append((mtime, path, _upload_entry_size(path)))
+        except OSError:
+            continue  # removed by another worker meanwhile
+    total = sum(size for _, _, size in entries)
+    for mtime, path, size in sorted(entries):
+        if total <= UPLOAD_QUOTA_BYTES or now - mtime < UPLOAD_GC_MIN_AGE_SECONDS:
+            break
+        shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+        total -= size
+        removed += 1
+    if removed:
+        print(f"Upload GC: removed {removed} upload(s); {total} bytes remain in {UPLOAD_STORE_DIR}")
+    return removed
+
+
+def maybe_gc_uploads():
+    """Run gc_uploads at most once per UPLOAD_GC_INTERVAL_SECONDS in this process."""
+    global _last_upload_gc
+    if time.time() - _last_upload_gc < UPLOAD_GC_INTERVAL_SECONDS or not _upload_gc_lock.acquire(blocking=False):
+        return
+    try:
+        _last_upload_gc = time.time()
+        gc_uploads()
+    except OSError as e:
+        print(f"Upload GC error: {e}")
+    finally:
+        _upload_gc_lock.release()
+
+
 # --- ROUTES ---
 # Serve static assets (CSS, JS, images)
 @app.route('/assets/<path:filename>')
@@ -1933,7 +5504,7 @@ def search_blog_rag():
         
         # Step 3: Use Gemini to generate answer based on retrieved context
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
+            model = get_model(ASSISTANT_MODEL)
             
             prompt = f"""You are a helpful assistant for Curam-Ai Protocol™, an AI document automation service for engineering firms.
 
@@ -1967,6 +5538,7 @@ Answer the question comprehensively:"""
             })
             
         except Exception as e:
+            report_model_error(e)
             return jsonify({
                 'answer': f"I encountered an error processing your question. Please visit www.curam-ai.com.au to search for information about '{query}'.",
                 'sources': sources,
@@ -2114,7 +5686,7 @@ Keep responses concise (2-3 sentences per paragraph), friendly, and focused on u
         conversation.append({"role": "user", "parts": [message]})
         
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
+            model = get_model(ASSISTANT_MODEL)
             
             # Generate response
             response = model.generate_content(conversation)
@@ -2174,6 +5746,7 @@ Keep responses concise (2-3 sentences per paragraph), friendly, and focused on u
             
         except Exception as e:
             app.logger.error(f"Gemini generation failed for contact assistant: {e}")
+            report_model_error(e)
             return jsonify({
                 'message': "I'm here to help! Could you tell me more about your document automation needs?",
                 'error': str(e)
@@ -2243,7 +5816,7 @@ Message to analyze:
 """
         
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
+            model = get_model(ASSISTANT_MODEL)
             
             # Generate relevance analysis
             full_prompt = relevance_prompt + message
@@ -2272,6 +5845,7 @@ Message to analyze:
             
         except Exception as e:
             app.logger.error(f"Gemini relevance check failed: {e}")
+            report_model_error(e)
             # Fallback to allowing submission
             return jsonify({
                 'is_relevant': True,
@@ -2853,6 +6427,7 @@ def index_automater():
     model_actions = []
     detected_schedule_type = None
     selected_samples = []
+    saved = None
 
     # Default to DEFAULT_DEPARTMENT if still not set
     if not department:
@@ -2860,7 +6435,11 @@ def index_automater():
 
     # Load results from session on GET requests (only if department matches)
     if request.method == 'GET':
-        saved = session.get('last_results')
+        # Results of a background job can be opened via ?result_id=...
+        requested_result_id = request.args.get('result_id')
+        if requested_result_id and load_results(requested_result_id):
+            session['last_results_id'] = requested_result_id
+        saved = load_session_results()
         if saved:
             saved_department = saved.get('department')
             # Only load from session if department matches (respect user's selection)
@@ -2877,188 +6456,35 @@ def index_automater():
         # Log the department received
         model_actions.append(f"POST request received. Department from form: '{department}'")
         
-        finance_defaults = []
-        finance_uploaded_paths = []
-        transmittal_defaults = []
-
-        # For engineering (radio buttons), get single value; for others handle custom logic
-        if department == 'engineering':
-            sample_value = request.form.get('samples')
-            selected_samples = [sample_value] if sample_value else []
-            model_actions.append(f"Engineering mode: sample_value from form = '{sample_value}'")
-        elif department == 'finance':
-            finance_defaults = request.form.getlist('finance_defaults')
-            selected_samples = finance_defaults.copy()
-            model_actions.append(f"Finance mode: auto-selecting {len(finance_defaults)} sample invoice(s)")
-        elif department == 'transmittal':
-            transmittal_defaults = request.form.getlist('transmittal_defaults')
-            selected_samples = transmittal_defaults.copy()
-            model_actions.append(f"Transmittal mode: auto-selecting {len(transmittal_defaults)} sample drawing(s)")
-        else:
-            selected_samples = request.form.getlist('samples')
-            model_actions.append(f"Non-engineering mode: selected_samples from form = {selected_samples}")
-        allowed_folder = DEPARTMENT_SAMPLES.get(department, {}).get("folder", "")
-        
-        # Handle finance uploads
-        if department == 'finance':
-            uploaded_files = request.files.getlist('finance_uploads')
-            if uploaded_files:
-                model_actions.append(f"Finance mode: {len(uploaded_files)} uploaded file(s) received")
-            for file_storage in uploaded_files:
-                if not file_storage or not file_storage.filename:
-                    continue
-                filename = secure_filename(file_storage.filename)
-                if not filename.lower().endswith('.pdf'):
-                    error_message = "Only PDF files can be uploaded for Finance."
-                    model_actions.append(f"✗ ERROR: {filename} rejected (not a PDF)")
-                    break
-                unique_name = f"{int(time.time() * 1000)}_{filename}"
-                file_path = os.path.join(FINANCE_UPLOAD_DIR, unique_name)
-                file_storage.save(file_path)
-                finance_uploaded_paths.append(file_path)
-                model_actions.append(f"✓ Uploaded invoice saved: {file_path}")
-            selected_samples.extend(finance_uploaded_paths)
-
-        # Filter samples to only those matching the current department (skip for auto-select departments)
-        if department in ('finance', 'transmittal'):
-            samples = [sample for sample in selected_samples if sample]
-        else:
-            samples = [
-                sample for sample in selected_samples
-                if sample and SAMPLE_TO_DEPT.get(sample) == department
-            ]
-        # Log what was selected for debugging
-        if selected_samples:
-            model_actions.append(f"Selected samples: {selected_samples}")
-            for sample in selected_samples:
-                if sample:
-                    dept_match = SAMPLE_TO_DEPT.get(sample, "NOT FOUND")
-                    model_actions.append(f"  - {sample}: mapped to department '{dept_match}'")
-            model_actions.append(f"Filtered to department '{department}': {samples}")
-        else:
-            model_actions.append("No samples selected in form")
-
-        # Check if there's anything to process
-        if not samples:
-            if selected_samples:
-                error_message = f"No samples matched department '{department}'. Selected: {selected_samples}"
-                model_actions.append(f"✗ ERROR: {error_message}")
-            else:
-                error_message = "Please select at least one sample file."
-                model_actions.append(f"✗ ERROR: {error_message}")
+        selected_samples, samples, error_message = collect_samples(department, request.form, request.files, model_actions)
 
         if not error_message:
             if samples:
-                model_actions.append(f"Processing {len(samples)} sample file(s)")
-                for sample_path in samples:
-                    if not os.path.exists(sample_path):
-                        error_msg = f"File not found: {sample_path}"
-                        model_actions.append(f"✗ {error_msg}")
-                        if not error_message:
-                            error_message = error_msg
+                concurrency = request.form.get('concurrency', type=int)
+                model_actions.append(f"Processing {len(samples)} sample file(s) with up to {extraction_worker_count(len(samples), concurrency)} in parallel")
+                for outcome in process_documents(samples, department, concurrency):
+                    filename = outcome["filename"]
+                    model_actions.extend(outcome["actions"])
+                    if outcome["attempt_log"]:
+                        model_attempts.extend(outcome["attempt_log"])
+                    if outcome["model"]:
+                        last_model_used = outcome["model"]
+                    if outcome["error"] and not error_message:
+                        error_message = outcome["error"]
+                    if not outcome["analyzed"]:
                         continue
-                
-                    filename = os.path.basename(sample_path)
-                    model_actions.append(f"Processing file: {filename} (path: {sample_path})")
-                    model_actions.append(f"Extracting text from {filename}")
-                    text = extract_text(sample_path)
-                    if text.startswith("Error:"):
-                        model_actions.append(f"✗ Text extraction failed for {filename}: {text}")
-                        if not error_message:
-                            error_message = f"Text extraction failed for {filename}"
-                        continue
-                    else:
-                        model_actions.append(f"✓ Text extracted successfully ({len(text)} characters)")
-                    
-                    model_actions.append(f"Analyzing {filename} with AI models")
-                    entries, api_error, model_used, attempt_log, file_action_log, schedule_type = analyze_gemini(text, department)
-                    if file_action_log:
-                        model_actions.extend(file_action_log)
-                    if model_used:
-                        last_model_used = model_used
-                        model_actions.append(f"✓ Successfully processed {filename} with {model_used}")
-                    if attempt_log:
-                        model_attempts.extend(attempt_log)
-                    if api_error:
-                        model_actions.append(f"✗ Failed to process {filename}: {api_error}")
-                        if not error_message:
-                            error_message = api_error
-                    if entries:
-                        if department == "transmittal":
-                            # Transmittal returns a single object with multiple arrays
-                            if isinstance(entries, list) and len(entries) > 0 and isinstance(entries[0], dict):
-                                transmittal_data = entries[0]
-                                # Add filename to DrawingRegister (handle both dict and list)
-                                if 'DrawingRegister' in transmittal_data:
-                                    dr = transmittal_data['DrawingRegister']
-                                    if isinstance(dr, dict):
-                                        dr['Filename'] = filename
-                                    elif isinstance(dr, list) and len(dr) > 0:
-                                        for item in dr:
-                                            if isinstance(item, dict):
-                                                item['Filename'] = filename
-                                # Add SourceDocument to all sub-arrays
-                                for key in ['Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
-                                    if key in transmittal_data and isinstance(transmittal_data[key], list):
-                                        for item in transmittal_data[key]:
-                                            if isinstance(item, dict):
-                                                item['SourceDocument'] = filename
-                                results.append(transmittal_data)
-                                model_actions.append(f"✓ Extracted structured data from {filename}")
-                            else:
-                                # Fallback to old format
-                                for entry in entries if isinstance(entries, list) else [entries]:
-                                    entry['Filename'] = filename
-                                    results.append(entry)
-                                model_actions.append(f"✓ Extracted {len(entries)} row(s) from {filename}")
-                        else:
-                            model_actions.append(f"✓ Extracted {len(entries)} row(s) from {filename}")
-                            for entry in entries:
-                                entry['Filename'] = filename
-                                if department == "finance":
-                                    cost_value = entry.get('Cost')
-                                    gst_value = entry.get('GST')
-                                    final_value = entry.get('FinalAmount') or entry.get('Total')
-                                    if final_value and not entry.get('FinalAmount'):
-                                        entry['FinalAmount'] = final_value
-                                    entry['CostFormatted'] = format_currency(cost_value) if cost_value not in ("", None, "N/A") else (cost_value or "N/A")
-                                    entry['GST'] = gst_value if gst_value not in ("", None) else "N/A"
-                                    entry['GSTFormatted'] = format_currency(gst_value) if gst_value not in ("", None, "N/A") else "N/A"
-                                    entry['FinalAmountFormatted'] = format_currency(final_value) if final_value not in ("", None, "N/A") else (final_value or "N/A")
-                                else:
-                                    entry['TotalFormatted'] = format_currency(entry.get('Total', ''))
-                                results.append(entry)
-                            # Store schedule type for engineering documents (use first detected type)
-                            if department == "engineering" and schedule_type and not detected_schedule_type:
-                                detected_schedule_type = schedule_type
-                    else:
-                        model_actions.append(f"⚠ No data extracted from {filename}")
+                    entries = outcome["entries"]
+                    schedule_type = outcome["schedule_type"]
+                    rows = shape_result_rows(entries, filename, department, model_actions)
+                    results.extend(rows)
+                    # Store schedule type for engineering documents (use first detected type)
+                    if department == "engineering" and rows and schedule_type and not detected_schedule_type:
+                        detected_schedule_type = schedule_type
 
         # Aggregate transmittal data into structured categories
         transmittal_aggregated = None
         if department == "transmittal" and results:
-            transmittal_aggregated = {
-                "DrawingRegister": [],
-                "Standards": [],
-                "Materials": [],
-                "Connections": [],
-                "Assumptions": [],
-                "VOSFlags": [],
-                "CrossReferences": []
-            }
-            for result in results:
-                if isinstance(result, dict):
-                    # Extract drawing register - handle both dict and list
-                    if 'DrawingRegister' in result:
-                        dr = result['DrawingRegister']
-                        if isinstance(dr, dict):
-                            transmittal_aggregated["DrawingRegister"].append(dr)
-                        elif isinstance(dr, list):
-                            transmittal_aggregated["DrawingRegister"].extend(dr)
-                    # Aggregate arrays
-                    for key in ['Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
-                        if key in result and isinstance(result[key], list):
-                            transmittal_aggregated[key].extend(result[key])
+            transmittal_aggregated = aggregate_transmittal(results)
 
         if results:
             session_data = {"department": department, "rows": results}
@@ -3066,49 +6492,28 @@ def index_automater():
                 session_data["schedule_type"] = detected_schedule_type
             if transmittal_aggregated:
                 session_data["transmittal_aggregated"] = transmittal_aggregated
-            session['last_results'] = session_data
+            session['last_results_id'] = save_results(session_data)
+            saved = session_data
         else:
-            session.pop('last_results', None)
+            session.pop('last_results_id', None)
+            saved = None
 
     # Get schedule type from session or detected value
     schedule_type = None
     if department == "engineering":
-        saved = session.get('last_results', {})
-        schedule_type = saved.get('schedule_type')
+        schedule_type = (saved or {}).get('schedule_type')
         if not schedule_type and 'detected_schedule_type' in locals() and detected_schedule_type:
             schedule_type = detected_schedule_type
     
     # Get aggregated transmittal data
     transmittal_data = None
     if department == "transmittal":
-        saved = session.get('last_results', {})
-        transmittal_data = saved.get('transmittal_aggregated')
+        transmittal_data = (saved or {}).get('transmittal_aggregated')
         if not transmittal_data and 'transmittal_aggregated' in locals():
             transmittal_data = transmittal_aggregated
         # If still no transmittal_data, try to aggregate from results
         if not transmittal_data and results:
-            transmittal_data = {
-                "DrawingRegister": [],
-                "Standards": [],
-                "Materials": [],
-                "Connections": [],
-                "Assumptions": [],
-                "VOSFlags": [],
-                "CrossReferences": []
-            }
-            for result in results:
-                if isinstance(result, dict):
-                    # Extract drawing register - handle both dict and list
-                    if 'DrawingRegister' in result:
-                        dr = result['DrawingRegister']
-                        if isinstance(dr, dict):
-                            transmittal_data["DrawingRegister"].append(dr)
-                        elif isinstance(dr, list):
-                            transmittal_data["DrawingRegister"].extend(dr)
-                    # Aggregate arrays
-                    for key in ['Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
-                        if key in result and isinstance(result[key], list):
-                            transmittal_data[key].extend(result[key])
+            transmittal_data = aggregate_transmittal(results)
         # Ensure all keys are lists, not None
         if transmittal_data and isinstance(transmittal_data, dict):
             for key in ['DrawingRegister', 'Standards', 'Materials', 'Connections', 'Assumptions', 'VOSFlags', 'CrossReferences']:
@@ -3134,7 +6539,7 @@ def index_automater():
 @app.route('/export_csv')
 def export_csv():
     """Export results as CSV"""
-    saved = session.get('last_results')
+    saved = load_session_results()
     if not saved or not saved.get('rows'):
         return "No data to export", 404
 
@@ -3184,7 +6589,7 @@ def export_csv():
 @app.route('/export_transmittal_csv')
 def export_transmittal_csv():
     """Export a specific transmittal category as CSV"""
-    saved = session.get('last_results')
+    saved = load_session_results()
     if not saved:
         return "No data to export", 404
     
@@ -3252,6 +6657,151 @@ def export_transmittal_csv():
     return response
 
 
+@app.route('/api/jobs', methods=['POST'])
+def create_extraction_job():
+    """Queue an extraction job for the same form fields /extract accepts; returns immediately"""
+    department = request.form.get('department') or DEFAULT_DEPARTMENT
+    model_actions = []
+    selected_samples, samples, error_message = collect_samples(department, request.form, request.files, model_actions)
+    if error_message:
+        return jsonify({'error': error_message, 'actions': model_actions}), 400
+
+    job_id = submit_job(department, samples, request.form.get('concurrency', type=int))
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'files': [os.path.basename(path) for path in samples],
+        'status_url': url_for('extraction_job_status', job_id=job_id),
+        'stream_url': url_for('extraction_job_stream', job_id=job_id)
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>')
+def extraction_job_status(job_id):
+    """Poll a job: per-file status, rows extracted so far and the model action log"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['result_id']:
+        job['results_url'] = url_for('automater', department=job['department'], result_id=job['result_id'])
+    return jsonify(job)
+
+
+@app.route('/api/jobs/<job_id>/stream')
+def extraction_job_stream(job_id):
+    """Server-Sent Events feed of a job's progress (events: job, file, done, error)
+
+    While a file is running, its file events carry only the rows added since the last
+    event, starting at rows_offset. The event for a finished file carries all of its rows.
+    """
+    if not get_job(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    results_base = url_for('automater')
+
+    def generate():
+        yield "retry: 2000\n\n"
+        sent_files = {}
+        sent_rows = {}
+        sent_status = None
+        deadline = time.time() + JOB_STREAM_MAX_SECONDS
+        while time.time() < deadline:
+            job = get_job(job_id)
+            if not job:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+            if job["status"] != sent_status:
+                sent_status = job["status"]
+                yield f"event: job\ndata: {json.dumps({'status': job['status'], 'progress': job['progress']})}\n\n"
+            for file_data in job["files"]:
+                position = file_data["position"]
+                marker = (file_data["status"], file_data["updated_at"])
+                if sent_files.get(position) == marker:
+                    continue
+                sent_files[position] = marker
+                offset = sent_rows.get(position, 0)
+                if file_data["status"] == "running" and len(file_data["rows"]) >= offset:
+                    file_data = {
+                        "position": position,
+                        "filename": file_data["filename"],
+                        "status": file_data["status"],
+                        "rows_offset": offset,
+                        "rows": file_data["rows"][offset:]
+                    }
+                    sent_rows[position] = offset + len(file_data["rows"])
+                else:
+                    file_data["rows_offset"] = 0
+                    sent_rows[position] = len(file_data["rows"])
+                yield f"event: file\ndata: {json.dumps(file_data)}\n\n"
+            if job["status"] in ("completed", "failed"):
+                if job["result_id"]:
+                    job["results_url"] = f"{results_base}?department={quote(job['department'])}&result_id={job['result_id']}"
+                # Files and rows have already been sent; the status URL has the full job
+                done = {key: value for key, value in job.items() if key not in ("files", "rows")}
+                yield f"event: done\ndata: {json.dumps(done)}\n\n"
+                return
+            time.sleep(JOB_STREAM_POLL_SECONDS)
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    """Reject oversized uploads (per file or per request) with a readable message"""
+    if request.path.startswith('/api/'):
+        return jsonify({'error': upload_limit_message()}), 413
+    return upload_limit_message(), 413
+
+
+def admin_auth_error():
+    """Error response for an admin request without the right token, or None when allowed.
+
+    The admin endpoints are disabled (404) unless ADMIN_TOKEN is set.
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    token = request.headers.get('X-Admin-Token', request.args.get('token')) or ''
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+
+@app.route('/api/ingest/invoices')
+def ingested_invoices():
+    """Invoices picked up from the ingestion folder, newest first (?status=done|error|queued|processing&limit=N)"""
+    denied = admin_auth_error()
+    if denied:
+        return denied
+    try:
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    return jsonify({
+        'watching': INGEST_WATCH,
+        'directory': INGEST_WATCH_DIR,
+        'invoices': list_ingested(request.args.get('status'), limit)
+    })
+
+
+@app.route('/api/admin/model-health')
+def model_health():
+    """Per-model latency percentiles, error/timeout rates and circuit state for this worker"""
+    denied = admin_auth_error()
+    if denied:
+        return denied
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'breaker': {
+            'failures_to_open': MODEL_BREAKER_FAILURES,
+            'cooldown_seconds': MODEL_BREAKER_COOLDOWN_SECONDS
+        },
+        'models': model_health_snapshot()
+    })
+
+
 @app.route('/sample')
 def view_sample():
     requested = request.args.get('path')
@@ -3318,6 +6868,14 @@ except Exception as e:
     import traceback
     traceback.print_exc()
 
+# Warm the Gemini clients in the background so worker boot is not delayed
+if GEMINI_CLIENT_WARMUP:
+    threading.Thread(target=warm_model_clients, name='gemini-warmup', daemon=True).start()
+
+# Every worker starts the watcher thread; only the one holding the lock file watches
+if INGEST_WATCH:
+    threading.Thread(target=run_ingest_watcher, name='ingest-watcher', daemon=True).start()
+
 if __name__ == '__main__':
     # This allows local testing
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+PDF text extraction engine.
+
+Pages are parsed across a process pool and streamed back in page order, so callers can
+stop as soon as they have enough text (e.g. once a prompt limit is filled) instead of
+parsing whole drawing sets. Kept free of Flask/Gemini imports so pool processes start fast.
+"""
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import threading
+
+import pdfplumber
+
+PDF_EXTRACT_PROCESSES = int(os.environ.get('PDF_EXTRACT_PROCESSES', min(4, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 4))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', 2))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def extract_page_range(path, start, end):
+    """Return the text of pages [start, end) of a PDF ('' for pages without text)."""
+    texts = []
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages[start:end]:
+            texts.append(page.extract_text() or "")
+    return texts
+
+
+def get_pool():
+    """Shared process pool (spawned, so it is safe to create from threaded gunicorn workers)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None and PDF_EXTRACT_PROCESSES > 1:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+def reset_pool():
+    """Discard a broken pool so the next call starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def iter_page_texts(file_obj, max_chars=None, stats=None):
+    """Yield the text of each page in order.
+
+    Large PDFs given by path are parsed across the process pool; file-like objects and short
+    documents are parsed in-process. Parsing stops once max_chars characters have been
+    yielded. If a stats dict is passed it receives pages_total, pages_parsed and parallel.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({"pages_total": 0, "pages_parsed": 0, "parallel": False})
+
+    with pdfplumber.open(file_obj) as pdf:
+        page_count = len(pdf.pages)
+        stats["pages_total"] = page_count
+        pool = None
+        if isinstance(file_obj, (str, os.PathLike)) and page_count >= PDF_PARALLEL_MIN_PAGES:
+            try:
+                pool = get_pool()
+            except OSError as e:
+                print(f"PDF process pool unavailable, parsing in-process: {e}")
+        if pool is None:
+            total = 0
+            for page in pdf.pages:
+                text = page.extract_text() or ""
+                stats["pages_parsed"] += 1
+                yield text
+                total += len(text)
+                if max_chars and total >= max_chars:
+                    return
+            return
+
+    stats["parallel"] = True
+    ranges = deque(
+        (start, min(start + PDF_PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PDF_PAGES_PER_TASK)
+    )
+    in_flight = deque()
+    window = PDF_EXTRACT_PROCESSES * 2
+    total = 0
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < window:
+                start, end = ranges.popleft()
+                in_flight.append(pool.submit(extract_page_range, file_obj, start, end))
+            for text in in_flight.popleft().result():
+                stats["pages_parsed"] += 1
+                yield text
+                total += len(text)
+                if max_chars and total >= max_chars:
+                    return
+    except BrokenProcessPool:
+        reset_pool()
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def extract_tables(file_obj):
+    """Return every table pdfplumber finds, as rows of whitespace-normalised cell strings."""
+    tables = []
+    with pdfplumber.open(file_obj) as pdf:
+        for page in pdf.pages:
+            for table in page.extract_tables():
+                tables.append([
+                    [" ".join((cell or "").split()) for cell in row]
+                    for row in table
+                ])
+    return tables
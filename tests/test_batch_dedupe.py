@@ -0,0 +1,30 @@
+"""Removing boilerplate lines repeated across the drawings of a transmittal batch."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+TITLE_BLOCK = "ACME STRUCTURAL ENGINEERS - BRISBANE QLD 4000"
+
+
+def test_long_lines_are_kept_only_where_they_first_appear():
+    texts = [f"{TITLE_BLOCK}\nFoundation Plan", f"{TITLE_BLOCK}\nFraming Plan", f"Details\n  {TITLE_BLOCK}  "]
+    new_texts, saved = main.dedupe_batch_texts(texts)
+    assert new_texts == [f"{TITLE_BLOCK}\nFoundation Plan", "Framing Plan", "Details"]
+    assert saved == [0, len(TITLE_BLOCK) + 1, len(TITLE_BLOCK) + 5]
+
+
+def test_short_lines_are_always_kept():
+    new_texts, saved = main.dedupe_batch_texts(["Rev B\nScale 1:100", "Rev B\nScale 1:100"])
+    assert new_texts == ["Rev B\nScale 1:100"] * 2
+    assert saved == [0, 0]
+
+
+def test_skipped_documents_stay_in_place():
+    new_texts, saved = main.dedupe_batch_texts([None, TITLE_BLOCK, TITLE_BLOCK])
+    assert new_texts == [None, TITLE_BLOCK, ""]
+    assert saved[0] == 0
@@ -0,0 +1,55 @@
+"""Cross-reference resolution against the drawings and connection details of one transmittal batch."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+
+def resolve(*references, connections=()):
+    aggregated = {
+        "DrawingRegister": [
+            {"DwgNo": "S-100", "Filename": "s100.pdf"},
+            {"DwgNo": "S-500", "Filename": "s500.pdf"},
+        ],
+        "Connections": list(connections),
+        "CrossReferences": [dict(SourceDocument="s100.pdf", **reference) for reference in references],
+    }
+    main.resolve_cross_references(aggregated)
+    return aggregated["CrossReferences"]
+
+
+def test_detail_on_another_sheet_is_resolved_through_the_index():
+    [xref] = resolve({"RefersTo": "See Detail D1/S-500"},
+                     connections=[{"DetailMark": "D1", "DrawingRef": "S-500", "SourceDocument": "s500.pdf"}])
+    assert (xref["TargetDrawing"], xref["TargetDetail"], xref["Found"]) == ("S-500", "D1", "Yes")
+    assert xref["Status"].startswith("Resolved - detail D1 on S-500")
+
+
+def test_bare_connection_mark_is_resolved_through_the_index():
+    [xref] = resolve({"RefersTo": "Refer to CBP-01"},
+                     connections=[{"DetailMark": "CBP-01", "SourceDocument": "s500.pdf"}])
+    assert (xref["TargetDrawing"], xref["TargetDetail"], xref["Found"]) == ("S-500", "CBP-01", "Yes")
+
+
+def test_mark_listed_on_several_sheets_is_ambiguous():
+    [xref] = resolve({"RefersTo": "Refer to CBP-01"}, connections=[
+        {"DetailMark": "CBP-01", "DrawingRef": "S-500"},
+        {"DetailMark": "CBP-01", "DrawingRef": "S-102"},
+    ])
+    assert (xref["TargetDetail"], xref["Found"]) == ("CBP-01", "N/A")
+    assert xref["Status"] == "Ambiguous - detail CBP-01 is on S-102, S-500"
+
+
+def test_drawing_numbers_must_stand_alone():
+    dangling, unknown = resolve({"RefersTo": "Refer to S-501"}, {"RefersTo": "Refer to XS-1001"})
+    assert (dangling["TargetDrawing"], dangling["Found"]) == ("S-501", "No")
+    assert (unknown["TargetDrawing"], unknown["Status"]) == ("N/A", "No drawing number in reference")
+
+
+def test_detail_without_a_sheet_points_to_its_own_drawing():
+    [xref] = resolve({"RefersTo": "See Detail D3"})
+    assert (xref["TargetDrawing"], xref["TargetDetail"], xref["Found"]) == ("S-100", "D3", "Yes")
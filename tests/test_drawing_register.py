@@ -0,0 +1,67 @@
+"""The per-drawing register: lookup by file hash, re-issues and older revisions."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def register_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DRAWING_REGISTER_DB_PATH", str(tmp_path / "register.sqlite3"))
+    monkeypatch.setattr(main, "_drawing_register_ready", False)
+
+
+def sheet(rev, title="Foundation Plan"):
+    return {"DrawingRegister": {"DwgNo": "S-100", "Rev": rev, "Title": title, "Scale": "1:100"}, "Standards": []}
+
+
+def superseded_rows():
+    conn = main._open_drawing_register()
+    try:
+        return [tuple(row) for row in conn.execute("SELECT dwg_no, rev, filename, superseded_by_rev FROM superseded")]
+    finally:
+        conn.close()
+
+
+def test_registered_entry_is_found_by_file_hash():
+    assert main.register_drawing("hash-b", "s100.pdf", sheet("B"), "gemini-2.5-pro") is None
+    registered = main.get_registered_drawing("hash-b")
+    assert (registered["dwg_no"], registered["rev"], registered["model"]) == ("S-100", "B", "gemini-2.5-pro")
+    assert registered["entries"] == [sheet("B")]
+    assert main.get_registered_drawing("hash-other") is None
+
+
+def test_new_revision_supersedes_the_registered_one():
+    main.register_drawing("hash-b", "s100_b.pdf", sheet("B"), "gemini-2.5-pro")
+    note = main.register_drawing("hash-c", "s100_c.pdf", sheet("C"), "gemini-2.5-pro")
+    assert note.startswith("✓ S-100 re-issued: Rev B (s100_b.pdf) superseded by Rev C")
+    assert main.get_registered_drawing("hash-b") is None
+    assert main.get_registered_drawing("hash-c")["rev"] == "C"
+    assert superseded_rows() == [("S-100", "B", "s100_b.pdf", "C")]
+
+
+def test_older_revision_leaves_the_register_unchanged():
+    main.register_drawing("hash-1", "s100_1.pdf", sheet("1"), "gemini-2.5-pro")
+    note = main.register_drawing("hash-c", "s100_c.pdf", sheet("C"), "gemini-2.5-pro")
+    assert note == "S-100 Rev C is older than registered Rev 1 (s100_1.pdf) - register unchanged"
+    assert main.get_registered_drawing("hash-1")["rev"] == "1"
+    assert superseded_rows() == []
+
+
+def test_same_file_re_registered_is_an_update_not_a_reissue():
+    main.register_drawing("hash-b", "s100.pdf", sheet("B"), "gemini-2.5-flash-lite")
+    assert main.register_drawing("hash-b", "s100.pdf", sheet("B", "Foundation Plan (Rev B)"), "gemini-2.5-pro") is None
+    assert main.get_registered_drawing("hash-b")["entries"][0]["DrawingRegister"]["Title"] == "Foundation Plan (Rev B)"
+    assert superseded_rows() == []
+
+
+def test_entry_without_a_drawing_number_is_not_registered():
+    entry = {"DrawingRegister": {"DwgNo": "N/A", "Rev": "A"}}
+    assert main.register_drawing("hash-x", "unknown.pdf", entry, "gemini-2.5-pro") is None
+    assert main.get_registered_drawing("hash-x") is None
@@ -0,0 +1,52 @@
+"""Extraction cache keys and the memory/disk lookup, against a throwaway SQLite file."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+FILE_HASH = "ab" * 32
+ROWS = [{"Mark": "B1", "Size": "200UB25"}]
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "EXTRACTION_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "EXTRACTION_CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(main, "_extraction_cache_ready", False)
+    monkeypatch.setattr(main, "_extraction_cache_memory", main.OrderedDict())
+
+
+def test_key_depends_on_file_doc_type_and_model():
+    key = main.extraction_cache_key(FILE_HASH, "engineering", "gemini-2.5-pro")
+    assert key == main.extraction_cache_key(FILE_HASH, "engineering", "gemini-2.5-pro")
+    assert key != main.extraction_cache_key("cd" * 32, "engineering", "gemini-2.5-pro")
+    assert key != main.extraction_cache_key(FILE_HASH, "transmittal", "gemini-2.5-pro")
+    assert key != main.extraction_cache_key(FILE_HASH, "engineering", "gemini-2.5-flash-lite")
+
+
+def test_lookup_returns_the_first_candidate_model_with_a_result():
+    main.store_cached_extraction(FILE_HASH, "engineering", "gemini-2.5-pro", ROWS, "beam")
+    assert main.get_cached_extraction(FILE_HASH, "engineering", ["gemini-2.5-flash-lite"]) is None
+    record = main.get_cached_extraction(FILE_HASH, "engineering", ["gemini-2.5-flash-lite", "gemini-2.5-pro"])
+    assert (record["entries"], record["schedule_type"], record["model"], record["tier"]) == (ROWS, "beam", "gemini-2.5-pro", "memory")
+
+
+def test_disk_tier_is_used_when_the_memory_tier_is_empty():
+    main.store_cached_extraction(FILE_HASH, "engineering", "gemini-2.5-pro", ROWS, "beam")
+    main._extraction_cache_memory.clear()
+    assert main.get_cached_extraction(FILE_HASH, "engineering", ["gemini-2.5-pro"])["tier"] == "disk"
+    # the disk hit is promoted to memory
+    assert main.get_cached_extraction(FILE_HASH, "engineering", ["gemini-2.5-pro"])["tier"] == "memory"
+
+
+def test_disabled_cache_neither_stores_nor_returns(monkeypatch):
+    monkeypatch.setattr(main, "EXTRACTION_CACHE_ENABLED", False)
+    main.store_cached_extraction(FILE_HASH, "engineering", "gemini-2.5-pro", ROWS, "beam")
+    monkeypatch.setattr(main, "EXTRACTION_CACHE_ENABLED", True)
+    assert main.get_cached_extraction(FILE_HASH, "engineering", ["gemini-2.5-pro"]) is None
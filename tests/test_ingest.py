@@ -0,0 +1,74 @@
+"""Invoice ingestion: claiming files by content hash, storing outcomes and the admin listing."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+TOKEN = "test-admin-token"
+
+
+@pytest.fixture(autouse=True)
+def ingest_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "INGEST_DB_PATH", str(tmp_path / "ingest.sqlite3"))
+    monkeypatch.setattr(main, "_ingest_store_ready", False)
+    monkeypatch.setattr(main, "ADMIN_TOKEN", TOKEN)
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def test_claims_are_keyed_by_content_hash():
+    assert main.claim_ingested("hash-1", "/in/a.pdf") == "queued"
+    assert main.claim_ingested("hash-1", "/in/a.pdf") == "known"
+    assert main.claim_ingested("hash-1", "/in/copy of a.pdf") == "duplicate"
+    assert main.claim_ingested("hash-2", "/in/b.pdf") == "queued"
+    by_hash = {row["file_hash"]: row for row in main.list_ingested()}
+    assert (by_hash["hash-1"]["filename"], by_hash["hash-1"]["duplicates"]) == ("a.pdf", 1)
+    assert {row["file_hash"] for row in main.list_ingested(status="queued")} == {"hash-1", "hash-2"}
+
+
+def test_outcome_is_stored_with_rows_tagged_by_filename(monkeypatch):
+    def fake_process_document(path, doc_type):
+        return dict(main.new_outcome(path), entries=[{"Vendor": "ACME"}], model="gemini-2.5-pro", actions=["done"])
+
+    monkeypatch.setattr(main, "process_document", fake_process_document)
+    main.claim_ingested("hash-1", "/in/a.pdf")
+    main.ingest_invoice("/in/a.pdf", "hash-1")
+    [row] = main.list_ingested(status="done")
+    assert (row["model"], row["rows"], row["actions"]) == ("gemini-2.5-pro", [{"Vendor": "ACME", "Filename": "a.pdf"}], ["done"])
+
+
+def test_pipeline_exception_is_stored_as_an_error(monkeypatch):
+    def failing_process_document(path, doc_type):
+        raise OSError("disk gone")
+
+    monkeypatch.setattr(main, "process_document", failing_process_document)
+    main.claim_ingested("hash-1", "/in/a.pdf")
+    main.ingest_invoice("/in/a.pdf", "hash-1")
+    [row] = main.list_ingested(status="error")
+    assert row["error"] == "OSError: disk gone"
+
+
+def test_listing_requires_the_admin_token(client, monkeypatch):
+    assert client.get('/api/ingest/invoices').status_code == 401
+    assert client.get('/api/ingest/invoices', headers={'X-Admin-Token': 'wrong'}).status_code == 401
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    assert client.get('/api/ingest/invoices', headers={'X-Admin-Token': TOKEN}).status_code == 404
+
+
+def test_listing_validates_the_limit(client):
+    headers = {'X-Admin-Token': TOKEN}
+    assert client.get('/api/ingest/invoices?limit=ten', headers=headers).status_code == 400
+    main.claim_ingested("hash-1", "/in/a.pdf")
+    main.claim_ingested("hash-2", "/in/b.pdf")
+    response = client.get('/api/ingest/invoices?limit=0&status=queued', headers=headers)
+    assert response.status_code == 200
+    assert len(response.get_json()["invoices"]) == 1  # limit is clamped to at least 1
@@ -0,0 +1,119 @@
+"""Local (no LLM) parsers run against the sample schedules in drawings/ and the sample invoices in invoices/."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+from pdf_extraction import extract_tables  # noqa: E402
+
+
+def sample(*parts):
+    return os.path.join(ROOT, *parts)
+
+
+def invoice_text(name):
+    with open(sample('invoices', name), 'rb') as f:
+        return main.extract_text(f)
+
+
+def test_column_schedule_is_parsed_from_tables():
+    entries, schedule_type = main.parse_schedule_tables(extract_tables(sample('drawings', 'schedule_revit.pdf')))
+    assert schedule_type == "column"
+    assert [e["Mark"] for e in entries] == ["C1", "C2", "C3", "C4", "C5"]
+    assert entries[0]["Size"] == "310 UC 158"
+    assert entries[0]["Length"] == "4500 mm"
+    assert entries[4]["CapPlate"] == "N/A"
+    assert main.validate_entries(entries, "engineering") == []
+
+
+def test_beam_schedule_is_parsed_from_tables():
+    entries, schedule_type = main.parse_schedule_tables(extract_tables(sample('drawings', 'schedule_cad.pdf')))
+    assert schedule_type == "beam"
+    marks = [e["Mark"] for e in entries]
+    assert len(marks) == len(set(marks)) == 8
+    assert entries[0] == {
+        "Mark": "B-101", "Size": "460UB82.1", "Qty": "12", "Length": "8500 mm", "Grade": "300PLUS",
+        "PaintSystem": "P1 (2 coats)", "Comments": "Main Ridge Beam. Fly Brace @ 1500 CTRS. See Detail D1/S-500"
+    }
+    # "VARIES 1200-2400 mm" lengths are flagged, so they are re-asked like model output
+    flagged = {(issue["row"], issue["field"]) for issue in main.validate_entries(entries, "engineering")}
+    assert flagged == {(6, "Length"), (7, "Length")}
+
+
+def test_incomplete_header_is_left_to_the_model():
+    tables = extract_tables(sample('drawings', 'schedule_cad.pdf'))
+    for table in tables:
+        table[0] = ["LEN" if "LENGTH" in str(cell).upper() else cell for cell in table[0]]
+    assert main.parse_schedule_tables(tables) == (None, None)
+
+
+def test_invoice_with_matching_subtotal_and_gst_skips_the_model():
+    entry, _, score = main.parse_invoice_locally(invoice_text('Bne.pdf'))
+    assert score >= main.INVOICE_PREPARSE_MIN_CONFIDENCE
+    assert entry == {
+        "Vendor": "BNE STRUCTURAL STEEL PTY LTD", "Date": "2025-11-14", "InvoiceNum": "INV-2025-889",
+        "Cost": "2070.00", "GST": "207.00", "FinalAmount": "2277.00", "Summary": "Fabrication of 200UB25 Beams"
+    }
+
+
+def test_till_receipt_with_abn_skips_the_model():
+    entry, _, score = main.parse_invoice_locally(invoice_text('Tingalpa.pdf'))
+    assert score >= main.INVOICE_PREPARSE_MIN_CONFIDENCE
+    assert (entry["Vendor"], entry["Date"], entry["FinalAmount"], entry["GST"]) == ("TINGALPA HARDWARE", "2025-11-15", "61.45", "5.59")
+    assert entry["Cost"] == "55.86"  # total less GST; no subtotal is printed
+    assert entry["InvoiceNum"] == "N/A"
+
+
+def test_receipt_without_abn_or_gst_goes_to_the_model():
+    entry, _, score = main.parse_invoice_locally(invoice_text('CloudRender.pdf'))
+    assert score == 0
+    assert (entry["Vendor"], entry["Date"], entry["FinalAmount"]) == ("CloudRender.io", "2025-11-01", "450.00")
+
+
+@pytest.mark.parametrize("abn, trusted", [("", False), ("ABN: 12 345 678 901\n", True)])
+def test_bare_upper_case_vendor_needs_an_abn(abn, trusted):
+    text = f"ACME\n{abn}Date: 3 Mar 2025\nSubtotal: $100.00\nGST: $10.00\nTOTAL: $110.00\n"
+    _, confidences, score = main.parse_invoice_locally(text)
+    assert (confidences["Vendor"] >= main.INVOICE_PREPARSE_MIN_CONFIDENCE) is trusted
+    assert (score >= main.INVOICE_PREPARSE_MIN_CONFIDENCE) is trusted
+
+
+@pytest.mark.parametrize("amount_lines", [
+    "Total ex GST $300.00\nGST $30.00\nTotal inc GST $330.00\n",
+    "Subtotal $300.00\nTotal GST $30.00\nTotal Amount Due $330.00\n",
+])
+def test_ex_gst_and_gst_totals_are_not_read_as_the_amount_payable(amount_lines):
+    text = f"ACME PTY LTD\nABN: 12 345 678 901\nInvoice #: 123\nDate: 3 Mar 2025\n{amount_lines}"
+    entry, _, score = main.parse_invoice_locally(text)
+    assert (entry["Cost"], entry["GST"], entry["FinalAmount"]) == ("300.00", "30.00", "330.00")
+    assert score >= main.INVOICE_PREPARSE_MIN_CONFIDENCE
+
+
+def test_subtotal_that_does_not_add_up_goes_to_the_model():
+    text = "ACME PTY LTD\nABN: 12 345 678 901\nDate: 3 Mar 2025\nSubtotal $300.00\nGST $30.00\nTOTAL $360.00\n"
+    _, confidences, score = main.parse_invoice_locally(text)
+    assert score == 0
+    assert confidences["FinalAmount"] == 0
+
+
+def test_derived_cost_alone_does_not_corroborate():
+    # No ABN and no printed subtotal: Cost = total - GST always "adds up", so it proves nothing
+    text = "ACME PTY LTD\nDate: 3 Mar 2025\nGST $30.00\nTOTAL $330.00\n"
+    entry, _, score = main.parse_invoice_locally(text)
+    assert entry["Cost"] == "300.00"
+    assert score == 0
+
+
+def test_title_block_register_is_trusted_only_when_printed_in_the_title_block():
+    with open(sample('drawings', 's101_ground_floor_plan.pdf'), 'rb') as f:
+        text = main.extract_text(f)
+    register = main.extract_drawing_register(text)
+    assert main.register_is_reliable(register, text)
+    assert not main.register_is_reliable(dict(register, Scale="N/A"), text)
+    # a drawing number that only appears in a file path is not trusted
+    assert not main.register_is_reliable(dict(register, DwgNo="S-999"), text + "\nC:/projects/S-999.dwg")
@@ -0,0 +1,53 @@
+"""Parsing model responses: fences and prose, truncation salvage, and streamed array rows."""
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+
+def test_fenced_json_is_complete():
+    assert main.parse_model_json('```json\n[{"a": 1}]\n```') == ([{"a": 1}], None, False)
+
+
+def test_prose_around_the_json_is_ignored():
+    parsed, note, partial = main.parse_model_json('Here you go:\n[{"a": 1}, {"b": "x]"}]\nHope this helps')
+    assert parsed == [{"a": 1}, {"b": "x]"}]
+    assert note == "Ignored text around the JSON response"
+    assert partial is False
+
+
+def test_truncated_array_keeps_complete_rows_and_is_partial():
+    parsed, note, partial = main.parse_model_json('[{"a": 1}, {"b": "x]"}, {"c": "trunc')
+    assert parsed == [{"a": 1}, {"b": "x]"}]
+    assert note.startswith("Response was truncated")
+    assert partial is True
+
+
+def test_truncated_object_closes_open_brackets():
+    parsed, _, partial = main.parse_model_json('{"DrawingRegister": {"DwgNo": "S-100"}, "Standards": [{"s": "AS 4100"}, {"s": "AS')
+    assert parsed == {"DrawingRegister": {"DwgNo": "S-100"}, "Standards": [{"s": "AS 4100"}]}
+    assert partial is True
+
+
+def test_no_json_raises():
+    with pytest.raises(json.JSONDecodeError):
+        main.parse_model_json("no json here")
+
+
+def test_array_items_are_yielded_across_fragment_boundaries():
+    source = '```json\n[{"Mark": "B1"}, {"Mark": "B2", "Note": "a \\" [quote] }"},\n{"Mark": "B3"}]```'
+    fragments = [source[i:i + 5] for i in range(0, len(source), 5)]
+    assert list(main.iter_json_array_items(fragments)) == [
+        {"Mark": "B1"}, {"Mark": "B2", "Note": 'a " [quote] }'}, {"Mark": "B3"}
+    ]
+
+
+def test_array_items_stop_at_a_truncated_row():
+    assert list(main.iter_json_array_items(['[{"Mark": "B1"}, {"Mark": "B'])) == [{"Mark": "B1"}]
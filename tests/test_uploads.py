@@ -0,0 +1,80 @@
+"""Content-addressed upload storage and its garbage collection, in a temporary upload folder."""
+import hashlib
+import io
+import os
+import sys
+import time
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GEMINI_CLIENT_WARMUP', '0')
+
+import main  # noqa: E402
+
+PDF = b"%PDF-1.4\n% test invoice\n"
+
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "UPLOAD_SPOOL_DIR", str(tmp_path / ".spool"))
+    return tmp_path
+
+
+def upload(data, filename):
+    return main.store_upload(FileStorage(stream=io.BytesIO(data), filename=filename), filename)
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_upload_is_stored_under_its_content_hash(upload_dir):
+    path, duplicate = upload(PDF, "inv.pdf")
+    assert path == str(upload_dir / hashlib.sha256(PDF).hexdigest() / "inv.pdf")
+    assert not duplicate
+    with open(path, "rb") as f:
+        assert f.read() == PDF
+    assert os.listdir(upload_dir / ".spool") == []
+
+
+def test_repeat_upload_keeps_its_name_and_shares_the_stored_copy():
+    first, _ = upload(PDF, "inv.pdf")
+    again, duplicate = upload(PDF, "inv.pdf")
+    renamed, renamed_duplicate = upload(PDF, "copy of inv.pdf")
+    assert (again, duplicate) == (first, True)
+    assert renamed_duplicate
+    assert os.path.basename(renamed) == "copy of inv.pdf"
+    assert os.path.dirname(renamed) == os.path.dirname(first)
+    assert main._upload_entry_size(os.path.dirname(first)) == len(PDF)  # hard links counted once
+
+
+def test_non_pdf_is_rejected(upload_dir):
+    assert upload(b"hello", "notes.pdf") == (None, False)
+    assert [name for name in os.listdir(upload_dir) if name != ".spool"] == []
+
+
+def test_gc_removes_expired_uploads_and_old_spool_files(upload_dir):
+    kept, _ = upload(PDF, "new.pdf")
+    expired, _ = upload(PDF + b"old", "old.pdf")
+    age(os.path.dirname(expired), main.UPLOAD_RETENTION_SECONDS + 60)
+    spool = upload_dir / ".spool" / "upload-abandoned"
+    spool.write_bytes(b"partial")
+    age(spool, 25 * 3600)
+    assert main.gc_uploads() == 1
+    assert os.path.exists(kept)
+    assert not os.path.exists(os.path.dirname(expired))
+    assert not spool.exists()
+
+
+def test_quota_evicts_the_oldest_uploads_but_not_recent_ones(monkeypatch):
+    paths = [upload(PDF + bytes([i]) * 100, f"inv{i}.pdf")[0] for i in range(3)]
+    for i, path in enumerate(paths[:2]):
+        age(os.path.dirname(path), main.UPLOAD_GC_MIN_AGE_SECONDS + 600 - i)
+    monkeypatch.setattr(main, "UPLOAD_QUOTA_BYTES", 1)
+    assert main.gc_uploads() == 2
+    assert [os.path.exists(path) for path in paths] == [False, False, True]